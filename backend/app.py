@@ -1,74 +1,443 @@
 # backend/app.py
 import os
-import tempfile
 import json
-from flask import Flask, request, jsonify, send_from_directory
+import time
+# 起動時間の計測用 (このモジュールが依存モジュールを読み込むのにかかった時間)
+_IMPORT_STARTED_AT = time.perf_counter()
+import base64
+import uuid
+from flask import Blueprint, Flask, Request, current_app, request, g, jsonify, send_from_directory, Response, stream_with_context
+from tempfile import SpooledTemporaryFile
 from flask_cors import CORS
 from dotenv import load_dotenv
 import logging
-from datetime import datetime
-from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime, date, timedelta
+from sqlalchemy import and_, bindparam, or_, func, inspect, select, text, update
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import load_only, undefer
 
 # backend内のモジュールをインポート
-from gemini import chat_with_ai, generate_diary_from_conversation, transcribe_audio # transcribe_audio を追加
-from notion import save_to_notion
+# (gemini / notion / audio_ingest は SDK やクライアントを最初に使うときに読み込むため、インポート自体は軽い)
+import gemini
+import notion
+import audio_ingest
+from gemini import (chat_with_ai, chat_with_ai_stream, generate_diary_from_conversation,
+                    listen_and_reply, summarize_conversation, estimate_tokens, get_client_stats)
+from notion import is_notion_configured
+from notion_sync import NotionSyncWorker
+from idempotency import RequestDeduplicator, conversation_key
+import metrics
+from metrics import span
+from audio_ingest import ingest_audio, transcribe_ingested, AudioRejectedError, AUDIO_MAX_BYTES, AUDIO_SPOOL_MAX_BYTES
+from models import db, make_preview, Diary, SentimentRollup, NotionOutbox, ChatSession, ChatTurn, DiaryRequest
+from search import ensure_search_index, rebuild_search_index, drop_search_index, search_diaries
+
+_IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED_AT
 
 load_dotenv()
 
-app = Flask(__name__, static_folder=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'frontend'), static_url_path='')
+class _SpoolingRequest(Request):
+    """アップロードファイルを AUDIO_SPOOL_MAX_BYTES までメモリ上に置くリクエスト (既定の 500KB ではすぐディスクに書かれるため)"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return SpooledTemporaryFile(max_size=AUDIO_SPOOL_MAX_BYTES, mode="rb+")
+
+# ルートはこの Blueprint に登録し、create_app でアプリに組み込む
+bp = Blueprint("talklog", __name__)
 
-# --- Database Configuration --- #
 db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'talklog.db')
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
-# --- End Database Configuration --- #
 
 # CORS設定を環境変数から読み込む
 CORS_ORIGIN = os.getenv("CORS_ORIGIN", "http://localhost:8000")
-CORS(app, resources={r"/api/*": {"origins": CORS_ORIGIN}})
+
+# 1 のときは create_app の中で prewarm を行う (オートスケールで追加されたインスタンスを温めてからトラフィックを受けるため)
+APP_PREWARM = os.getenv("APP_PREWARM", "0") == "1"
 
 # ロギング設定
 logging.basicConfig(level=logging.INFO)
 
-# --- Database Model --- #
-class Diary(db.Model):
-    """日記エントリを保存するモデル"""
-    id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
-    diary_content = db.Column(db.Text, nullable=False)
-    sentiment_score = db.Column(db.Float, nullable=True)
-    highlight_events = db.Column(db.String(255), nullable=True)
-
-    def to_dict(self):
-        """モデルオブジェクトを辞書に変換"""
-        return {
-            'id': self.id,
-            'date': self.date.isoformat(),
-            'diary_content': self.diary_content,
-            'sentiment_score': self.sentiment_score,
-            'highlight_events': self.highlight_events
-        }
-# --- End Database Model --- #
-
-@app.route('/')
+SENTIMENT_BUCKETS = ('day', 'week', 'month')
+
+def _bucket_start(dt, bucket):
+    """日時が属する集計期間の開始日を返す (週は月曜始まり)"""
+    day = dt.date() if isinstance(dt, datetime) else dt
+    if bucket == 'day':
+        return day
+    if bucket == 'week':
+        return day - timedelta(days=day.weekday())
+    if bucket == 'month':
+        return day.replace(day=1)
+    raise ValueError(f"Unknown bucket: {bucket}")
+
+def _record_sentiment(diary_date, score):
+    """感情スコアを各集計期間に加算する (commit は呼び出し側で行う)"""
+    if score is None:
+        return
+    table = SentimentRollup.__table__
+    for bucket in SENTIMENT_BUCKETS:
+        stmt = sqlite_insert(table).values(
+            bucket=bucket, bucket_start=_bucket_start(diary_date, bucket),
+            count=1, score_sum=score, score_min=score, score_max=score
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.bucket, table.c.bucket_start],
+            set_={
+                'count': table.c.count + 1,
+                'score_sum': table.c.score_sum + stmt.excluded.score_sum,
+                'score_min': func.min(table.c.score_min, stmt.excluded.score_min),
+                'score_max': func.max(table.c.score_max, stmt.excluded.score_max),
+            }
+        )
+        db.session.execute(stmt)
+
+def _rebuild_sentiment_rollups():
+    """既存の日記から集計テーブルを作り直す (集計はメモリ上で行い、まとめて挿入する)"""
+    rollups = {}
+    query = (db.session.query(Diary.date, Diary.sentiment_score)
+             .filter(Diary.sentiment_score.isnot(None))
+             .execution_options(yield_per=10000))
+    for diary_date, score in query:
+        for bucket in SENTIMENT_BUCKETS:
+            key = (bucket, _bucket_start(diary_date, bucket))
+            row = rollups.get(key)
+            if row is None:
+                rollups[key] = {'bucket': key[0], 'bucket_start': key[1], 'count': 1,
+                                'score_sum': score, 'score_min': score, 'score_max': score}
+            else:
+                row['count'] += 1
+                row['score_sum'] += score
+                row['score_min'] = min(row['score_min'], score)
+                row['score_max'] = max(row['score_max'], score)
+    db.session.query(SentimentRollup).delete()
+    if rollups:
+        db.session.execute(SentimentRollup.__table__.insert(), list(rollups.values()))
+    db.session.commit()
+
+def _bucket_end(start, bucket):
+    """集計期間の終了日 (次の期間の開始日) を返す"""
+    if bucket == 'day':
+        return start + timedelta(days=1)
+    if bucket == 'week':
+        return start + timedelta(days=7)
+    return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+def _refresh_sentiment_rollups(diary_dates):
+    """
+    指定した日時を含む集計期間だけを日記テーブルから集計し直す (commit は呼び出し側で行う)。
+    既存の日記のスコアを書き換えた場合に使う (最小・最大値は差分では更新できないため)。
+    """
+    for bucket in SENTIMENT_BUCKETS:
+        for start in {_bucket_start(diary_date, bucket) for diary_date in diary_dates}:
+            begin = datetime.combine(start, datetime.min.time())
+            end = datetime.combine(_bucket_end(start, bucket), datetime.min.time())
+            count, score_sum, score_min, score_max = (
+                db.session.query(func.count(Diary.sentiment_score), func.sum(Diary.sentiment_score),
+                                 func.min(Diary.sentiment_score), func.max(Diary.sentiment_score))
+                .filter(Diary.date >= begin, Diary.date < end)
+                .one()
+            )
+            SentimentRollup.query.filter_by(bucket=bucket, bucket_start=start).delete()
+            if count:
+                db.session.add(SentimentRollup(bucket=bucket, bucket_start=start, count=count,
+                                               score_sum=score_sum, score_min=score_min, score_max=score_max))
+
+def _add_missing_columns():
+    """既存テーブルにモデルで追加されたカラムがなければ ALTER TABLE で追加する"""
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                current_app.logger.info(f"Adding column {table.name}.{column.name}")
+                with db.engine.begin() as conn:
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+# 本文の圧縮・プレビュー導入前の日記を移行するときの 1 トランザクションあたりの件数
+DIARY_MIGRATION_BATCH_SIZE = 1000
+
+def _migrate_diary_storage():
+    """プレビューのない (圧縮導入前の) 日記の本文を圧縮して保存し直し、プレビューを作る"""
+    table = Diary.__table__
+    migrated = 0
+    update = (table.update()
+              .where(table.c.id == bindparam('_id'))
+              .values(diary_content=bindparam('_content'), preview=bindparam('_preview')))
+    while True:
+        # 列の型 (CompressedText) を通すため、読み出しで展開され、書き込みで圧縮される
+        rows = db.session.execute(
+            db.select(table.c.id, table.c.diary_content)
+            .where(table.c.preview.is_(None)).order_by(table.c.id).limit(DIARY_MIGRATION_BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        db.session.execute(update, [{'_id': row.id, '_content': row.diary_content, '_preview': make_preview(row.diary_content)}
+                                    for row in rows])
+        db.session.commit()
+        migrated += len(rows)
+    return migrated
+
+def init_db():
+    """テーブルを作成し、既存テーブルに不足しているカラムとインデックスを追加する (アプリケーションコンテキスト内で呼ぶ)"""
+    db.create_all()
+    _add_missing_columns()
+    # create_all は既存テーブルにインデックスを追加しないため個別に作成する
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+    # 集計テーブル導入前のデータベースでは既存の日記から集計を作成する
+    if SentimentRollup.query.first() is None and Diary.query.first() is not None:
+        current_app.logger.info("Backfilling sentiment rollups from existing diaries")
+        _rebuild_sentiment_rollups()
+    # 本文の圧縮導入前の日記を移行する (索引のトリガーが 1 行ずつ再索引しないよう外しておき、移行後に作り直す)
+    if Diary.query.filter(Diary.preview.is_(None)).first() is not None:
+        current_app.logger.info("Compressing diary bodies and building previews for existing diaries")
+        drop_search_index()
+        current_app.logger.info(f"Migrated {_migrate_diary_storage()} diaries")
+    # 全文検索の索引を導入する前のデータベースでは既存の日記を索引する (以降はトリガーで同期される)
+    if ensure_search_index() and Diary.query.first() is not None:
+        current_app.logger.info("Backfilling full-text search index from existing diaries")
+        rebuild_search_index()
+
+@bp.route('/')
 def serve_index():
-    return send_from_directory(app.static_folder, 'index.html')
+    return send_from_directory(current_app.static_folder, 'index.html')
 
-@app.route('/dashboard.html')
+@bp.route('/dashboard.html')
 def serve_dashboard():
-    return send_from_directory(app.static_folder, 'dashboard.html')
+    return send_from_directory(current_app.static_folder, 'dashboard.html')
 
-@app.post("/api/chat")
+# 音声入力の処理方式: "combined" (文字起こしと応答を 1 回の呼び出しで行う) | "two_step"
+CHAT_AUDIO_MODE = os.getenv("CHAT_AUDIO_MODE", "combined")
+
+class ApiError(Exception):
+    """クライアントに JSON のエラーメッセージとして返す例外"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+# --- Metrics --- #
+@bp.before_app_request
+def start_request_timing():
+    g.request_started_at = time.perf_counter()
+    g.request_timings = metrics.start_request()
+
+@bp.after_app_request
+def record_request_timing(response):
+    started_at = g.get("request_started_at")
+    if started_at is None:
+        return response
+    elapsed = time.perf_counter() - started_at
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.observe_request(request.method, endpoint, response.status_code, elapsed)
+    if metrics.SERVER_TIMING_ENABLED:
+        # ストリーミングのレスポンスではヘッダー送信後の処理は含まれない
+        response.headers["Server-Timing"] = metrics.server_timing_header(g.request_timings, total=elapsed)
+    return response
+
+@bp.get("/metrics")
+def metrics_endpoint():
+    """Prometheus のテキスト形式で集計値を返す"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@bp.app_errorhandler(ApiError)
+def handle_api_error(e):
+    return jsonify(error=e.message), e.status
+
+@bp.app_errorhandler(413)
+def handle_request_too_large(e):
+    return jsonify(error=f"アップロードが大きすぎます (上限 {AUDIO_MAX_BYTES // (1024 * 1024)}MB)。"), 413
+
+# --- Chat sessions --- #
+# 要約されていない会話のトークン数がこれを超えたら古い発言を要約に畳み込む
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", 4000))
+# 畳み込み後もそのまま残す直近の発言数
+CHAT_KEEP_RECENT_TURNS = int(os.getenv("CHAT_KEEP_RECENT_TURNS", 6))
+
+def _load_chat_context(form):
+    """
+    リクエストのフォームから会話の文脈を読み込む (DB アクセスのみで、モデルは呼ばない)。
+    conversation があれば従来どおりそれを使い、なければ session_id のセッション (省略時は新規) を使う。
+    新規セッションは ID だけを決めておき、最初の発言を保存するとき (_append_turns) に作成する。
+    戻り値の辞書:
+      session_id: セッションID (conversation を使う場合は None)
+      summary:    要約済みの古い会話
+      history:    要約されていない発言のリスト
+      fold_count: トークン予算を超えたため要約に畳み込むべき先頭の発言数 (0 なら不要)
+      fold_upto:  畳み込む最後の発言の通し番号
+    """
+    context = {"session_id": None, "summary": None, "history": [], "fold_count": 0, "fold_upto": 0}
+    if 'conversation' in form:
+        try:
+            conversation_history = json.loads(form["conversation"])
+            if not isinstance(conversation_history, list):
+                raise ValueError("Conversation history is not a list.")
+        except (json.JSONDecodeError, ValueError) as e:
+            current_app.logger.error(f"Failed to parse conversation history: {e}")
+            raise ApiError("会話履歴の形式が正しくありません。")
+        context["history"] = conversation_history
+        return context
+
+    if not form.get("session_id"):
+        # 応答の生成に失敗した場合に空のセッションを残さないよう、ここではまだ作成しない
+        context["session_id"] = uuid.uuid4().hex
+        return context
+    chat_session = db.session.get(ChatSession, form["session_id"])
+    if chat_session is None:
+        raise ApiError("会話セッションが見つかりません。", 404)
+
+    turns = (ChatTurn.query
+             .filter(ChatTurn.session_id == chat_session.id, ChatTurn.seq > chat_session.summarized_turns)
+             .order_by(ChatTurn.seq)
+             .all())
+    context.update(session_id=chat_session.id, summary=chat_session.summary,
+                   history=[turn.to_dict() for turn in turns])
+    tokens = estimate_tokens(chat_session.summary or "") + sum(estimate_tokens(turn.content) for turn in turns)
+    if tokens > CHAT_CONTEXT_TOKEN_BUDGET and len(turns) > CHAT_KEEP_RECENT_TURNS:
+        context["fold_count"] = len(turns) - CHAT_KEEP_RECENT_TURNS
+        context["fold_upto"] = turns[context["fold_count"] - 1].seq
+        current_app.logger.info(f"Chat session {chat_session.id} is over budget ({tokens} tokens); folding {context['fold_count']} turns")
+    return context
+
+def _save_compaction(session_id, summary, fold_upto):
+    """畳み込み後の要約を保存する (保存に失敗しても会話は続けられるので、警告を出して False を返す)"""
+    try:
+        chat_session = db.session.get(ChatSession, session_id)
+        chat_session.summary = summary
+        chat_session.summarized_turns = fold_upto
+        db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        current_app.logger.warning(f"Failed to save compaction of chat session {session_id}: {e}")
+        return False
+    current_app.logger.info(f"Compacted chat session {session_id} up to turn {fold_upto}")
+    return True
+
+def _apply_compaction(context, summary):
+    """要約済みの発言を context から取り除く"""
+    context["summary"] = summary
+    context["history"] = context["history"][context["fold_count"]:]
+    context["fold_count"] = 0
+
+def _compact_chat_context(context):
+    """必要なら古い発言を要約に畳み込む (要約に失敗してもプロンプトが長くなるだけなので会話は続ける)"""
+    if not context["fold_count"]:
+        return
+    try:
+        summary = summarize_conversation(context["summary"], context["history"][:context["fold_count"]])
+    except Exception as e:
+        current_app.logger.warning(f"Failed to compact chat session {context['session_id']}: {e}")
+        return
+    if _save_compaction(context["session_id"], summary, context["fold_upto"]):
+        _apply_compaction(context, summary)
+
+# 同じセッションへの同時保存で通し番号が衝突した場合の再試行回数
+_APPEND_TURNS_ATTEMPTS = 3
+
+def _append_turns(session_id, user_text, ai_reply):
+    """
+    ユーザーの発言と AI の応答をセッションに保存する (新規セッションはここで作成する)。
+    通し番号はセッションの turn_count を UPDATE で進めて同じトランザクション内で確保し、衝突した場合は再試行する。
+    """
+    for attempt in range(1, _APPEND_TURNS_ATTEMPTS + 1):
+        try:
+            now = datetime.utcnow()
+            updated = db.session.execute(
+                update(ChatSession).where(ChatSession.id == session_id)
+                .values(turn_count=ChatSession.turn_count + 2, updated_at=now)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if updated:
+                turn_count = db.session.execute(select(ChatSession.turn_count).where(ChatSession.id == session_id)).scalar_one()
+            else:
+                db.session.add(ChatSession(id=session_id, turn_count=2, updated_at=now))
+                db.session.flush()
+                turn_count = 2
+            db.session.add_all([
+                ChatTurn(session_id=session_id, seq=turn_count - 1, role='user', content=user_text),
+                ChatTurn(session_id=session_id, seq=turn_count, role='ai', content=ai_reply),
+            ])
+            db.session.commit()
+            if not updated:
+                current_app.logger.info(f"Created chat session {session_id}")
+            return
+        except IntegrityError:
+            db.session.rollback()
+            if attempt == _APPEND_TURNS_ATTEMPTS:
+                raise
+            current_app.logger.warning(f"Turn numbers of chat session {session_id} conflicted; retrying ({attempt}/{_APPEND_TURNS_ATTEMPTS})")
+
+def _chat_response(context, user_text, ai_reply):
+    """チャットの JSON レスポンス用の辞書を作る"""
+    result = {"reply": ai_reply, "user_message_text": user_text} # 文字起こし結果も返す
+    if context["session_id"]:
+        result["session_id"] = context["session_id"]
+    return result
+
+def _sse_event(event, data):
+    """Server-Sent Events の 1 イベント分の文字列を作る"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def _ingest_upload(stream, mime_type):
+    """アップロードされた音声を取り込む (上限を超えた場合は 413)"""
+    try:
+        return ingest_audio(stream, mime_type)
+    except AudioRejectedError as e:
+        raise ApiError(e.message, e.status)
+
+def _use_listen_and_reply(audio):
+    """文字起こしと応答を 1 回の呼び出しで得るか (分割が必要な長い録音は文字起こしを先に行う)"""
+    return CHAT_AUDIO_MODE == "combined" and not audio.segments
+
+def _stream_chat_events(context, user_text, audio):
+    """文字起こし結果 → 応答トークン → 完了 の順に SSE イベントを生成する"""
+    session_info = {"session_id": context["session_id"]} if context["session_id"] else {}
+    history, summary = context["history"], context["summary"]
+    try:
+        if audio is not None:
+            if _use_listen_and_reply(audio):
+                # 1 回の呼び出しで文字起こしと応答がそろうため、応答はまとめて送る
+                user_text, ai_reply = listen_and_reply(history, audio.source, mime_type=audio.mime_type, summary=summary)
+                current_app.logger.info(f"Transcribed audio: {user_text}")
+                yield _sse_event("user_message", {"user_message_text": user_text, **session_info})
+                yield _sse_event("token", {"text": ai_reply})
+                if context["session_id"]:
+                    _append_turns(context["session_id"], user_text, ai_reply)
+                yield _sse_event("done", {"reply": ai_reply, **session_info})
+                return
+            user_text = transcribe_ingested(audio)
+            current_app.logger.info(f"Transcribed audio: {user_text}")
+        yield _sse_event("user_message", {"user_message_text": user_text, **session_info})
+
+        reply_parts = []
+        for text in chat_with_ai_stream(history, user_text=user_text, summary=summary):
+            reply_parts.append(text)
+            yield _sse_event("token", {"text": text})
+        ai_reply = "".join(reply_parts)
+        if context["session_id"]:
+            _append_turns(context["session_id"], user_text, ai_reply)
+        yield _sse_event("done", {"reply": ai_reply, **session_info})
+    except Exception as e:
+        current_app.logger.error(f"Error processing streaming chat request: {e}", exc_info=True)
+        yield _sse_event("error", {"error": "AIの応答生成中にエラーが発生しました。"})
+    finally:
+        if audio is not None:
+            audio.close()
+
+@bp.post("/api/chat")
 def chat_endpoint():
-    """音声またはテキストと会話履歴を受け取り、AIの応答を返す"""
-    app.logger.info("Received request for /api/chat")
-    
-    if 'conversation' not in request.form:
-        app.logger.error("Conversation history part missing in chat request")
-        return jsonify(error="会話履歴が見つかりません。"), 400
-
-    conversation_json = request.form["conversation"]
+    """
+    音声またはテキストを受け取り、AIの応答を返す (?stream=1 で SSE 配信)。
+    session_id を送ると (省略時は新規作成) サーバー側の会話履歴を使い、
+    conversation を送ると従来どおりクライアントの会話履歴を使う。
+    """
+    current_app.logger.info("Received request for /api/chat")
+
     user_text_input = request.form.get("text") # 元のテキスト入力
     audio_blob = request.files.get("audio")
 
@@ -78,89 +447,445 @@ def chat_endpoint():
     if not audio_blob and not user_text_input:
         return jsonify(error="音声またはテキストデータが必要です。"), 400
 
-    try:
-        conversation_history = json.loads(conversation_json)
-        if not isinstance(conversation_history, list):
-            raise ValueError("Conversation history is not a list.")
-    except (json.JSONDecodeError, ValueError) as e:
-        app.logger.error(f"Failed to parse conversation history: {e}")
-        return jsonify(error="会話履歴の形式が正しくありません。"), 400
+    context = _load_chat_context(request.form)
+    # アップロードはメモリ上に置いたまま取り込み、サイズ・長さの上限をモデル呼び出しの前に確認する
+    audio = _ingest_upload(audio_blob.stream, audio_blob.mimetype) if audio_blob else None
+    _compact_chat_context(context)
+    conversation_history, summary = context["history"], context["summary"]
+
+    if request.args.get("stream") == "1":
+        # 取り込んだ音声はストリームの終了時に閉じる
+        return Response(
+            stream_with_context(_stream_chat_events(context, user_text_input, audio)),
+            mimetype="text/event-stream",
+            headers=SSE_HEADERS
+        )
 
     try:
-        if audio_blob:
-            with tempfile.NamedTemporaryFile(delete=True, suffix=".webm") as tmp:
-                audio_blob.save(tmp.name)
-                transcribed_text = transcribe_audio(tmp.name) # 音声ファイルを文字起こし
+        if audio is not None and _use_listen_and_reply(audio):
+            # 文字起こしと応答を 1 回の呼び出しで取得する
+            actual_user_text, ai_reply = listen_and_reply(conversation_history, audio.source, mime_type=audio.mime_type, summary=summary)
+            current_app.logger.info(f"Transcribed audio: {actual_user_text}")
+        else:
+            if audio is not None:
+                transcribed_text = transcribe_ingested(audio) # 長い録音は区間ごとに並列で文字起こし
                 actual_user_text = transcribed_text # 文字起こし結果をAIに渡すテキストとする
-                app.logger.info(f"Transcribed audio: {transcribed_text}")
-        
-        ai_reply = chat_with_ai(conversation_history, user_text=actual_user_text)
-        
-        return jsonify(reply=ai_reply, user_message_text=actual_user_text) # 文字起こし結果も返す
+                current_app.logger.info(f"Transcribed audio: {transcribed_text}")
+
+            # 失敗した場合は定型の謝罪文を会話履歴に保存せず、エラーとして返す
+            ai_reply = chat_with_ai(conversation_history, user_text=actual_user_text, summary=summary, raise_errors=True)
+
+        if context["session_id"]:
+            _append_turns(context["session_id"], actual_user_text, ai_reply)
+        return jsonify(_chat_response(context, actual_user_text, ai_reply))
 
     except Exception as e:
-        app.logger.error(f"Error processing chat request: {e}", exc_info=True)
+        current_app.logger.error(f"Error processing chat request: {e}", exc_info=True)
         return jsonify(error="AIの応答生成中にエラーが発生しました。"), 500
+    finally:
+        if audio is not None:
+            audio.close()
 
-@app.post("/api/generate_diary")
-def generate_diary_endpoint():
-    """会話履歴から日記を生成し、DBに保存。任意でNotionにも保存。"""
-    app.logger.info("Received request for /api/generate_diary")
-    data = request.get_json()
-    if not data or "conversation" not in data:
-        app.logger.error("Conversation history missing")
-        return jsonify(error="会話履歴が必要です。"), 400
+# --- Diary generation --- #
+# 同じ会話から作った日記を再利用する期間 (この期間を過ぎた同じ会話は新しい日記として生成する)
+DIARY_DEDUP_TTL_SECONDS = int(os.getenv("DIARY_DEDUP_TTL_SECONDS", 24 * 60 * 60))
+diary_dedup = RequestDeduplicator(
+    max_entries=int(os.getenv("DIARY_DEDUP_CACHE_SIZE", 256)),
+    ttl_seconds=DIARY_DEDUP_TTL_SECONDS
+)
+
+def _load_diary_conversation(data):
+    """
+    日記生成リクエストの JSON から会話履歴を読み込む。
+    戻り値: (会話履歴, 生成元の会話セッションID or None)
+    """
+    if not data or ("conversation" not in data and "session_id" not in data):
+        current_app.logger.error("Conversation history missing")
+        raise ApiError("会話履歴が必要です。")
+
+    if "session_id" in data:
+        chat_session = db.session.get(ChatSession, data["session_id"])
+        if chat_session is None:
+            raise ApiError("会話セッションが見つかりません。", 404)
+        # 日記は要約ではなく保存済みの全発言から作成する
+        turns = ChatTurn.query.filter_by(session_id=chat_session.id).order_by(ChatTurn.seq).all()
+        return _diary_turns([turn.to_dict() for turn in turns]), chat_session.id
 
     conversation_history = data["conversation"]
     if not isinstance(conversation_history, list):
-        app.logger.error("Invalid conversation history format")
-        return jsonify(error="会話履歴の形式がリストではありません。"), 400
+        current_app.logger.error("Invalid conversation history format")
+        raise ApiError("会話履歴の形式がリストではありません。")
+    return _diary_turns(conversation_history), None
 
-    try:
-        diary_content, score, highlights = generate_diary_from_conversation(conversation_history)
+def _diary_turns(conversation_history):
+    """日記生成に使う発言 (role が user / ai で内容がある発言) だけを残す。1 つもなければ 400"""
+    turns = [
+        msg for msg in conversation_history
+        if isinstance(msg, dict) and msg.get("role") in ("user", "ai")
+        and isinstance(msg.get("content"), str) and msg["content"].strip()
+    ]
+    if not turns:
+        current_app.logger.error("No user/ai turns in conversation history")
+        raise ApiError("日記にできる会話がありません。")
+    return turns
 
-        with app.app_context():
-            new_diary_entry = Diary(
-                diary_content=diary_content,
-                sentiment_score=score,
-                highlight_events=highlights
-            )
-            db.session.add(new_diary_entry)
+def _diary_request_key(idempotency_key, conversation_history):
+    """同じ会話 (または同じ Idempotency-Key) を同一リクエストとみなすためのキー"""
+    return f"key:{idempotency_key}" if idempotency_key else f"conv:{conversation_key(conversation_history)}"
+
+def _load_diary_request(request_key):
+    """永続化済みの日記生成結果があれば返す"""
+    cutoff = datetime.utcnow() - timedelta(seconds=DIARY_DEDUP_TTL_SECONDS)
+    row = DiaryRequest.query.filter(DiaryRequest.key == request_key, DiaryRequest.created_at >= cutoff).first()
+    return json.loads(row.response_json) if row else None
+
+def _save_diary(generated, chat_session_id, request_key):
+    """生成した日記 (日記コンテンツ, 感情スコア, ハイライト) を保存し、レスポンス用の辞書を返す"""
+    diary_content, score, highlights = generated
+    new_diary_entry = Diary(
+        date=datetime.utcnow(),
+        diary_content=diary_content,
+        sentiment_score=score,
+        highlight_events=highlights,
+        chat_session_id=chat_session_id
+    )
+    db.session.add(new_diary_entry)
+    _record_sentiment(new_diary_entry.date, score)
+    notion_status = 'disabled'
+    if is_notion_configured():
+        # Notion への保存はアウトボックス経由でバックグラウンドワーカーが行う
+        db.session.add(NotionOutbox(diary=new_diary_entry))
+        notion_status = 'pending'
+    db.session.flush()
+
+    result = {
+        "diary_id": new_diary_entry.id,
+        "summary": diary_content,
+        "notion_url": "",
+        "notion_sync": {"status": notion_status},
+        "sentiment_score": score,
+        "highlight_events": highlights
+    }
+    # 有効期限切れの結果を削除する (同一キーのものも含む。有効なものが残っていれば主キーの重複で下の分岐に入る)
+    cutoff = datetime.utcnow() - timedelta(seconds=DIARY_DEDUP_TTL_SECONDS)
+    DiaryRequest.query.filter(DiaryRequest.created_at < cutoff).delete(synchronize_session=False)
+    db.session.add(DiaryRequest(key=request_key, diary_id=new_diary_entry.id,
+                                response_json=json.dumps(result, ensure_ascii=False)))
+    try:
+        with span("db_commit"):
             db.session.commit()
-            app.logger.info(f"Saved diary to DB with ID: {new_diary_entry.id}")
+    except IntegrityError:
+        # 別プロセスが同じキーで先に保存した場合はそちらの結果を使う
+        db.session.rollback()
+        existing = _load_diary_request(request_key)
+        if existing is None:
+            raise
+        return existing
+    current_app.logger.info(f"Saved diary to DB with ID: {new_diary_entry.id}")
+    if notion_status == 'pending':
+        current_app.extensions["notion_worker"].notify()
+    return result
 
-        notion_url = ""
-        try:
-            notion_url = save_to_notion(diary_content)
-            app.logger.info("Successfully saved diary to Notion.")
-        except Exception as e_notion:
-            app.logger.warning(f"Failed to save diary to Notion: {e_notion}")
-
-        return jsonify({
-            "summary": diary_content,
-            "notion_url": notion_url,
-            "sentiment_score": score,
-            "highlight_events": highlights
-        })
+def _generate_and_save_diary(conversation_history, chat_session_id, request_key):
+    """日記を生成して保存し、レスポンス用の辞書を返す"""
+    timings = {}
+    with span("diary_generate"):
+        # 失敗した生成は保存も再利用もせず、500 を返してクライアントに再試行させる
+        generated = generate_diary_from_conversation(conversation_history, timings=timings, raise_errors=True)
+    current_app.logger.info(f"Generated diary in {timings.get('total', 0):.2f}s (stages: {timings})")
+    return _save_diary(generated, chat_session_id, request_key)
+
+@bp.post("/api/generate_diary")
+def generate_diary_endpoint():
+    """会話履歴 (conversation または session_id) から日記を生成し、DBに保存。任意でNotionにも保存。"""
+    current_app.logger.info("Received request for /api/generate_diary")
+    conversation_history, chat_session_id = _load_diary_conversation(request.get_json(silent=True))
+
+    # 同じ会話 (または同じ Idempotency-Key) の日記生成は 1 回だけ行う
+    request_key = _diary_request_key(request.headers.get("Idempotency-Key"), conversation_history)
+    try:
+        result, replayed = diary_dedup.run(
+            request_key,
+            lambda: _generate_and_save_diary(conversation_history, chat_session_id, request_key),
+            load_persisted=_load_diary_request
+        )
+        if replayed:
+            current_app.logger.info(f"Returning existing diary {result['diary_id']} for duplicate request")
+        response = jsonify(result)
+        response.headers["Idempotent-Replayed"] = "true" if replayed else "false"
+        return response
 
     except Exception as e:
-        app.logger.error(f"Error processing generate_diary request: {e}", exc_info=True)
+        current_app.logger.error(f"Error processing generate_diary request: {e}", exc_info=True)
         return jsonify(error="日記の生成中にエラーが発生しました。"), 500
 
-@app.get("/api/diaries")
+# --- Diary list pagination --- #
+DIARIES_DEFAULT_LIMIT = int(os.getenv("DIARIES_DEFAULT_LIMIT", 50))
+DIARIES_MAX_LIMIT = int(os.getenv("DIARIES_MAX_LIMIT", 200))
+
+def _encode_cursor(diary):
+    """最後に返した行の (date, id) を不透明なカーソル文字列にする"""
+    raw = json.dumps([diary.date.isoformat(), diary.id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def _decode_cursor(cursor):
+    """カーソル文字列を (date, id) に戻す。不正な場合は ValueError"""
+    try:
+        date_str, diary_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(date_str), int(diary_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def _stream_diary_page(rows, fields, limit):
+    """1ページ分の日記を JSON として逐次出力する (ページ全体をメモリに構築しない)"""
+    yield '{"diaries":['
+    last_row = None
+    has_more = False
+    # ビューの戻り後に実行されるため、ジェネレータ側のコンテキストのセッションで実行する
+    # (ビューのセッションは既に破棄されており、そのまま使うと接続がプールに戻らない)
+    rows = iter(rows.with_session(db.session))
+    try:
+        for i, row in enumerate(rows):
+            if i == limit:
+                has_more = True
+                break
+            yield ("," if i else "") + json.dumps(row.to_dict(fields), ensure_ascii=False)
+            last_row = row
+    finally:
+        # 途中で打ち切った yield_per の結果を閉じないと接続がプールに戻らない
+        rows.close()
+    next_cursor = _encode_cursor(last_row) if has_more and last_row is not None else None
+    yield '],"next_cursor":' + json.dumps(next_cursor) + '}'
+
+@bp.get("/api/diaries")
 def get_diaries_endpoint():
-    """保存されているすべての日記エントリを取得する"""
-    app.logger.info("Received request for /api/diaries")
+    """日記エントリを新しい順にページ単位で取得する
+
+    クエリパラメータ:
+      limit:  1ページの件数 (既定 DIARIES_DEFAULT_LIMIT, 上限 DIARIES_MAX_LIMIT)
+      cursor: 前のレスポンスの next_cursor
+      fields: 返すフィールドのカンマ区切り (例: id,date,sentiment_score)
+    """
+    current_app.logger.info("Received request for /api/diaries")
+    try:
+        limit = int(request.args.get("limit", DIARIES_DEFAULT_LIMIT))
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        limit = min(limit, DIARIES_MAX_LIMIT)
+    except ValueError:
+        return jsonify(error="limit の値が正しくありません。"), 400
+
+    fields = None
+    if request.args.get("fields"):
+        # "," のように有効な名前がない場合は ?fields= と同じく指定なしとして扱う
+        fields = [f.strip() for f in request.args["fields"].split(",") if f.strip()] or None
+        unknown = [f for f in fields or [] if f not in Diary.SERIALIZABLE_FIELDS]
+        if unknown:
+            return jsonify(error=f"不明なフィールドです: {', '.join(unknown)}"), 400
+
     try:
-        with app.app_context():
-            diaries = Diary.query.order_by(Diary.date.desc()).all()
-        return jsonify([diary.to_dict() for diary in diaries])
+        query = Diary.query
+        if fields is not None:
+            # カーソル生成に date / id が必要なため常に読み込む
+            columns = {"id", "date", *fields}
+            query = query.options(load_only(*[getattr(Diary, c) for c in columns]))
+            if "diary_content" in fields:
+                query = query.options(undefer(Diary.diary_content))
+        else:
+            # 本文は読み込みを遅らせる列のため、1 行ずつ読み込まないようまとめて読み込む
+            query = query.options(undefer(Diary.diary_content))
+        if request.args.get("cursor"):
+            cursor_date, cursor_id = _decode_cursor(request.args["cursor"])
+            query = query.filter(or_(
+                Diary.date < cursor_date,
+                and_(Diary.date == cursor_date, Diary.id < cursor_id)
+            ))
+        rows = query.order_by(Diary.date.desc(), Diary.id.desc()).limit(limit + 1).yield_per(100)
+    except ValueError:
+        return jsonify(error="cursor の値が正しくありません。"), 400
     except Exception as e:
-        app.logger.error(f"Error fetching diaries: {e}", exc_info=True)
+        current_app.logger.error(f"Error fetching diaries: {e}", exc_info=True)
         return jsonify(error="日記の取得中にエラーが発生しました。"), 500
 
-if __name__ == "__main__":
+    return Response(stream_with_context(_stream_diary_page(rows, fields, limit)), mimetype="application/json")
+
+# --- Diary search --- #
+SEARCH_DEFAULT_LIMIT = int(os.getenv("SEARCH_DEFAULT_LIMIT", 20))
+SEARCH_MAX_LIMIT = int(os.getenv("SEARCH_MAX_LIMIT", 100))
+
+def _encode_search_cursor(offset):
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode("utf-8")).decode("ascii")
+
+def _decode_search_cursor(cursor):
+    """検索結果のカーソル文字列をオフセットに戻す。不正な場合は ValueError"""
+    try:
+        offset = int(json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))["offset"])
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if offset < 0:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return offset
+
+@bp.get("/api/diaries/search")
+def search_diaries_endpoint():
+    """日記を全文検索する (関連度順)
+
+    クエリパラメータ:
+      q:      検索語 (空白区切りの語をすべて含む日記が一致する)
+      limit:  1ページの件数 (既定 SEARCH_DEFAULT_LIMIT, 上限 SEARCH_MAX_LIMIT)
+      cursor: 前のレスポンスの next_cursor
+    結果の snippet は HTML エスケープ済みで、一致箇所が <mark> で囲まれている。
+    """
+    current_app.logger.info("Received request for /api/diaries/search")
+    q = request.args.get("q", "").strip()
+    if not q:
+        return jsonify(error="検索語 (q) が必要です。"), 400
+    try:
+        limit = int(request.args.get("limit", SEARCH_DEFAULT_LIMIT))
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        limit = min(limit, SEARCH_MAX_LIMIT)
+    except ValueError:
+        return jsonify(error="limit の値が正しくありません。"), 400
+    try:
+        offset = _decode_search_cursor(request.args["cursor"]) if request.args.get("cursor") else 0
+    except ValueError:
+        return jsonify(error="cursor の値が正しくありません。"), 400
+
+    try:
+        with span("diary_search"):
+            results, has_more = search_diaries(q, limit, offset)
+    except Exception as e:
+        current_app.logger.error(f"Error searching diaries: {e}", exc_info=True)
+        return jsonify(error="日記の検索中にエラーが発生しました。"), 500
+    next_cursor = _encode_search_cursor(offset + limit) if has_more else None
+    return jsonify(results=results, next_cursor=next_cursor)
+
+@bp.get("/api/diaries/<int:diary_id>")
+def get_diary_endpoint(diary_id):
+    """日記 1 件を本文を含めて返す (一覧は preview だけを使い、本文はここで取得する)"""
+    diary = db.session.get(Diary, diary_id, options=[undefer(Diary.diary_content)])
+    if diary is None:
+        return jsonify(error="日記が見つかりません。"), 404
+    return jsonify(diary.to_dict())
+
+@bp.get("/api/diaries/<int:diary_id>/notion_sync")
+def get_notion_sync_status_endpoint(diary_id):
+    """日記の Notion 同期状況を返す (クライアントのポーリング用)"""
+    diary = db.session.get(Diary, diary_id)
+    if diary is None:
+        return jsonify(error="日記が見つかりません。"), 404
+    job = NotionOutbox.query.filter_by(diary_id=diary_id).order_by(NotionOutbox.id.desc()).first()
+    sync = job.to_dict() if job else {"status": "disabled"}
+    return jsonify(notion_url=diary.notion_url or "", notion_sync=sync)
+
+@bp.get("/api/gemini_stats")
+def get_gemini_stats_endpoint():
+    """Gemini クライアント層のモデルごとの統計値 (待ち時間・リトライ数など) を返す"""
+    return jsonify(get_client_stats())
+
+@bp.get("/api/sentiment_series")
+def get_sentiment_series_endpoint():
+    """感情スコアの期間別集計を返す
+
+    クエリパラメータ:
+      bucket: day | week | month (既定 day)
+      from / to: 対象期間 (YYYY-MM-DD, 両端を含む)
+    """
+    current_app.logger.info("Received request for /api/sentiment_series")
+    bucket = request.args.get("bucket", "day")
+    if bucket not in SENTIMENT_BUCKETS:
+        return jsonify(error="bucket は day / week / month のいずれかを指定してください。"), 400
+
+    try:
+        date_from = date.fromisoformat(request.args["from"]) if request.args.get("from") else None
+        date_to = date.fromisoformat(request.args["to"]) if request.args.get("to") else None
+    except ValueError:
+        return jsonify(error="from / to の日付形式が正しくありません。"), 400
+
+    try:
+        query = SentimentRollup.query.filter_by(bucket=bucket)
+        if date_from:
+            query = query.filter(SentimentRollup.bucket_start >= _bucket_start(date_from, bucket))
+        if date_to:
+            query = query.filter(SentimentRollup.bucket_start <= date_to)
+        rollups = query.order_by(SentimentRollup.bucket_start).all()
+        return jsonify(bucket=bucket, series=[rollup.to_dict() for rollup in rollups])
+    except Exception as e:
+        current_app.logger.error(f"Error fetching sentiment series: {e}", exc_info=True)
+        return jsonify(error="感情スコアの集計取得中にエラーが発生しました。"), 500
+
+# --- App factory --- #
+def prewarm(app):
+    """
+    最初のリクエストで払うことになる読み込み・接続を先に済ませる
+    (Gemini SDK の読み込みと設定・Notion のセッション・ffmpeg の確認・DB 接続)。
+    """
+    started_at = time.perf_counter()
+    gemini.prewarm()
+    notion.prewarm()
+    audio_ingest.prewarm()
+    with app.app_context():
+        db.session.execute(text("SELECT 1"))
+    elapsed = time.perf_counter() - started_at
+    metrics.startup_seconds.set(elapsed, phase="prewarm")
+    app.logger.info(f"Prewarmed in {elapsed:.3f}s")
+
+def create_app(config=None):
+    """
+    Flask アプリを作成する。DB への接続や Gemini SDK の読み込みは最初に使うとき (または prewarm) まで行わない。
+    テーブルの作成 (init_db) と Notion 同期ワーカーの開始は行わないため、サーバーとして動かす場合は create_server_app を使う。
+    config: app.config に上書きする設定 (別の DB を使う場合など)
+    """
+    started_at = time.perf_counter()
+    app = Flask(__name__, static_folder=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'frontend'), static_url_path='')
+    app.request_class = _SpoolingRequest
+    # 上限を超えるリクエストは本文を読む前に 413 で拒否する (音声以外のフォーム項目のぶん余裕を持たせる)
+    app.config['MAX_CONTENT_LENGTH'] = AUDIO_MAX_BYTES + 1024 * 1024
+    # DATABASE_URL で別の DB (ベンチマーク用のシードデータなど) を使える
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("DATABASE_URL", f'sqlite:///{db_path}')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if config:
+        app.config.update(config)
+
+    db.init_app(app)
+    CORS(app, resources={r"/api/*": {"origins": CORS_ORIGIN}})
+    app.register_blueprint(bp)
+    # start_background_workers で開始する
+    app.extensions["notion_worker"] = NotionSyncWorker(app, db, Diary, NotionOutbox)
+
+    metrics.startup_seconds.set(_IMPORT_SECONDS, phase="import")
+    metrics.startup_seconds.set(time.perf_counter() - started_at, phase="create_app")
+    app.logger.info(f"Created app in {time.perf_counter() - started_at:.3f}s (module imports {_IMPORT_SECONDS:.3f}s)")
+    if APP_PREWARM:
+        prewarm(app)
+    return app
+
+def start_background_workers(app):
+    """Notion 同期ワーカーを開始する (サーバーとして動かすプロセスでのみ呼ぶ)"""
+    app.extensions["notion_worker"].start()
+
+def stop_background_workers(app, timeout=None):
+    """Notion 同期ワーカーを止めて終了を待つ (開始していなければ何もしない)"""
+    app.extensions["notion_worker"].stop(timeout)
+
+def create_server_app(config=None):
+    """
+    サーバーとして動かす Flask アプリを作成し、テーブルを作成 (init_db) して Notion 同期ワーカーを開始する。
+
+        flask --app 'app:create_server_app' run --port 5500
+        gunicorn -w 1 --threads 8 -b 0.0.0.0:5500 'app:create_server_app()'
+
+    同期ワーカーはプロセスごとに開始されるため、gunicorn のワーカープロセスは 1 つにする。
+    (引数なしの flask run は create_app を使うため、DB の初期化とワーカーの開始が行われない)
+    """
+    app = create_app(config)
     with app.app_context():
-        db.create_all()
+        init_db()
+    start_background_workers(app)
+    return app
+
+if __name__ == "__main__":
+    app = create_server_app()
     port = int(os.getenv("PORT", 5500))
-    app.run(host="0.0.0.0", port=port, debug=False)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=port, debug=False)
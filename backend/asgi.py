@@ -0,0 +1,252 @@
+# backend/asgi.py
+"""
+ASGI で動かすためのエントリポイント。
+
+    uvicorn asgi:app --port 5500
+
+/api/chat と /api/generate_diary は asyncio 上で Gemini を待つため、
+応答待ちの間にワーカースレッドを占有せず、多数の同時リクエストをさばける。
+DB アクセスは上限付きのスレッドプールで行い、それ以外のルートは Flask アプリにそのまま渡す。
+"""
+import asyncio
+import contextlib
+import contextvars
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.datastructures import MutableHeaders
+from starlette.formparsers import MultiPartParser
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+from app import (
+    create_app, init_db, start_background_workers, stop_background_workers, CORS_ORIGIN, diary_dedup, ApiError, SSE_HEADERS, AUDIO_MAX_BYTES,
+    _load_chat_context, _ingest_upload, _use_listen_and_reply, _save_compaction, _apply_compaction, _append_turns, _chat_response, _sse_event,
+    _load_diary_conversation, _diary_request_key, _load_diary_request, _save_diary
+)
+from gemini import (
+    chat_with_ai_async, chat_with_ai_stream_async, listen_and_reply_async,
+    summarize_conversation_async, generate_diary_from_conversation_async
+)
+import metrics
+from audio_ingest import transcribe_ingested_async, AUDIO_SPOOL_MAX_BYTES
+
+# DB アクセスに使うスレッド数 (SQLite への同時書き込みを増やしすぎないよう小さめにする)
+ASYNC_DB_WORKERS = int(os.getenv("ASYNC_DB_WORKERS", 4))
+_db_executor = ThreadPoolExecutor(max_workers=ASYNC_DB_WORKERS, thread_name_prefix="db")
+# アップロードファイルを AUDIO_SPOOL_MAX_BYTES までメモリ上に置く (既定の 1MB ではすぐディスクに書かれるため)
+MultiPartParser.spool_max_size = AUDIO_SPOOL_MAX_BYTES
+
+flask_app = create_app()
+logger = flask_app.logger
+
+
+async def run_db(fn, *args):
+    """Flask のアプリケーションコンテキスト内で fn を DB 用スレッドプールで実行する"""
+    def call():
+        with flask_app.app_context():
+            return fn(*args)
+    # span の記録先 (リクエストごとのコンテキスト) をスレッドに引き継ぐ
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(_db_executor, context.run, call)
+
+
+async def _compact_chat_context_async(context):
+    """app._compact_chat_context の非同期版"""
+    if not context["fold_count"]:
+        return
+    try:
+        summary = await summarize_conversation_async(context["summary"], context["history"][:context["fold_count"]])
+    except Exception as e:
+        logger.warning(f"Failed to compact chat session {context['session_id']}: {e}")
+        return
+    if await run_db(_save_compaction, context["session_id"], summary, context["fold_upto"]):
+        _apply_compaction(context, summary)
+
+
+async def _stream_chat_events_async(context, user_text, audio):
+    """app._stream_chat_events の非同期版"""
+    session_info = {"session_id": context["session_id"]} if context["session_id"] else {}
+    history, summary = context["history"], context["summary"]
+    try:
+        if audio is not None:
+            if _use_listen_and_reply(audio):
+                user_text, ai_reply = await listen_and_reply_async(history, audio.source, mime_type=audio.mime_type, summary=summary)
+                logger.info(f"Transcribed audio: {user_text}")
+                yield _sse_event("user_message", {"user_message_text": user_text, **session_info})
+                yield _sse_event("token", {"text": ai_reply})
+                if context["session_id"]:
+                    await run_db(_append_turns, context["session_id"], user_text, ai_reply)
+                yield _sse_event("done", {"reply": ai_reply, **session_info})
+                return
+            user_text = await transcribe_ingested_async(audio)
+            logger.info(f"Transcribed audio: {user_text}")
+        yield _sse_event("user_message", {"user_message_text": user_text, **session_info})
+
+        reply_parts = []
+        async for text in chat_with_ai_stream_async(history, user_text=user_text, summary=summary):
+            reply_parts.append(text)
+            yield _sse_event("token", {"text": text})
+        ai_reply = "".join(reply_parts)
+        if context["session_id"]:
+            await run_db(_append_turns, context["session_id"], user_text, ai_reply)
+        yield _sse_event("done", {"reply": ai_reply, **session_info})
+    except Exception as e:
+        logger.error(f"Error processing streaming chat request: {e}", exc_info=True)
+        yield _sse_event("error", {"error": "AIの応答生成中にエラーが発生しました。"})
+    finally:
+        if audio is not None:
+            await asyncio.to_thread(audio.close)
+
+
+async def chat_endpoint(request: Request):
+    """/api/chat の非同期版 (リクエストとレスポンスの形式は Flask 版と同じ)"""
+    logger.info("Received request for /api/chat (async)")
+    # 上限を超えるリクエストは本文を読む前に拒否する
+    if int(request.headers.get("content-length") or 0) > AUDIO_MAX_BYTES + 1024 * 1024:
+        return JSONResponse({"error": f"アップロードが大きすぎます (上限 {AUDIO_MAX_BYTES // (1024 * 1024)}MB)。"}, status_code=413)
+    form = await request.form()
+    user_text_input = form.get("text")
+    audio_upload = form.get("audio")
+    if isinstance(audio_upload, str):
+        audio_upload = None
+
+    if audio_upload is None and not user_text_input:
+        return JSONResponse({"error": "音声またはテキストデータが必要です。"}, status_code=400)
+
+    audio = None
+    try:
+        context = await run_db(_load_chat_context, form)
+        if audio_upload is not None:
+            # 取り込み (サイズ・長さの確認と長い録音の分割) はデコードを伴うためスレッドで行う
+            audio = await asyncio.to_thread(_ingest_upload, audio_upload.file, audio_upload.content_type)
+    except ApiError as e:
+        return JSONResponse({"error": e.message}, status_code=e.status)
+    await _compact_chat_context_async(context)
+
+    if request.query_params.get("stream") == "1":
+        # 取り込んだ音声はストリームの終了時に閉じる
+        return StreamingResponse(
+            _stream_chat_events_async(context, user_text_input, audio),
+            media_type="text/event-stream",
+            headers=SSE_HEADERS
+        )
+
+    try:
+        actual_user_text = user_text_input
+        if audio is not None and _use_listen_and_reply(audio):
+            actual_user_text, ai_reply = await listen_and_reply_async(
+                context["history"], audio.source, mime_type=audio.mime_type, summary=context["summary"])
+            logger.info(f"Transcribed audio: {actual_user_text}")
+        else:
+            if audio is not None:
+                actual_user_text = await transcribe_ingested_async(audio)
+                logger.info(f"Transcribed audio: {actual_user_text}")
+            ai_reply = await chat_with_ai_async(context["history"], user_text=actual_user_text, summary=context["summary"],
+                                                raise_errors=True)
+
+        if context["session_id"]:
+            await run_db(_append_turns, context["session_id"], actual_user_text, ai_reply)
+        return JSONResponse(_chat_response(context, actual_user_text, ai_reply))
+
+    except Exception as e:
+        logger.error(f"Error processing chat request: {e}", exc_info=True)
+        return JSONResponse({"error": "AIの応答生成中にエラーが発生しました。"}, status_code=500)
+    finally:
+        if audio is not None:
+            await asyncio.to_thread(audio.close)
+
+
+async def generate_diary_endpoint(request: Request):
+    """/api/generate_diary の非同期版 (リクエストとレスポンスの形式は Flask 版と同じ)"""
+    logger.info("Received request for /api/generate_diary (async)")
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    try:
+        conversation_history, chat_session_id = await run_db(_load_diary_conversation, data)
+    except ApiError as e:
+        return JSONResponse({"error": e.message}, status_code=e.status)
+
+    request_key = _diary_request_key(request.headers.get("Idempotency-Key"), conversation_history)
+
+    async def generate_and_save():
+        timings = {}
+        with metrics.span("diary_generate"):
+            generated = await generate_diary_from_conversation_async(conversation_history, timings=timings,
+                                                                     raise_errors=True)
+        logger.info(f"Generated diary in {timings.get('total', 0):.2f}s (stages: {timings})")
+        return await run_db(_save_diary, generated, chat_session_id, request_key)
+
+    async def load_persisted(key):
+        return await run_db(_load_diary_request, key)
+
+    try:
+        result, replayed = await diary_dedup.run_async(request_key, generate_and_save, load_persisted=load_persisted)
+        if replayed:
+            logger.info(f"Returning existing diary {result['diary_id']} for duplicate request")
+        return JSONResponse(result, headers={"Idempotent-Replayed": "true" if replayed else "false"})
+
+    except Exception as e:
+        logger.error(f"Error processing generate_diary request: {e}", exc_info=True)
+        return JSONResponse({"error": "日記の生成中にエラーが発生しました。"}, status_code=500)
+
+
+class RequestMetricsMiddleware:
+    """非同期ルートのリクエスト数・所要時間を記録し、有効なら Server-Timing ヘッダーを付ける (Flask 版の before/after_request と同じ)"""
+
+    def __init__(self, app, endpoint):
+        self.app = app
+        self.endpoint = endpoint
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started_at = time.perf_counter()
+        timings = metrics.start_request()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                elapsed = time.perf_counter() - started_at
+                metrics.observe_request(scope["method"], self.endpoint, status, elapsed)
+                if metrics.SERVER_TIMING_ENABLED:
+                    MutableHeaders(scope=message).append("Server-Timing", metrics.server_timing_header(timings, total=elapsed))
+            await send(message)
+
+        await self.app(scope, receive, send_with_timing)
+
+
+def _route_middleware(endpoint):
+    return [
+        Middleware(RequestMetricsMiddleware, endpoint=endpoint),
+        Middleware(CORSMiddleware, allow_origins=[CORS_ORIGIN], allow_methods=["POST"], allow_headers=["*"]),
+    ]
+
+
+@contextlib.asynccontextmanager
+async def lifespan(_app):
+    await run_db(init_db)
+    start_background_workers(flask_app)
+    yield
+    await asyncio.to_thread(stop_background_workers, flask_app)
+
+
+app = Starlette(
+    routes=[
+        Route("/api/chat", chat_endpoint, methods=["POST"], middleware=_route_middleware("/api/chat")),
+        Route("/api/generate_diary", generate_diary_endpoint, methods=["POST"], middleware=_route_middleware("/api/generate_diary")),
+        # それ以外 (日記一覧・フロントエンドの配信など) は Flask アプリで処理する
+        Mount("/", app=WSGIMiddleware(flask_app)),
+    ],
+    lifespan=lifespan
+)
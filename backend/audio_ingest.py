@@ -0,0 +1,321 @@
+# backend/audio_ingest.py
+"""
+アップロードされた音声の取り込みと、長い録音の分割文字起こし。
+- AUDIO_SPOOL_MAX_BYTES 以下の音声はメモリ上に置き、超えたときだけ一時ファイルに書き出す
+- サイズ (AUDIO_MAX_BYTES) と長さ (AUDIO_MAX_SECONDS) の上限は文字起こしの前に確認する (長さはデコードの前にコンテナから読む)
+- AUDIO_SEGMENT_SECONDS より十分長い録音は無音の位置で区間に分割し、並列に文字起こしして元の順序でつなぐ
+長さの確認と分割には ffprobe / ffmpeg を使う。音声は ffmpeg の中で流しながら処理し、録音全体を PCM としてメモリに展開しない。
+入っていない場合は分割せず 1 回の呼び出しで文字起こしする。
+"""
+import io
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from typing import BinaryIO, List, Optional, Tuple, Union
+
+from gemini import (transcribe_audio, transcribe_audio_async,
+                    transcribe_audio_segments, transcribe_audio_segments_async)
+
+logger = logging.getLogger(__name__)
+
+# この大きさまではメモリ上に置く (Gemini にインラインで送れる大きさに合わせる)
+AUDIO_SPOOL_MAX_BYTES = int(os.getenv("AUDIO_SPOOL_MAX_BYTES", 15 * 1024 * 1024))
+# 受け付ける音声の上限
+AUDIO_MAX_BYTES = int(os.getenv("AUDIO_MAX_BYTES", 100 * 1024 * 1024))
+AUDIO_MAX_SECONDS = float(os.getenv("AUDIO_MAX_SECONDS", 60 * 60))
+# 分割するときの 1 区間の目安の長さ (この 1.5 倍より長い録音だけ分割する)
+AUDIO_SEGMENT_SECONDS = float(os.getenv("AUDIO_SEGMENT_SECONDS", 60))
+# この音量 (dBFS) より小さい音を無音とみなす
+AUDIO_SILENCE_DB = float(os.getenv("AUDIO_SILENCE_DB", -35))
+
+_READ_CHUNK_BYTES = 64 * 1024
+_MIN_SILENCE_SECONDS = 0.5 # 区切りとみなす無音の長さ
+_PROBE_TIMEOUT_SECONDS = 30
+_FFMPEG_TIMEOUT_SECONDS = 300
+_SEGMENT_MIME_TYPE = "audio/wav"
+
+# ffmpeg / ffprobe のパスは最初に使うとき (または prewarm) に探す
+_tools: Optional[Tuple[Optional[str], Optional[str]]] = None
+
+# MIME タイプ → 一時ファイルの拡張子 (ffmpeg が形式を判別しやすいように付ける)
+_SUFFIXES = {
+    "audio/webm": "webm",
+    "audio/ogg": "ogg",
+    "audio/wav": "wav",
+    "audio/x-wav": "wav",
+    "audio/mpeg": "mp3",
+    "audio/mp4": "mp4",
+    "audio/x-m4a": "mp4",
+    "audio/m4a": "mp4",
+}
+
+_SILENCE_START = re.compile(r"silence_start: (-?[\d.]+)")
+_SILENCE_END = re.compile(r"silence_end: (-?[\d.]+)")
+_OUT_TIME_US = re.compile(r"^out_time_us=(\d+)$", re.MULTILINE)
+
+
+class AudioRejectedError(ValueError):
+    """上限を超えたなどの理由で受け付けられない音声"""
+
+    def __init__(self, message: str, status: int = 413):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class IngestedAudio:
+    """
+    取り込んだ音声。小さければメモリ上のバイト列、大きければ一時ファイルとして持つ。
+    使い終わったら close() する (with 文でも使える)。
+    """
+
+    def __init__(self, mime_type: str):
+        self.mime_type = mime_type
+        self.size = 0
+        self.duration: Optional[float] = None # 秒 (確認できなかった場合は None)
+        self.segments: Optional[List[str]] = None # 無音で分割した各区間 (WAV の一時ファイル)。分割しない場合は None
+        self._buffer: Optional[io.BytesIO] = io.BytesIO()
+        self._file = None
+        self._probe_path: Optional[str] = None
+        self._segment_dir: Optional[str] = None
+
+    def _write(self, data: bytes) -> None:
+        self.size += len(data)
+        if self.size > AUDIO_MAX_BYTES:
+            raise AudioRejectedError(f"音声ファイルが大きすぎます (上限 {AUDIO_MAX_BYTES // (1024 * 1024)}MB)。")
+        if self._file is None and self.size > AUDIO_SPOOL_MAX_BYTES:
+            # 上限を超えたらそれまでの内容ごと一時ファイルに移す
+            self._file = tempfile.NamedTemporaryFile(delete=False, suffix=_suffix(self.mime_type))
+            self._file.write(self._buffer.getvalue())
+            self._buffer = None
+        if self._file is not None:
+            self._file.write(data)
+        else:
+            self._buffer.write(data)
+
+    @property
+    def source(self) -> Union[bytes, str]:
+        """gemini の文字起こし関数に渡せる形 (メモリ上ならバイト列、そうでなければファイルパス)"""
+        if self._file is not None:
+            self._file.flush()
+            return self._file.name
+        return self._buffer.getvalue()
+
+    @property
+    def in_memory(self) -> bool:
+        return self._file is None
+
+    def open(self) -> BinaryIO:
+        """音声を読み出すファイルオブジェクトを返す"""
+        return open(self._file.name, "rb") if self._file is not None else io.BytesIO(self._buffer.getvalue())
+
+    def path(self) -> str:
+        """
+        ffmpeg に渡すファイルパス。メモリ上にある場合は ffmpeg 用の写しを一時ファイルに書き出す
+        (MP4 などはパイプからでは読めないため。文字起こしにはメモリ上のバイト列をそのまま使う)。
+        """
+        if self._file is not None:
+            self._file.flush()
+            return self._file.name
+        if self._probe_path is None:
+            with tempfile.NamedTemporaryFile(delete=False, suffix=_suffix(self.mime_type)) as f:
+                f.write(self._buffer.getvalue())
+            self._probe_path = f.name
+        return self._probe_path
+
+    def segment_dir(self) -> str:
+        """分割した区間を置く一時ディレクトリ (close() で削除する)"""
+        if self._segment_dir is None:
+            self._segment_dir = tempfile.mkdtemp(prefix="talklog-segments-")
+        return self._segment_dir
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            try:
+                os.remove(self._file.name)
+            except OSError:
+                pass
+            self._file = None
+        if self._probe_path is not None:
+            try:
+                os.remove(self._probe_path)
+            except OSError:
+                pass
+            self._probe_path = None
+        if self._segment_dir is not None:
+            shutil.rmtree(self._segment_dir, ignore_errors=True)
+            self._segment_dir = None
+        self._buffer = None
+        self.segments = None
+
+    def __enter__(self) -> "IngestedAudio":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def _find_tools() -> Tuple[Optional[str], Optional[str]]:
+    """(ffmpeg のパス, ffprobe のパス) を返す (見つからなければ None)"""
+    global _tools
+    if _tools is None:
+        _tools = (shutil.which("ffmpeg"), shutil.which("ffprobe"))
+    return _tools
+
+
+def prewarm() -> None:
+    """ffmpeg / ffprobe を探しておく"""
+    _find_tools()
+
+
+def _suffix(mime_type: str) -> str:
+    return "." + _SUFFIXES.get(mime_type, "webm")
+
+
+def _base_mime_type(mime_type: Optional[str]) -> str:
+    """"audio/webm;codecs=opus" などからパラメータを除く"""
+    return (mime_type or "audio/webm").split(";")[0].strip().lower() or "audio/webm"
+
+
+def silence_cut_points(duration: float, silences: List[Tuple[float, float]], segment_seconds: float) -> List[float]:
+    """
+    duration 秒の録音を segment_seconds 程度の区間に分ける区切りの位置 (秒) を返す。
+    区切りは目安の位置の前後 (0.5〜1.5 倍) にある無音の中央を選び、見つからなければ目安の位置でそのまま区切る。
+    """
+    midpoints = [(start + end) / 2 for start, end in silences]
+    cuts, start = [], 0.0
+    while duration - start > segment_seconds * 1.5:
+        target = start + segment_seconds
+        candidates = [p for p in midpoints if start + segment_seconds * 0.5 <= p <= start + segment_seconds * 1.5]
+        cut = min(candidates, key=lambda p: abs(p - target)) if candidates else target
+        cuts.append(cut)
+        start = cut
+    return cuts
+
+
+def _container_duration(ffprobe: str, path: str) -> Optional[float]:
+    """コンテナのヘッダーに記録された長さ (秒) を読む (デコードはしない)。記録がない場合は None"""
+    result = subprocess.run(
+        [ffprobe, "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", path],
+        capture_output=True, text=True, timeout=_PROBE_TIMEOUT_SECONDS, check=True
+    )
+    value = result.stdout.strip()
+    return float(value) if value and value != "N/A" else None
+
+
+def _scan_silences(ffmpeg: str, path: str, limit_seconds: float) -> Tuple[float, List[Tuple[float, float]]]:
+    """
+    ffmpeg で音声を流しながらデコードし、(長さ, [(無音の開始, 終了)]) を返す。
+    デコードは limit_seconds で打ち切り、PCM はメモリに溜めない。
+    """
+    result = subprocess.run(
+        [ffmpeg, "-hide_banner", "-nostats", "-t", f"{limit_seconds:.3f}", "-i", path, "-vn",
+         "-af", f"silencedetect=noise={AUDIO_SILENCE_DB}dB:d={_MIN_SILENCE_SECONDS}",
+         "-f", "null", "-progress", "pipe:1", "-"],
+        capture_output=True, text=True, timeout=_FFMPEG_TIMEOUT_SECONDS, check=True
+    )
+    out_times = _OUT_TIME_US.findall(result.stdout)
+    if not out_times:
+        raise RuntimeError("ffmpeg did not report the audio duration")
+    duration = int(out_times[-1]) / 1_000_000
+    starts = [float(v) for v in _SILENCE_START.findall(result.stderr)]
+    ends = [float(v) for v in _SILENCE_END.findall(result.stderr)]
+    # 末尾まで続く無音には終了が出力されない
+    ends += [duration] * (len(starts) - len(ends))
+    return duration, list(zip(starts, ends))
+
+
+def _extract_segments(ffmpeg: str, path: str, cuts: List[float], out_dir: str) -> List[str]:
+    """
+    cuts の位置で区切った区間を WAV の一時ファイルに書き出し、順番どおりのパスを返す。
+    文字起こしにはモノラル 16kHz で十分なため、区間ごとの WAV を小さくしてインラインで送れるようにする。
+    """
+    pattern = os.path.join(out_dir, "segment%04d.wav")
+    subprocess.run(
+        [ffmpeg, "-hide_banner", "-v", "error", "-i", path, "-vn", "-ac", "1", "-ar", "16000", "-c:a", "pcm_s16le",
+         "-f", "segment", "-segment_times", ",".join(f"{cut:.3f}" for cut in cuts), pattern],
+        capture_output=True, timeout=_FFMPEG_TIMEOUT_SECONDS, check=True
+    )
+    return sorted(os.path.join(out_dir, name) for name in os.listdir(out_dir))
+
+
+def _reject_if_too_long(duration: float) -> None:
+    if duration > AUDIO_MAX_SECONDS:
+        raise AudioRejectedError(f"録音が長すぎます (上限 {int(AUDIO_MAX_SECONDS // 60)} 分)。")
+
+
+def _probe(audio: IngestedAudio) -> None:
+    """
+    音声の長さを確認し、長ければ区間に分割する。
+    長さはまずコンテナのヘッダーから読み、上限を超えていればデコードせずに断る。デコードするのは分割が必要な場合と、
+    ヘッダーに長さの記録がない場合 (MediaRecorder の WebM など。上限の少し先までしか読まない) だけ。
+    """
+    ffmpeg, ffprobe = _find_tools()
+    if ffmpeg is None:
+        return
+    path = audio.path()
+
+    if ffprobe is not None:
+        try:
+            audio.duration = _container_duration(ffprobe, path)
+        except Exception as e:
+            logger.warning(f"Could not probe audio duration ({audio.mime_type}, {audio.size} bytes): {e}")
+        if audio.duration is not None:
+            _reject_if_too_long(audio.duration)
+            if audio.duration <= AUDIO_SEGMENT_SECONDS * 1.5:
+                return
+
+    try:
+        duration, silences = _scan_silences(ffmpeg, path, AUDIO_MAX_SECONDS + 1)
+    except Exception as e:
+        # デコードできない形式でも Gemini は扱える場合があるため、分割せずにそのまま進める
+        logger.warning(f"Could not decode audio for probing ({audio.mime_type}, {audio.size} bytes): {e}")
+        return
+    audio.duration = duration
+    _reject_if_too_long(duration)
+    if duration <= AUDIO_SEGMENT_SECONDS * 1.5:
+        return
+
+    cuts = silence_cut_points(duration, silences, AUDIO_SEGMENT_SECONDS)
+    try:
+        audio.segments = _extract_segments(ffmpeg, path, cuts, audio.segment_dir())
+    except Exception as e:
+        logger.warning(f"Could not split audio ({audio.mime_type}, {audio.size} bytes): {e}")
+        return
+    logger.info(f"Split {duration:.1f}s recording into {len(audio.segments)} segments")
+
+
+def ingest_audio(stream: BinaryIO, mime_type: Optional[str] = None) -> IngestedAudio:
+    """
+    アップロードされた音声を読み込み、上限を確認する。上限を超えた場合は AudioRejectedError を送出する。
+    """
+    audio = IngestedAudio(_base_mime_type(mime_type))
+    try:
+        while True:
+            data = stream.read(_READ_CHUNK_BYTES)
+            if not data:
+                break
+            audio._write(data)
+        _probe(audio)
+        return audio
+    except BaseException:
+        audio.close()
+        raise
+
+
+def transcribe_ingested(audio: IngestedAudio) -> str:
+    """取り込んだ音声を文字起こしする (分割済みなら区間ごとに並列で)"""
+    if audio.segments:
+        return transcribe_audio_segments(audio.segments, mime_type=_SEGMENT_MIME_TYPE)
+    return transcribe_audio(audio.source, mime_type=audio.mime_type)
+
+
+async def transcribe_ingested_async(audio: IngestedAudio) -> str:
+    """transcribe_ingested の非同期版"""
+    if audio.segments:
+        return await transcribe_audio_segments_async(audio.segments, mime_type=_SEGMENT_MIME_TYPE)
+    return await transcribe_audio_async(audio.source, mime_type=audio.mime_type)
@@ -0,0 +1,375 @@
+# backend/benchmark.py
+"""
+ローカルの偽 Gemini (fakes.FakeModelFactory) と偽 Notion (fakes.FakeNotionServer) を使った負荷テスト。
+API キーは不要。シードした DB に対して実際の HTTP サーバーを起動し、各エンドポイントのスループットと
+p50 / p95 / p99 を計測する。
+
+    python benchmark.py --diaries 100000 --requests 500 --concurrency 16
+    python benchmark.py --server asgi --scenarios chat_text,generate_diary --json result.json
+    python benchmark.py --baseline result.json --max-regression 0.2  # 悪化していたら終了コード 1
+
+シードした DB は --data-dir に件数ごとに保存して次回から再利用し、計測は毎回そのコピーに対して行う。
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+import requests
+from sqlalchemy import func
+
+from fakes import FakeModelFactory, FakeNotionServer
+
+SCENARIOS = ["chat_text", "chat_audio", "generate_diary", "diaries", "search", "sentiment_series"]
+_SEED_BATCH_SIZE = 10000
+_SEED_SENTENCES = [
+    "朝は少し寝坊したけど、ゆっくりコーヒーを飲んだ。",
+    "仕事で新しいプロジェクトの打ち合わせがあった。",
+    "帰り道に新しいカフェを見つけた。",
+    "友達と電話で久しぶりに話せて楽しかった。",
+    "夕飯はカレーを作った。",
+    "少し疲れたので早めに寝ることにする。",
+]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="TalkLog load test with local Gemini / Notion stand-ins")
+    parser.add_argument("--diaries", type=int, default=1000, help="シードする日記の件数 (例: 1000, 100000, 1000000)")
+    parser.add_argument("--diary-chars", type=int, default=400, help="シードする日記 1 件あたりの文字数")
+    parser.add_argument("--data-dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_data"))
+    parser.add_argument("--server", choices=["wsgi", "asgi"], default="wsgi")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=200, help="シナリオごとのリクエスト数")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=5, help="計測から除くシナリオごとの最初のリクエスト数")
+    parser.add_argument("--audio-bytes", type=int, default=32 * 1024)
+    parser.add_argument("--max-pages", type=int, default=5, help="diaries シナリオでカーソルをたどるページ数")
+    parser.add_argument("--gemini-latency", type=float, default=0.5)
+    parser.add_argument("--gemini-jitter", type=float, default=0.3)
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0)
+    parser.add_argument("--gemini-rpm", type=float, default=60000,
+                        help="Gemini クライアントのレート制限 (既定では制限にかからないよう大きくし、アプリ自体を計測する)")
+    parser.add_argument("--response-chars", type=int, default=200)
+    parser.add_argument("--notion-latency", type=float, default=0.3)
+    parser.add_argument("--notion-jitter", type=float, default=0.3)
+    parser.add_argument("--notion-error-rate", type=float, default=0.0)
+    parser.add_argument("--drain-timeout", type=float, default=60.0, help="Notion 同期の完了を待つ最大秒数 (0 で待たない)")
+    parser.add_argument("--json", help="結果を JSON で保存するパス")
+    parser.add_argument("--baseline", help="比較する以前の結果 (--json で保存したもの)")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="p95 の悪化・スループットの低下の許容割合")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="アプリのログと print 出力を表示する")
+    return parser.parse_args(argv)
+
+
+# --- 準備 ---
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _configure_environment(args, notion_server, db_path) -> None:
+    """app / gemini / notion をインポートする前に環境変数を設定する"""
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.environ["NOTION_API_BASE_URL"] = notion_server.base_url
+    os.environ["NOTION_API_KEY"] = "benchmark"
+    os.environ["NOTION_DATABASE_ID"] = "benchmark"
+    os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+    os.environ["GEMINI_REQUESTS_PER_MINUTE"] = str(args.gemini_rpm)
+    os.environ["GEMINI_BURST"] = str(max(1.0, args.gemini_rpm / 60))
+
+
+def _seed(app_module, count: int, diary_chars: int, rng: random.Random) -> None:
+    """日記を count 件まとめて挿入し、感情スコアの集計を作り直す"""
+    Diary = app_module.Diary
+    now = datetime.utcnow()
+    # 1 日あたり 3 件程度になるよう日付を散らす
+    span_seconds = max(1, count // 3) * 24 * 60 * 60
+    started_at = time.perf_counter()
+    for offset in range(0, count, _SEED_BATCH_SIZE):
+        rows = []
+        for _ in range(min(_SEED_BATCH_SIZE, count - offset)):
+            body = "".join(rng.choice(_SEED_SENTENCES) for _ in range(max(1, diary_chars // 20)))[:diary_chars]
+            content = f"## 今日のハイライト\n- {body}"
+            rows.append({
+                "date": now - timedelta(seconds=rng.uniform(0, span_seconds)),
+                "diary_content": content,
+                "preview": app_module.make_preview(content),
+                "sentiment_score": round(rng.uniform(-1.0, 1.0), 2),
+                "highlight_events": rng.choice(_SEED_SENTENCES),
+            })
+        app_module.db.session.execute(Diary.__table__.insert(), rows)
+        app_module.db.session.commit()
+        print(f"  seeded {offset + len(rows)}/{count} diaries ({time.perf_counter() - started_at:.1f}s)", file=sys.stderr)
+    app_module._rebuild_sentiment_rollups()
+    print(f"  rebuilt sentiment rollups ({time.perf_counter() - started_at:.1f}s)", file=sys.stderr)
+
+
+def _start_server(args, app_module, flask_app):
+    """アプリを別スレッドで起動し、ベース URL を返す"""
+    port = _free_port()
+    if args.server == "asgi":
+        import uvicorn
+        import asgi
+        server = uvicorn.Server(uvicorn.Config(asgi.app, host="127.0.0.1", port=port, log_level="warning"))
+        threading.Thread(target=server.run, name="bench-server", daemon=True).start()
+        while not server.started:
+            time.sleep(0.05)
+    else:
+        from werkzeug.serving import make_server
+        server = make_server("127.0.0.1", port, flask_app, threaded=True)
+        threading.Thread(target=server.serve_forever, name="bench-server", daemon=True).start()
+        app_module.start_background_workers(flask_app)
+    return f"http://127.0.0.1:{port}"
+
+
+# --- シナリオ (1 回のリクエストを送る関数。state はワーカーごとの状態) ---
+def _chat_session_data(state):
+    if state.get("turns", 0) >= 20:
+        state.clear()
+    data = {"session_id": state["session_id"]} if state.get("session_id") else {}
+    state["turns"] = state.get("turns", 0) + 1
+    return data
+
+
+def _remember_session(state, res):
+    if res.ok:
+        state["session_id"] = res.json().get("session_id")
+
+
+def chat_text(http, base_url, state, args, rng):
+    data = _chat_session_data(state)
+    data["text"] = rng.choice(_SEED_SENTENCES)
+    res = http.post(f"{base_url}/api/chat", data=data, timeout=120)
+    _remember_session(state, res)
+    return res
+
+
+def chat_audio(http, base_url, state, args, rng):
+    data = _chat_session_data(state)
+    audio = rng.randbytes(args.audio_bytes)
+    res = http.post(f"{base_url}/api/chat", data=data, files={"audio": ("voice.webm", audio, "audio/webm")}, timeout=120)
+    _remember_session(state, res)
+    return res
+
+
+def generate_diary(http, base_url, state, args, rng):
+    # 重複排除に当たらないよう毎回異なる会話にする
+    conversation = [
+        {"role": "user", "content": f"{rng.choice(_SEED_SENTENCES)} ({uuid.uuid4().hex})"},
+        {"role": "ai", "content": "そうだったんだね。それでどうなったの？"},
+        {"role": "user", "content": rng.choice(_SEED_SENTENCES)},
+    ]
+    return http.post(f"{base_url}/api/generate_diary", json={"conversation": conversation}, timeout=120)
+
+
+def diaries(http, base_url, state, args, rng):
+    # ダッシュボードの一覧と同じ項目 (本文は詳細表示のときだけ取得する)
+    params = {"limit": 50, "fields": "id,date,sentiment_score,highlight_events,preview"}
+    if state.get("cursor") and state.get("pages", 0) < args.max_pages:
+        params["cursor"] = state["cursor"]
+        state["pages"] += 1
+    else:
+        state["pages"] = 1
+    res = http.get(f"{base_url}/api/diaries", params=params, timeout=120)
+    state["cursor"] = res.json().get("next_cursor") if res.ok else None
+    return res
+
+
+def sentiment_series(http, base_url, state, args, rng):
+    return http.get(f"{base_url}/api/sentiment_series", params={"bucket": rng.choice(["day", "week", "month"])}, timeout=120)
+
+
+_SEARCH_QUERIES = ["カフェ", "打ち合わせ", "新しい カフェ", "コーヒー", "夕飯", "早めに寝る", "電話"]
+
+
+def search(http, base_url, state, args, rng):
+    return http.get(f"{base_url}/api/diaries/search", params={"q": rng.choice(_SEARCH_QUERIES), "limit": 20}, timeout=120)
+
+
+# --- 計測 ---
+def percentile(sorted_values, p):
+    """最近接順位法によるパーセンタイル"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(p / 100 * len(sorted_values)) - 1))]
+
+
+def run_scenario(name, base_url, args):
+    """concurrency 本のワーカーで requests 回 (+ ウォームアップ) リクエストを送り、統計を返す"""
+    fn = globals()[name]
+    total = args.warmup + args.requests
+    issued = iter(range(total))
+    lock = threading.Lock()
+    latencies, errors = [], 0
+    measure_started_at = [None]
+
+    def worker(worker_id):
+        nonlocal errors
+        rng = random.Random(args.seed * 1000 + worker_id)
+        http = requests.Session()
+        state = {}
+        while True:
+            with lock:
+                i = next(issued, None)
+                if i == args.warmup and measure_started_at[0] is None:
+                    measure_started_at[0] = time.perf_counter()
+            if i is None:
+                return
+            started_at = time.perf_counter()
+            try:
+                ok = fn(http, base_url, state, args, rng).ok
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - started_at
+            if i >= args.warmup:
+                with lock:
+                    latencies.append(elapsed)
+                    errors += 0 if ok else 1
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(worker, range(args.concurrency)))
+    wall = time.perf_counter() - (measure_started_at[0] or time.perf_counter())
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": len(latencies) / wall if wall > 0 else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": (latencies[-1] if latencies else 0.0) * 1000,
+    }
+
+
+def wait_for_notion_sync(app_module, flask_app, timeout):
+    """アウトボックスが空になるまで待ち、件数と所要時間を返す"""
+    NotionOutbox = app_module.NotionOutbox
+    started_at = time.perf_counter()
+    with flask_app.app_context():
+        while True:
+            counts = dict(app_module.db.session.query(NotionOutbox.status, func.count())
+                          .group_by(NotionOutbox.status).all())
+            app_module.db.session.rollback()
+            if not counts.get("pending") or time.perf_counter() - started_at > timeout:
+                break
+            time.sleep(0.2)
+    return {"done": counts.get("done", 0), "pending": counts.get("pending", 0),
+            "failed": counts.get("failed", 0), "drain_seconds": time.perf_counter() - started_at}
+
+
+def compare_with_baseline(results, baseline, max_regression):
+    """p95 が許容割合を超えて悪化した、またはスループットが下がったシナリオを返す"""
+    regressions = []
+    for name, current in results.items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        if current["p95_ms"] > before["p95_ms"] * (1 + max_regression):
+            regressions.append(f"{name}: p95 {before['p95_ms']:.1f}ms -> {current['p95_ms']:.1f}ms")
+        if current["throughput_rps"] < before["throughput_rps"] * (1 - max_regression):
+            regressions.append(f"{name}: throughput {before['throughput_rps']:.1f} -> {current['throughput_rps']:.1f} req/s")
+    return regressions
+
+
+def print_report(results, notion):
+    header = f"{'scenario':<18}{'reqs':>7}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        print(f"{name:<18}{r['requests']:>7}{r['errors']:>8}{r['throughput_rps']:>9.1f}"
+              f"{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}{r['max_ms']:>10.1f}")
+    if notion:
+        print(f"\nNotion sync: done={notion['done']} pending={notion['pending']} failed={notion['failed']} "
+              f"(drained in {notion['drain_seconds']:.1f}s after the load)")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    notion_server = FakeNotionServer(latency=args.notion_latency, jitter=args.notion_jitter,
+                                     error_rate=args.notion_error_rate).start()
+    os.makedirs(args.data_dir, exist_ok=True)
+    template_path = os.path.join(args.data_dir, f"diaries_{args.diaries}_{args.diary_chars}.db")
+    work_dir = tempfile.mkdtemp(prefix="talklog-bench-")
+    db_path = os.path.join(work_dir, "talklog.db")
+    if os.path.exists(template_path):
+        shutil.copyfile(template_path, db_path)
+    _configure_environment(args, notion_server, db_path)
+
+    output = sys.stdout if args.verbose else open(os.devnull, "w")
+    flask_app = None
+    try:
+        with redirect_stdout(output):
+            import app as app_module
+            import gemini
+            if not args.verbose:
+                logging.disable(logging.INFO)
+            gemini.set_model_factory(FakeModelFactory(latency=args.gemini_latency, jitter=args.gemini_jitter,
+                                                      error_rate=args.gemini_error_rate, response_chars=args.response_chars))
+            if args.server == "asgi":
+                import asgi
+                flask_app = asgi.flask_app
+            else:
+                flask_app = app_module.create_app()
+            with flask_app.app_context():
+                app_module.init_db()
+                if not os.path.exists(template_path):
+                    print(f"Seeding {args.diaries} diaries into {template_path}", file=sys.stderr)
+                    _seed(app_module, args.diaries, args.diary_chars, random.Random(args.seed))
+                    app_module.db.engine.dispose()
+                    shutil.copyfile(db_path, template_path)
+
+            base_url = _start_server(args, app_module, flask_app)
+            results = {}
+            for name in scenarios:
+                print(f"Running {name} ({args.requests} requests, concurrency {args.concurrency})", file=sys.stderr)
+                results[name] = run_scenario(name, base_url, args)
+            notion = wait_for_notion_sync(app_module, flask_app, args.drain_timeout) if args.drain_timeout > 0 else None
+    finally:
+        # 同期ワーカーが偽 Notion サーバーへの接続中に落ちないよう、ワーカーを先に止める
+        if flask_app is not None:
+            app_module.stop_background_workers(flask_app)
+        notion_server.stop()
+        if output is not sys.stdout:
+            output.close()
+
+    print(f"\n{args.server} server, {args.diaries} seeded diaries, concurrency {args.concurrency}, "
+          f"gemini latency {args.gemini_latency}s, notion latency {args.notion_latency}s\n")
+    print_report(results, notion)
+
+    report = {"config": vars(args), "scenarios": results, "notion_sync": notion}
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare_with_baseline(results, json.load(f), args.max_regression)
+        if regressions:
+            print("\nRegressions against baseline:\n  " + "\n  ".join(regressions))
+            return 1
+        print("\nNo regressions against baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
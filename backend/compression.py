@@ -0,0 +1,65 @@
+# backend/compression.py
+"""
+日記本文の圧縮保存。
+圧縮した本文は形式を表すタグ (b"zlib:" / b"zstd:") を先頭に付けたバイト列 (SQLite の BLOB) として保存し、
+圧縮しても小さくならない短い本文と、圧縮導入前の行はそのまま TEXT として保存する。
+読み出し時はタグを見て展開するため、形式の異なる行が混在していてもよい。
+zstd は zstandard パッケージが入っている場合のみ使える (DIARY_COMPRESSION=zstd)。
+"""
+import logging
+import os
+import zlib
+from typing import Optional, Union
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+ZLIB_TAG = b"zlib:"
+ZSTD_TAG = b"zstd:"
+_ZLIB_LEVEL = 6
+_ZSTD_LEVEL = 6
+
+# 新しく保存する本文の圧縮形式: zlib | zstd | none
+DIARY_COMPRESSION = os.getenv("DIARY_COMPRESSION", "zlib").lower()
+if DIARY_COMPRESSION == "zstd" and zstandard is None:
+    logger.warning("DIARY_COMPRESSION=zstd but the zstandard package is not installed; using zlib")
+    DIARY_COMPRESSION = "zlib"
+
+
+def compress_text(value: Optional[str], codec: Optional[str] = None) -> Union[str, bytes, None]:
+    """本文を保存する形にする (圧縮して小さくならなければ文字列のまま返す)"""
+    codec = codec or DIARY_COMPRESSION
+    if value is None or codec == "none":
+        return value
+    raw = value.encode("utf-8")
+    if codec == "zstd":
+        packed = ZSTD_TAG + zstandard.ZstdCompressor(level=_ZSTD_LEVEL).compress(raw)
+    else:
+        packed = ZLIB_TAG + zlib.compress(raw, _ZLIB_LEVEL)
+    return packed if len(packed) < len(raw) else value
+
+
+def decompress_text(value: Union[str, bytes, None]) -> Optional[str]:
+    """保存されている本文を文字列に戻す (圧縮されていなければそのまま返す)"""
+    if value is None or isinstance(value, str):
+        return value
+    value = bytes(value)
+    if value.startswith(ZLIB_TAG):
+        return zlib.decompress(value[len(ZLIB_TAG):]).decode("utf-8")
+    if value.startswith(ZSTD_TAG):
+        if zstandard is None:
+            raise RuntimeError("Diary body is zstd-compressed but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(value[len(ZSTD_TAG):]).decode("utf-8")
+    return value.decode("utf-8")
+
+
+def register_sqlite_functions(dbapi_connection) -> None:
+    """
+    SQL から本文を展開する関数 talklog_decompress(x) を登録する。
+    全文検索の索引 (search.py) のトリガーとビューが使うため、すべての接続で登録が必要。
+    """
+    dbapi_connection.create_function("talklog_decompress", 1, decompress_text, deterministic=True)
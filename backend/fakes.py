@@ -0,0 +1,239 @@
+# backend/fakes.py
+"""
+ローカルで Gemini と Notion の代わりに使う偽物。
+API キーなしで遅延・エラー・応答サイズを再現し、ヘッジやリトライの動作確認やベンチマークに使う。
+
+    import gemini
+    from fakes import FakeModelFactory
+    gemini.set_model_factory(FakeModelFactory(latency={"gemini-1.5-flash": 5.0}, error_rate=0.1))
+
+    # notion をインポートする前に NOTION_API_BASE_URL を server.base_url にする
+    server = FakeNotionServer(latency=0.3, error_rate=0.05).start()
+"""
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Dict, Optional, Union
+
+from google.api_core import exceptions as google_exceptions
+
+_STOP_REASON = 1
+
+
+def _response(text: str) -> SimpleNamespace:
+    """GenerateContentResponse と同じ属性を持つ応答オブジェクトを作る"""
+    part = SimpleNamespace(text=text)
+    candidate = SimpleNamespace(
+        finish_reason=_STOP_REASON,
+        content=SimpleNamespace(parts=[part]),
+        safety_ratings=[]
+    )
+    return SimpleNamespace(text=text, candidates=[candidate], prompt_feedback=None)
+
+
+class FakeGenerativeModel:
+    """genai.GenerativeModel の generate_content だけを真似る偽モデル"""
+
+    def __init__(self, model_name: str, system_instruction: Optional[str] = None,
+                 generation_config: Optional[Dict] = None, factory: "FakeModelFactory" = None):
+        self.model_name = model_name
+        self.system_instruction = system_instruction or ""
+        self.generation_config = generation_config or {}
+        self.factory = factory or FakeModelFactory()
+
+    def _reply_text(self) -> str:
+        filler = "あ" * self.factory.response_chars
+        if self.generation_config.get("response_mime_type") != "application/json":
+            return f"[{self.model_name}] {filler}"
+        if "transcription" in self.system_instruction:
+            return json.dumps({"transcription": "今日は新しいカフェに行った", "reply": f"いいね！{filler}"}, ensure_ascii=False)
+        return json.dumps({
+            "sentiment_score": round(random.uniform(-1.0, 1.0), 2),
+            "highlight_events": "新しいカフェでケーキを食べた日",
+            "diary_content": f"## 今日のハイライト\n- 新しいカフェに行った\n\n## 感じたこと・気づき\n- {filler}"
+        }, ensure_ascii=False)
+
+    def _result(self, stream: bool):
+        if random.random() < self.factory.error_rate:
+            raise google_exceptions.ServiceUnavailable(f"Fake error from {self.model_name}")
+        text = self._reply_text()
+        if not stream:
+            return _response(text)
+        # ストリーミング時は数チャンクに分けて返す
+        step = max(1, len(text) // 4)
+        return [_response(text[i:i + step]) for i in range(0, len(text), step)]
+
+    def generate_content(self, contents=None, request_options=None, stream: bool = False, **kwargs):
+        self.factory.calls += 1
+        time.sleep(self.factory.latency_for(self.model_name))
+        result = self._result(stream)
+        return iter(result) if stream else result
+
+    async def generate_content_async(self, contents=None, request_options=None, stream: bool = False, **kwargs):
+        self.factory.calls += 1
+        await asyncio.sleep(self.factory.latency_for(self.model_name))
+        result = self._result(stream)
+        if not stream:
+            return result
+
+        async def chunks():
+            for chunk in result:
+                yield chunk
+        return chunks()
+
+
+class FakeModelFactory:
+    """
+    gemini.set_model_factory に渡すファクトリ。
+    latency: 秒数、またはモデル名ごとの秒数の辞書 (jitter の割合だけランダムに揺らぐ)
+    error_rate: 一時的エラー (503) を返す確率
+    response_chars: 応答に含める埋め草の文字数
+    """
+
+    def __init__(self, latency: Union[float, Dict[str, float]] = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, response_chars: int = 50):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.response_chars = response_chars
+        self.calls = 0
+
+    def latency_for(self, model_name: str) -> float:
+        base = self.latency.get(model_name, 0.0) if isinstance(self.latency, dict) else self.latency
+        return max(0.0, base * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def __call__(self, model_name: str, system_instruction: Optional[str] = None,
+                 generation_config: Optional[Dict] = None) -> FakeGenerativeModel:
+        return FakeGenerativeModel(model_name, system_instruction, generation_config, factory=self)
+
+
+class FakeNotionServer:
+    """
+    Notion API のうち TalkLog が使うエンドポイントだけを真似るローカル HTTP サーバー。
+    latency: 1 リクエストあたりの秒数 (jitter の割合だけランダムに揺らぐ)
+    error_rate: error_status (既定は 503) を返す確率。429 の場合は Retry-After も付ける
+    """
+
+    _QUERY_PATH = re.compile(r"^/v1/databases/[^/]+/query$")
+    _CHILDREN_PATH = re.compile(r"^/v1/blocks/([^/]+)/children$")
+    _PAGE_PATH = re.compile(r"^/v1/pages/([^/]+)$")
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 error_status: int = 503, port: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.pages: Dict[str, Dict] = {} # ページID → {"title", "url", "blocks", "archived"}
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-notion", daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeNotionServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeNotionServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def _create_page(self, payload: Dict) -> Dict:
+        title = "".join(t.get("text", {}).get("content", "")
+                        for t in payload.get("properties", {}).get("Name", {}).get("title", []))
+        page_id = uuid.uuid4().hex
+        page = {"title": title, "url": f"https://www.notion.so/fake-{page_id}", "blocks": list(payload.get("children", [])),
+                "archived": False}
+        with self._lock:
+            self.pages[page_id] = page
+        return {"object": "page", "id": page_id, "url": page["url"]}
+
+    def _query(self, payload: Dict) -> Dict:
+        title = payload.get("filter", {}).get("title", {}).get("equals")
+        with self._lock:
+            results = [{"object": "page", "id": page_id, "url": page["url"]}
+                       for page_id, page in self.pages.items()
+                       if not page["archived"] and (title is None or page["title"] == title)]
+        return {"object": "list", "results": results[:payload.get("page_size", 100)], "has_more": False}
+
+    def _append_children(self, page_id: str, payload: Dict) -> Optional[Dict]:
+        with self._lock:
+            page = self.pages.get(page_id)
+            if page is None:
+                return None
+            page["blocks"].extend(payload.get("children", []))
+        return {"object": "list", "results": payload.get("children", [])}
+
+    def _update_page(self, page_id: str, payload: Dict) -> Optional[Dict]:
+        with self._lock:
+            page = self.pages.get(page_id)
+            if page is None:
+                return None
+            page["archived"] = bool(payload.get("archived", page["archived"]))
+        return {"object": "page", "id": page_id, "url": page["url"], "archived": page["archived"]}
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status: int, body: Dict, headers: Optional[Dict[str, str]] = None) -> None:
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _handle(self) -> None:
+                length = int(self.headers.get("Content-Length") or 0)
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                with fake._lock:
+                    fake.requests += 1
+                time.sleep(max(0.0, fake.latency * random.uniform(1 - fake.jitter, 1 + fake.jitter)))
+                if random.random() < fake.error_rate:
+                    headers = {"Retry-After": "1"} if fake.error_status == 429 else None
+                    return self._send(fake.error_status, {"object": "error", "status": fake.error_status, "message": "Fake error"}, headers)
+
+                if self.command == "POST" and self.path == "/v1/pages":
+                    return self._send(200, fake._create_page(payload))
+                if self.command == "POST" and fake._QUERY_PATH.match(self.path):
+                    return self._send(200, fake._query(payload))
+                match = fake._CHILDREN_PATH.match(self.path)
+                if self.command == "PATCH" and match:
+                    result = fake._append_children(match.group(1), payload)
+                    if result is not None:
+                        return self._send(200, result)
+                match = fake._PAGE_PATH.match(self.path)
+                if self.command == "PATCH" and match:
+                    result = fake._update_page(match.group(1), payload)
+                    if result is not None:
+                        return self._send(200, result)
+                self._send(404, {"object": "error", "status": 404, "message": f"Unknown endpoint {self.command} {self.path}"})
+
+            do_POST = _handle
+            do_PATCH = _handle
+
+        return Handler
@@ -1,22 +1,75 @@
 # backend/gemini.py
 import os
 import base64
+import tempfile
 import mimetypes
-import google.generativeai as genai
-from google.generativeai.types import File
 from dotenv import load_dotenv
 import time
 import traceback
 import json
-from typing import List, Dict, Union, Optional, Tuple
+import hashlib
+import random
+import asyncio
+import contextvars
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Union, Optional, Tuple, Iterator, AsyncIterator, Any, TYPE_CHECKING
+
+from ratelimit import TokenBucket
+import metrics
+from metrics import span
+
+if TYPE_CHECKING:
+    from google.generativeai.types import File
 
 load_dotenv()
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+
+# --- SDK の遅延読み込み ---
+# google.generativeai (と protobuf / gRPC) の読み込みには 1 秒近くかかるため、
+# インポート時ではなく最初に API を使うとき (または prewarm) に読み込んで設定する
+_genai_module = None
+_genai_lock = threading.Lock()
+
+def _genai():
+    """設定済みの google.generativeai モジュールを返す (初回のみ読み込みと configure を行う)"""
+    global _genai_module
+    if _genai_module is None:
+        with _genai_lock:
+            if _genai_module is None:
+                import google.generativeai as genai
+                genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+                _genai_module = genai
+    return _genai_module
+
+def prewarm() -> None:
+    """SDK とリトライ判定用の例外クラスを読み込んでおく (起動直後のリクエストで読み込み時間を払わないため)"""
+    _genai()
+    _retryable_errors()
 
 # --- モデル設定 ---
 _MODEL_MODEL_FOR_CHAT = "gemini-1.5-flash" # チャット用モデル
 _MODEL_MODEL_FOR_DIARY = "gemini-1.5-flash" # 日記生成用モデル
 _MODEL_MODEL_FOR_TRANSCRIPTION = "gemini-1.5-flash" # 文字起こし用モデル (音声入力対応モデル)
+_MODEL_MODEL_FOR_CHAT_FALLBACK = os.getenv("GEMINI_CHAT_FALLBACK_MODEL", "gemini-1.5-flash-8b") # チャットの予備モデル (ヘッジ・障害時用)
+
+# --- 音声入力設定 ---
+# このサイズ以下の音声はアップロードせずリクエストに直接埋め込む (インラインデータの上限は約20MB)
+_INLINE_AUDIO_MAX_BYTES = int(os.getenv("GEMINI_INLINE_AUDIO_MAX_BYTES", 15 * 1024 * 1024))
+# アップロードしたファイルが ACTIVE になるまでのポーリング間隔 (初期値から倍々で上限まで伸ばす)
+_FILE_POLL_INITIAL_INTERVAL = 0.25
+_FILE_POLL_MAX_INTERVAL = 4.0
+# 長い録音を区間ごとに文字起こしするときの並列数
+_TRANSCRIBE_WORKERS = int(os.getenv("TRANSCRIBE_WORKERS", 4))
+
+# アップロード済みファイルの削除をリクエスト処理の外で行うためのスレッド
+_cleanup_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="gemini-cleanup")
+
+# --- 長い会話の日記生成設定 (map-reduce) ---
+# 会話の見積もりトークン数がこれを超えたら、分割して要約してから日記を生成する
+_DIARY_MAP_REDUCE_THRESHOLD_TOKENS = int(os.getenv("DIARY_MAP_REDUCE_THRESHOLD_TOKENS", 30000))
+_DIARY_CHUNK_TOKENS = int(os.getenv("DIARY_CHUNK_TOKENS", 8000)) # 1チャンクあたりの目安トークン数
+_DIARY_MAP_WORKERS = int(os.getenv("DIARY_MAP_WORKERS", 4))      # チャンク要約の並列数
 
 # --- プロンプト ---
 _CHAT_SYSTEM_PROMPT = """
@@ -30,6 +83,37 @@ _CHAT_SYSTEM_PROMPT = """
 - ユーザーが音声で入力した場合、その内容を要約したり繰り返したりする必要はありません。会話の流れに沿った応答を生成してください。
 """.strip()
 
+# 音声の文字起こしと応答を 1 回の呼び出しで行うためのプロンプト
+_LISTEN_AND_REPLY_SYSTEM_PROMPT = _CHAT_SYSTEM_PROMPT + """
+
+最後のユーザーの発言は音声で届きます。
+音声を正確に文字起こししたうえで、その発言への応答を生成し、必ず以下のJSON形式で返してください。
+
+{
+  "transcription": "<音声の文字起こし>",
+  "reply": "<ユーザーへの応答>"
+}
+"""
+
+# 長い会話の古い部分を要約するためのプロンプト
+_SUMMARY_SYSTEM_PROMPT = """
+あなたはユーザーとAI（ログとも）の会話を記録する係です。
+入力は「これまでの要約」と「その後の会話」です。
+両方の内容を統合し、後で会話を続けたり日記を書いたりするのに必要な事実・出来事・ユーザーの感情を漏らさず、
+日本語の箇条書きで500文字以内に要約してください。要約のみを出力してください。
+""".strip()
+
+# 長い会話を分割したチャンクごとの要約 (日記生成の前処理) 用プロンプト
+_DIARY_CHUNK_SYSTEM_PROMPT = """
+あなたはユーザーの日記作成アシスタントです。
+入力はユーザーとAI（ログとも）の長い会話の一部分です。
+後でこの要約だけから日記を書くため、以下を漏らさず日本語の箇条書きで要約してください。
+- ユーザーが話した出来事 (時系列順)
+- ユーザーの印象的な発言 (できるだけ原文のまま)
+- ユーザーの感情や気づき、良かったこと、未解決のこと
+AI自身の発言は、話の流れを理解するのに必要な範囲でのみ含めてください。要約のみを出力してください。
+""".strip()
+
 _DIARY_SYSTEM_PROMPT = """
 あなたはユーザーの日記作成及び分析アシスタントです。
 入力はユーザーとAI（ログとも）の会話履歴です。
@@ -72,36 +156,74 @@ _DIARY_SYSTEM_PROMPT = """
     #会話ログ #今日の振り返り #感情メモ など、会話内容に合ったタグを3〜5個付けてください。
 """.strip()
 
+# 会話履歴が残っていない日記を、保存済みの本文から再分析する (reanalyze.py) ためのプロンプト
+_DIARY_ANALYSIS_SYSTEM_PROMPT = """
+あなたはユーザーの日記の分析アシスタントです。
+入力はユーザーとAI（ログとも）の会話から作成された日記です。
+必ず以下のJSON形式で日本語のレスポンスを生成してください。
+
+{
+  "sentiment_score": <float>,
+  "highlight_events": "<string>"
+}
+
+各フィールドの要件は以下の通りです。
+
+1.  `sentiment_score`:
+    - 日記全体から感じ取れるユーザーの感情を、-1.0（非常にネガティブ）から1.0（非常にポジティブ）の範囲の浮動小数点数で数値化してください。
+    - 中立的な感情は0.0とします。
+
+2.  `highlight_events`:
+    - 日記の中から、その日を最も象徴する出来事を、50文字以内の非常に短い日本語の文章で要約してください。
+    - 例：「新しいカフェで美味しいケーキを食べた日」「仕事のプロジェクトで大きな進展があった」
+""".strip()
+
+
+# --- トークン数の見積もり ---
+def estimate_tokens(text: str) -> int:
+    """
+    プロンプトのトークン数を概算する (API を呼ばない簡易見積もり)。
+    英数字は約4文字で1トークン、日本語などの非ASCII文字は1文字で約1トークンとして数える。
+    """
+    if not text:
+        return 0
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
 
 # --- ファイルアップロードと待機 ---
-def _upload_and_wait_for_file(path: str, timeout: int = 60) -> File:
+def _upload_and_wait_for_file(path: str, mime_type: str = "audio/webm", timeout: int = 60) -> "File":
     """ファイルをアップロードし、ACTIVEになるまで待機する"""
     print(f"Attempting to upload file: {path}")
     try:
-        print(f"Uploading with explicit mime_type: audio/webm")
-        audio_file = genai.upload_file(path=path, mime_type="audio/webm")
+        print(f"Uploading with explicit mime_type: {mime_type}")
+        with span("gemini_upload"):
+            audio_file = _genai().upload_file(path=path, mime_type=mime_type)
+        metrics.audio_bytes.inc(os.path.getsize(path), mode="upload")
         print(f"File uploaded: name={audio_file.name}, state={audio_file.state.name}")
 
-        start_time = time.time()
-        while audio_file.state.name != "ACTIVE":
-            if time.time() - start_time > timeout:
-                raise TimeoutError(f"File processing timed out for {audio_file.name}")
+        with span("gemini_wait_active"):
+            start_time = time.time()
+            interval = _FILE_POLL_INITIAL_INTERVAL
+            while audio_file.state.name != "ACTIVE":
+                if time.time() - start_time > timeout:
+                    raise TimeoutError(f"File processing timed out for {audio_file.name}")
 
-            print(f"Waiting for file {audio_file.name} to become ACTIVE. Current state: {audio_file.state.name}. Sleeping for 2 seconds...")
-            time.sleep(2)
+                print(f"Waiting for file {audio_file.name} to become ACTIVE. Current state: {audio_file.state.name}. Sleeping for {interval:.2f} seconds...")
+                time.sleep(interval)
+                interval = min(interval * 2, _FILE_POLL_MAX_INTERVAL)
 
-            try:
-                fetched_file = genai.get_file(name=audio_file.name)
-                audio_file: File = fetched_file
-                print(f"Refetched file state for {audio_file.name}: {audio_file.state.name}")
-            except Exception as e_get:
-                raise ValueError(f"Failed to get updated state for file {audio_file.name}") from e_get
-
-            if audio_file.state.name == "FAILED":
-                error_details = ""
-                if hasattr(audio_file, 'processing_error') and audio_file.processing_error:
-                    error_details = f" Details: {audio_file.processing_error}"
-                raise ValueError(f"File upload or processing failed for {path}.{error_details}")
+                try:
+                    fetched_file = _genai().get_file(name=audio_file.name)
+                    audio_file = fetched_file
+                    print(f"Refetched file state for {audio_file.name}: {audio_file.state.name}")
+                except Exception as e_get:
+                    raise ValueError(f"Failed to get updated state for file {audio_file.name}") from e_get
+
+                if audio_file.state.name == "FAILED":
+                    error_details = ""
+                    if hasattr(audio_file, 'processing_error') and audio_file.processing_error:
+                        error_details = f" Details: {audio_file.processing_error}"
+                    raise ValueError(f"File upload or processing failed for {path}.{error_details}")
 
         print(f"File {audio_file.name} is now ACTIVE.")
         return audio_file
@@ -109,175 +231,1272 @@ def _upload_and_wait_for_file(path: str, timeout: int = 60) -> File:
     except Exception as e:
         raise
 
+def _delete_file(name: str) -> None:
+    """アップロード済みファイルを削除する (バックグラウンドスレッドで実行)"""
+    try:
+        print(f"Attempting to delete file: {name}")
+        _genai().delete_file(name)
+        print(f"Successfully deleted file: {name}")
+    except Exception as delete_error:
+        print(f"Warning: Failed to delete uploaded file {name}: {delete_error}")
+
+# --- Gemini クライアント層 ---
+# モデルごとの同時実行数・レート制限・リトライ設定
+_GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", 8))
+# レート制限は任意 (未設定または 0 なら制限しない)。プロジェクトのクォータに合わせて設定する
+_GEMINI_REQUESTS_PER_MINUTE = float(os.getenv("GEMINI_REQUESTS_PER_MINUTE", 0))
+_GEMINI_BURST = float(os.getenv("GEMINI_BURST", 10))
+_GEMINI_QUEUE_TIMEOUT = float(os.getenv("GEMINI_QUEUE_TIMEOUT", 120)) # 同時実行枠を待つ最大秒数
+_GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", 3))
+_GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", 1.0))
+_GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", 30.0))
+_GEMINI_REQUEST_TIMEOUT = 600
+
+_retryable_errors_cache: Optional[Tuple[type, ...]] = None
+
+def _retryable_errors() -> Tuple[type, ...]:
+    """一時的なエラーとしてリトライする例外 (429 / 5xx / タイムアウト / 通信エラー)"""
+    global _retryable_errors_cache
+    if _retryable_errors_cache is None:
+        from google.api_core import exceptions as google_exceptions
+        _retryable_errors_cache = (
+            google_exceptions.ResourceExhausted,
+            google_exceptions.TooManyRequests,
+            google_exceptions.ServiceUnavailable,
+            google_exceptions.InternalServerError,
+            google_exceptions.DeadlineExceeded,
+            ConnectionError,
+            TimeoutError,
+        )
+    return _retryable_errors_cache
+
+class _ModelLimiter:
+    """1 モデル分の同時実行セマフォ・トークンバケット (レート制限を設定した場合のみ) と統計値"""
+
+    def __init__(self):
+        self.semaphore = threading.BoundedSemaphore(_GEMINI_MAX_CONCURRENCY)
+        self.bucket: Optional[TokenBucket] = None
+        if _GEMINI_REQUESTS_PER_MINUTE > 0:
+            self.bucket = TokenBucket(rate=_GEMINI_REQUESTS_PER_MINUTE / 60.0, capacity=_GEMINI_BURST)
+        self.async_semaphore: Optional[asyncio.Semaphore] = None # 非同期モード用 (イベントループ内で作成)
+        self.lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "errors": 0,
+            "retries": 0,
+            "in_flight": 0,
+            "queue_wait_seconds_total": 0.0,
+            "queue_wait_seconds_max": 0.0,
+        }
+
+    def record(self, **increments) -> None:
+        with self.lock:
+            for key, value in increments.items():
+                self.stats[key] += value
+
+    def acquire_token(self) -> None:
+        if self.bucket is not None:
+            self.bucket.acquire()
+
+    def token_delay(self) -> float:
+        """トークンを先取りし、使ってよくなるまでの秒数を返す (非同期モード用)"""
+        return self.bucket.reserve() if self.bucket is not None else 0.0
+
+    def record_wait(self, waited: float) -> None:
+        with self.lock:
+            self.stats["queue_wait_seconds_total"] += waited
+            self.stats["queue_wait_seconds_max"] = max(self.stats["queue_wait_seconds_max"], waited)
+
+
+def _observe_prompt(model_name: str, system_prompt: Optional[str], contents: Any) -> None:
+    """プロンプトのテキスト部分の見積もりトークン数を記録する (音声などのデータは含めない)"""
+    def text_of(content) -> str:
+        if isinstance(content, str):
+            return content
+        if isinstance(content, dict):
+            return "".join(text_of(part) for part in content.get("parts", []))
+        if isinstance(content, list):
+            return "".join(text_of(part) for part in content)
+        return ""
+    metrics.prompt_tokens.observe(estimate_tokens((system_prompt or "") + text_of(contents)), model=model_name)
+
+class _GeminiClient:
+    """
+    GenerativeModel インスタンスを (モデル名, システムプロンプト, 生成設定) ごとに使い回し、
+    モデルごとの同時実行数とレートを制限し、一時的なエラーをジッタ付き指数バックオフでリトライする。
+    """
+
+    def __init__(self, model_factory=None):
+        # model_factory はテストやベンチマークで偽モデルに差し替えるためのもの (None なら genai.GenerativeModel)
+        self.model_factory = model_factory
+        self._models: Dict[Tuple[str, Optional[str], str], Any] = {}
+        self._limiters: Dict[str, _ModelLimiter] = {}
+        self._lock = threading.Lock()
+
+    def get_model(self, model_name: str, system_prompt: Optional[str] = None, generation_config: Optional[Dict] = None):
+        key = (model_name, system_prompt, json.dumps(generation_config, sort_keys=True))
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                model_factory = self.model_factory or _genai().GenerativeModel
+                model = model_factory(
+                    model_name=model_name,
+                    system_instruction=system_prompt,
+                    generation_config=generation_config
+                )
+                self._models[key] = model
+            return model
+
+    def _prepare(self, model_name: str, contents: Any, system_prompt: Optional[str], generation_config: Optional[Dict]):
+        """呼び出しに使うモデルを取得し、プロンプトの大きさを記録する"""
+        model = self.get_model(model_name, system_prompt, generation_config)
+        _observe_prompt(model_name, system_prompt, contents)
+        return model
+
+    def _limiter(self, model_name: str) -> _ModelLimiter:
+        with self._lock:
+            if model_name not in self._limiters:
+                self._limiters[model_name] = _ModelLimiter()
+            return self._limiters[model_name]
+
+    def _acquire(self, model_name: str) -> _ModelLimiter:
+        """同時実行枠とレート制限のトークンを取得する (待ち時間を統計に記録)"""
+        limiter = self._limiter(model_name)
+        started_at = time.monotonic()
+        if not limiter.semaphore.acquire(timeout=_GEMINI_QUEUE_TIMEOUT):
+            limiter.record(errors=1)
+            raise TimeoutError(f"Timed out waiting for a free Gemini slot for {model_name}")
+        limiter.acquire_token()
+        limiter.record_wait(time.monotonic() - started_at)
+        limiter.record(in_flight=1)
+        return limiter
+
+    def _release(self, limiter: _ModelLimiter) -> None:
+        limiter.record(in_flight=-1)
+        limiter.semaphore.release()
+
+    def _retry_delay(self, model_name: str, limiter: _ModelLimiter, attempt: int, error: Exception) -> float:
+        """attempt 回目の一時的なエラーの後に待つ秒数 (フルジッタ)。リトライ回数を超えたら error を送出する"""
+        if attempt > _GEMINI_MAX_RETRIES:
+            limiter.record(errors=1)
+            raise error
+        delay = random.uniform(0, min(_GEMINI_BACKOFF_MAX, _GEMINI_BACKOFF_BASE * (2 ** attempt)))
+        limiter.record(retries=1)
+        print(f"Transient Gemini error on {model_name} (attempt {attempt}/{_GEMINI_MAX_RETRIES}), retrying in {delay:.2f}s: {error}")
+        return delay
+
+    def _with_retries(self, model_name: str, fn) -> Tuple[Any, _ModelLimiter]:
+        """
+        同時実行枠を取って fn() を実行し、一時的なエラーならバックオフして再実行する。
+        バックオフの間は枠を手放す。戻り値: (fn の結果, 取得したままの limiter。呼び出し側で _release する)
+        """
+        self._limiter(model_name).record(requests=1)
+        attempt = 0
+        while True:
+            limiter = self._acquire(model_name)
+            try:
+                return fn(), limiter
+            except _retryable_errors() as e:
+                self._release(limiter)
+                attempt += 1
+                delay = self._retry_delay(model_name, limiter, attempt, e)
+            except BaseException as e:
+                self._release(limiter)
+                if isinstance(e, Exception):
+                    limiter.record(errors=1)
+                raise
+            time.sleep(delay)
+
+    def generate(
+        self,
+        model_name: str,
+        contents: Any,
+        system_prompt: Optional[str] = None,
+        generation_config: Optional[Dict] = None,
+        timeout: float = _GEMINI_REQUEST_TIMEOUT
+    ):
+        """generate_content を呼び出してレスポンスを返す"""
+        model = self._prepare(model_name, contents, system_prompt, generation_config)
+        res, limiter = self._with_retries(model_name, lambda: model.generate_content(
+            contents=contents,
+            request_options={"timeout": timeout}
+        ))
+        self._release(limiter)
+        return res
+
+    def generate_stream(
+        self,
+        model_name: str,
+        contents: Any,
+        system_prompt: Optional[str] = None,
+        generation_config: Optional[Dict] = None,
+        timeout: float = _GEMINI_REQUEST_TIMEOUT
+    ) -> Iterator[Any]:
+        """generate_content(stream=True) のチャンクを返す (リトライはストリーム開始前のみ)"""
+        model = self._prepare(model_name, contents, system_prompt, generation_config)
+        res, limiter = self._with_retries(model_name, lambda: model.generate_content(
+            contents=contents,
+            request_options={"timeout": timeout},
+            stream=True
+        ))
+        try:
+            yield from res
+        finally:
+            self._release(limiter)
+
+    # --- 非同期版 (ASGI モード用)。スレッドを占有せずに待機・呼び出しを行う ---
+    async def _acquire_async(self, model_name: str) -> _ModelLimiter:
+        limiter = self._limiter(model_name)
+        started_at = time.monotonic()
+        if limiter.async_semaphore is None:
+            limiter.async_semaphore = asyncio.Semaphore(_GEMINI_MAX_CONCURRENCY)
+        try:
+            await asyncio.wait_for(limiter.async_semaphore.acquire(), _GEMINI_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            limiter.record(errors=1)
+            raise TimeoutError(f"Timed out waiting for a free Gemini slot for {model_name}")
+        try:
+            await asyncio.sleep(limiter.token_delay())
+        except BaseException:
+            limiter.async_semaphore.release()
+            raise
+        limiter.record_wait(time.monotonic() - started_at)
+        limiter.record(in_flight=1)
+        return limiter
+
+    def _release_async(self, limiter: _ModelLimiter) -> None:
+        limiter.record(in_flight=-1)
+        limiter.async_semaphore.release()
+
+    async def _with_retries_async(self, model_name: str, fn) -> Tuple[Any, _ModelLimiter]:
+        """_with_retries の非同期版 (fn はコルーチンを返す関数)"""
+        self._limiter(model_name).record(requests=1)
+        attempt = 0
+        while True:
+            limiter = await self._acquire_async(model_name)
+            try:
+                return await fn(), limiter
+            except _retryable_errors() as e:
+                self._release_async(limiter)
+                attempt += 1
+                delay = self._retry_delay(model_name, limiter, attempt, e)
+            except BaseException as e:
+                self._release_async(limiter)
+                if isinstance(e, Exception):
+                    limiter.record(errors=1)
+                raise
+            await asyncio.sleep(delay)
+
+    async def generate_async(
+        self,
+        model_name: str,
+        contents: Any,
+        system_prompt: Optional[str] = None,
+        generation_config: Optional[Dict] = None,
+        timeout: float = _GEMINI_REQUEST_TIMEOUT
+    ):
+        """generate の非同期版 (generate_content_async を使う)"""
+        model = self._prepare(model_name, contents, system_prompt, generation_config)
+        res, limiter = await self._with_retries_async(model_name, lambda: model.generate_content_async(
+            contents=contents,
+            request_options={"timeout": timeout}
+        ))
+        self._release_async(limiter)
+        return res
+
+    async def generate_stream_async(
+        self,
+        model_name: str,
+        contents: Any,
+        system_prompt: Optional[str] = None,
+        generation_config: Optional[Dict] = None,
+        timeout: float = _GEMINI_REQUEST_TIMEOUT
+    ) -> AsyncIterator[Any]:
+        """generate_stream の非同期版"""
+        model = self._prepare(model_name, contents, system_prompt, generation_config)
+        res, limiter = await self._with_retries_async(model_name, lambda: model.generate_content_async(
+            contents=contents,
+            request_options={"timeout": timeout},
+            stream=True
+        ))
+        try:
+            async for chunk in res:
+                yield chunk
+        finally:
+            self._release_async(limiter)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """モデルごとの統計値 (リクエスト数・エラー数・リトライ数・同時実行数・待ち時間) を返す"""
+        with self._lock:
+            limiters = dict(self._limiters)
+        result = {}
+        for model_name, limiter in limiters.items():
+            with limiter.lock:
+                result[model_name] = dict(limiter.stats)
+        return result
+
+_client = _GeminiClient()
+
+def set_model_factory(model_factory) -> None:
+    """
+    GenerativeModel の代わりに使うファクトリを設定する (None で元に戻す)。
+    ローカルの偽モデル (fakes.FakeGenerativeModel など) で遅延や障害を再現するために使う。
+    """
+    with _client._lock:
+        _client.model_factory = model_factory
+        _client._models.clear()
+
+def get_client_stats() -> Dict[str, Dict[str, float]]:
+    """Gemini クライアント層の統計値を返す"""
+    stats = _client.stats()
+    stats["chat_routing"] = _chat_router.stats()
+    return stats
+
+# /metrics に出力する Gemini クライアント層の統計値 (名前, 種類, 説明, stats のキー)
+_CLIENT_METRICS = [
+    ("talklog_gemini_requests_total", "counter", "Gemini calls by model.", "requests"),
+    ("talklog_gemini_errors_total", "counter", "Gemini calls that failed after retries.", "errors"),
+    ("talklog_gemini_retries_total", "counter", "Gemini calls retried after a transient error.", "retries"),
+    ("talklog_gemini_in_flight", "gauge", "Gemini calls in progress.", "in_flight"),
+    ("talklog_gemini_queue_wait_seconds_total", "counter", "Time spent waiting for a concurrency slot or rate-limit token.", "queue_wait_seconds_total"),
+]
+_ROUTING_METRICS = [
+    ("talklog_chat_hedged_total", "counter", "Chat calls that sent a hedge request to the fallback model.", "hedged"),
+    ("talklog_chat_fallback_wins_total", "counter", "Chat calls answered by the fallback model.", "fallback_wins"),
+    ("talklog_chat_breaker_routed_total", "counter", "Chat calls routed to the fallback model by the open circuit breaker.", "breaker_routed"),
+    ("talklog_chat_breaker_open", "gauge", "Whether the chat circuit breaker is open.", "breaker_open"),
+]
+
+def _render_client_metrics() -> List[str]:
+    stats = get_client_stats()
+    routing = stats.pop("chat_routing")
+    lines = []
+    for name, kind, help_text, key in _CLIENT_METRICS:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        lines += [f'{name}{{model="{model_name}"}} {float(model_stats[key]):g}' for model_name, model_stats in sorted(stats.items())]
+    for name, kind, help_text, key in _ROUTING_METRICS:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {float(routing[key]):g}"]
+    return lines
+
+# --- チャットのテールレイテンシ対策 (ヘッジリクエスト / フォールバック / サーキットブレーカー) ---
+_CHAT_HEDGING_ENABLED = os.getenv("GEMINI_CHAT_HEDGING", "1") == "1"
+_HEDGE_PERCENTILE = float(os.getenv("GEMINI_HEDGE_PERCENTILE", 95))
+_HEDGE_DEFAULT_DELAY = float(os.getenv("GEMINI_HEDGE_DEFAULT_DELAY", 3.0)) # 計測値が少ない間の待ち時間
+_HEDGE_MIN_DELAY = float(os.getenv("GEMINI_HEDGE_MIN_DELAY", 0.5))
+_HEDGE_MIN_SAMPLES = 20
+_BREAKER_WINDOW = int(os.getenv("GEMINI_BREAKER_WINDOW", 20))          # 直近何回の結果でエラー率を見るか
+_BREAKER_ERROR_RATE = float(os.getenv("GEMINI_BREAKER_ERROR_RATE", 0.5))
+_BREAKER_MIN_CALLS = int(os.getenv("GEMINI_BREAKER_MIN_CALLS", 10))
+_BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", 30.0))   # 開いてから主モデルを再試行するまでの秒数
+
+class _LatencyTracker:
+    """直近の応答時間からパーセンタイルを求める"""
+
+    def __init__(self, maxlen: int = 200):
+        self._samples = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < _HEDGE_MIN_SAMPLES:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * pct / 100))
+        return samples[index]
+
+
+class _CircuitBreaker:
+    """主モデルのエラー率が閾値を超えたら一定時間 open になり、予備モデルに切り替えさせる"""
+
+    def __init__(self):
+        self._outcomes = deque(maxlen=_BREAKER_WINDOW)
+        self._opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def allow_primary(self) -> bool:
+        """主モデルを使ってよいか (open 中でもクールダウン後は試行を許す = half-open)"""
+        with self._lock:
+            return self._opened_at is None or time.monotonic() - self._opened_at >= _BREAKER_COOLDOWN
+
+    def record(self, success: bool) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                if success:
+                    # half-open の試行が成功したら閉じる
+                    self._opened_at = None
+                    self._outcomes.clear()
+                else:
+                    self._opened_at = time.monotonic()
+                return
+            self._outcomes.append(success)
+            failures = self._outcomes.count(False)
+            if len(self._outcomes) >= _BREAKER_MIN_CALLS and failures / len(self._outcomes) >= _BREAKER_ERROR_RATE:
+                print(f"Circuit breaker opened: {failures}/{len(self._outcomes)} recent primary calls failed.")
+                self._opened_at = time.monotonic()
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._opened_at is not None
+
+
+class _HedgedRouter:
+    """
+    主モデルの応答が p95 を超えて遅れたら予備モデルにも同じリクエストを送り、先に成功した方を使う。
+    サーキットブレーカーが open の間は最初から予備モデルに送る。
+    負けた方は未開始ならキャンセルし、実行中なら結果を捨てる (SDK の呼び出しは途中で中断できないため)。
+    応答時間の分布は呼び出しの種類 (kind) ごとに分けて持つ (ストリーミングは最初のチャンクまでの時間)。
+    """
+
+    def __init__(self, primary_model: str, fallback_model: str):
+        self.primary_model = primary_model
+        self.fallback_model = fallback_model
+        self.latency: Dict[str, _LatencyTracker] = {}
+        self.breaker = _CircuitBreaker()
+        self._executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="gemini-hedge")
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "hedged": 0, "fallback_wins": 0, "breaker_routed": 0}
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self._stats[key] += 1
+
+    def _latency(self, kind: str) -> _LatencyTracker:
+        with self._lock:
+            if kind not in self.latency:
+                self.latency[kind] = _LatencyTracker()
+            return self.latency[kind]
+
+    def hedge_delay(self, kind: str = "reply") -> float:
+        p = self._latency(kind).percentile(_HEDGE_PERCENTILE)
+        return max(_HEDGE_MIN_DELAY, p if p is not None else _HEDGE_DEFAULT_DELAY)
+
+    @staticmethod
+    def _discard(future, discard) -> None:
+        """負けた呼び出しをキャンセルし、既に (または後で) 成功した場合は discard に結果を渡して後片付けさせる"""
+        future.cancel()
+        if discard is not None:
+            future.add_done_callback(lambda f: discard(f.result()) if not f.cancelled() and f.exception() is None else None)
+
+    def _start(self) -> bool:
+        """呼び出しを数え、主モデルを使ってよいかを返す (サーキットブレーカーが open なら予備モデルに直接送る)"""
+        self._count("calls")
+        if self.breaker.allow_primary():
+            return True
+        self._count("breaker_routed")
+        return False
+
+    def _record_primary(self, kind: str, started_at: float, success: bool) -> None:
+        """主モデルの呼び出し結果をサーキットブレーカーに、成功時の応答時間を kind の分布に記録する"""
+        self.breaker.record(success)
+        if success:
+            self._latency(kind).record(time.monotonic() - started_at)
+
+    def _pick_winner(self, finished, pending, fallback, discard, errors: List[BaseException]):
+        """
+        完了した呼び出し (Future / Task) のうち成功したものがあれば、残りを捨ててそれを返す。
+        失敗したものの例外は errors に加え、成功したものがなければ None を返す。
+        """
+        for future in finished:
+            if future.exception() is None:
+                for other in pending | (finished - {future}):
+                    self._discard(other, discard)
+                if future is fallback:
+                    self._count("fallback_wins")
+                return future
+            errors.append(future.exception())
+        return None
+
+    def _call_primary(self, call, kind: str):
+        started_at = time.monotonic()
+        try:
+            result = call(self.primary_model)
+        except Exception:
+            self._record_primary(kind, started_at, False)
+            raise
+        self._record_primary(kind, started_at, True)
+        return result
+
+    def call(self, call, kind: str = "reply", discard=None):
+        """
+        call(model_name) -> 結果 を、ヘッジ・フォールバック付きで実行する。
+        discard を渡すと、使われなかった方の結果 (ストリームなど) の後片付けに使う。
+        """
+        if not self._start():
+            return call(self.fallback_model)
+
+        # span の記録先 (リクエストごとのコンテキスト) を実行スレッドに引き継ぐ
+        primary = self._executor.submit(contextvars.copy_context().run, self._call_primary, call, kind)
+        done, _ = wait([primary], timeout=self.hedge_delay(kind))
+        if done and primary.exception() is None:
+            return primary.result()
+
+        # 主モデルが遅い、または失敗した → 予備モデルにも送る
+        self._count("hedged")
+        fallback = self._executor.submit(contextvars.copy_context().run, call, self.fallback_model)
+        pending = {fallback} if done else {primary, fallback}
+        errors = [primary.exception()] if done else []
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = self._pick_winner(finished, pending, fallback, discard, errors)
+            if winner is not None:
+                return winner.result()
+        raise errors[-1]
+
+    async def _call_primary_async(self, call, kind: str):
+        started_at = time.monotonic()
+        try:
+            result = await call(self.primary_model)
+        except Exception:
+            self._record_primary(kind, started_at, False)
+            raise
+        self._record_primary(kind, started_at, True)
+        return result
+
+    async def call_async(self, call, kind: str = "reply", discard=None):
+        """call の非同期版 (call(model_name) はコルーチンを返す)。負けた方のタスクは実際にキャンセルされる"""
+        if not self._start():
+            return await call(self.fallback_model)
+
+        primary = asyncio.ensure_future(self._call_primary_async(call, kind))
+        done, _ = await asyncio.wait({primary}, timeout=self.hedge_delay(kind))
+        if done and primary.exception() is None:
+            return primary.result()
+
+        self._count("hedged")
+        fallback = asyncio.ensure_future(call(self.fallback_model))
+        pending = {fallback} if done else {primary, fallback}
+        errors = [primary.exception()] if done else []
+        while pending:
+            finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = self._pick_winner(finished, pending, fallback, discard, errors)
+            if winner is not None:
+                return winner.result()
+        raise errors[-1]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["hedge_delay_seconds"] = self.hedge_delay()
+        stats["breaker_open"] = self.breaker.is_open
+        return stats
+
+_chat_router = _HedgedRouter(_MODEL_MODEL_FOR_CHAT, _MODEL_MODEL_FOR_CHAT_FALLBACK)
+metrics.register_collector(_render_client_metrics)
+
+# --- レスポンス検査 ---
+_STOP_REASON = 1
+_SAFETY_REASON = 2
+
+def _check_prompt_feedback(res) -> None:
+    """候補が返っていない (プロンプトがブロックされた) 場合に例外を送出する"""
+    if not res.candidates:
+         reason = "Unknown"
+         if hasattr(res, 'prompt_feedback') and hasattr(res.prompt_feedback, 'block_reason'):
+             block_reason_val = res.prompt_feedback.block_reason
+             reason = block_reason_val.name if hasattr(block_reason_val, 'name') else str(block_reason_val)
+         print(f"Error: No candidates returned. Block Reason: {reason}")
+         if hasattr(res, 'prompt_feedback') and hasattr(res.prompt_feedback, 'safety_ratings'):
+             print(f"Safety Ratings (Prompt Feedback): {res.prompt_feedback.safety_ratings}")
+         raise ValueError(f"Gemini response blocked or empty. Reason: {reason}")
+
+def _check_finish_reason(candidate) -> None:
+    """STOP 以外の終了理由を記録し、セーフティによる停止なら例外を送出する"""
+    finish_reason_val = getattr(candidate, 'finish_reason', None)
+    # ストリーミング中の途中チャンクは finish_reason が未設定 (0) のため対象外
+    if not finish_reason_val or finish_reason_val == _STOP_REASON:
+        return
+    finish_reason_str = finish_reason_val.name if hasattr(finish_reason_val, 'name') else str(finish_reason_val)
+    print(f"Warning: Response finished with non-STOP reason: {finish_reason_str}")
+    if hasattr(candidate, 'safety_ratings'):
+        print(f"Safety Ratings (Candidate): {candidate.safety_ratings}")
+    if finish_reason_val == _SAFETY_REASON:
+         raise ValueError(f"Gemini response stopped due to safety settings. Reason code: {finish_reason_val}")
+
 # --- Gemini API 呼び出し ---
-def _call_gemini(system_prompt: str, contents: List[Union[str, Dict, File]], model_name: str, is_json_output: bool = False) -> str:
+def _response_text(res) -> str:
+    """レスポンスを検査してテキストを取り出す"""
+    _check_prompt_feedback(res)
+    candidate = res.candidates[0]
+    _check_finish_reason(candidate)
+
+    if res.text:
+        return res.text
+    elif candidate.content and candidate.content.parts:
+         text_parts = [part.text for part in candidate.content.parts if hasattr(part, 'text')]
+         if text_parts:
+             print("Warning: Response.text is empty, but found text in parts.")
+             return "\n".join(text_parts)
+         else:
+             print("Error: Response text and parts are empty.")
+             raise ValueError("Gemini response does not contain any text content.")
+    else:
+         print(f"Warning: Response text is empty. Finish reason: {getattr(candidate, 'finish_reason', 'N/A')}")
+         return ""
+
+def _gemini_error(e: Exception) -> RuntimeError:
+    """API 呼び出し時の例外を記録し、呼び出し側に送出する RuntimeError に変換する"""
+    print(f"An error occurred during Gemini API call:")
+    traceback.print_exc()
+    if hasattr(e, 'message'):
+        return RuntimeError(f"Gemini API Error: {e.message}")
+    else:
+        return RuntimeError(f"Gemini API Error: {e}")
+
+def _generation_config(is_json_output: bool) -> Optional[Dict]:
+    """_call_gemini に渡す生成設定 (JSON モードの場合のみ指定する)"""
+    return {"response_mime_type": "application/json"} if is_json_output else None
+
+def _call_gemini(system_prompt: str, contents: List[Union[str, Dict, "File"]], model_name: str, is_json_output: bool = False) -> str:
     """Gemini APIを呼び出す共通関数"""
     print(f"Calling Gemini model: {model_name}")
     try:
-        generation_config = {"response_mime_type": "application/json"} if is_json_output else None
-        model = genai.GenerativeModel(
-            model_name=model_name,
-            system_instruction=system_prompt
-        )
-        res = model.generate_content(
-            contents=contents,
-            request_options={"timeout": 600},
-            generation_config=generation_config
-        )
+        with span("gemini_generate"):
+            res = _client.generate(model_name, contents, system_prompt=system_prompt,
+                                   generation_config=_generation_config(is_json_output))
         print("Received response from Gemini.")
+        return _response_text(res)
+    except Exception as e:
+        raise _gemini_error(e) from e
 
-        if not res.candidates:
-             reason = "Unknown"
-             if hasattr(res, 'prompt_feedback') and hasattr(res.prompt_feedback, 'block_reason'):
-                 block_reason_val = res.prompt_feedback.block_reason
-                 reason = block_reason_val.name if hasattr(block_reason_val, 'name') else str(block_reason_val)
-             print(f"Error: No candidates returned. Block Reason: {reason}")
-             if hasattr(res, 'prompt_feedback') and hasattr(res.prompt_feedback, 'safety_ratings'):
-                 print(f"Safety Ratings (Prompt Feedback): {res.prompt_feedback.safety_ratings}")
-             raise ValueError(f"Gemini response blocked or empty. Reason: {reason}")
-
-        candidate = res.candidates[0]
-        finish_reason_val = getattr(candidate, 'finish_reason', None)
-        STOP_REASON = 1
-        is_stopped = (finish_reason_val == STOP_REASON)
-
-        if finish_reason_val is not None and not is_stopped:
-             finish_reason_str = finish_reason_val.name if hasattr(finish_reason_val, 'name') else str(finish_reason_val)
-             print(f"Warning: Response finished with non-STOP reason: {finish_reason_str}")
-             if hasattr(candidate, 'safety_ratings'):
-                 print(f"Safety Ratings (Candidate): {candidate.safety_ratings}")
-             SAFETY_REASON_VALUE = 2
-             if finish_reason_val == SAFETY_REASON_VALUE:
-                  raise ValueError(f"Gemini response stopped due to safety settings. Reason code: {finish_reason_val}")
-
-        if res.text:
-            return res.text
-        elif candidate.content and candidate.content.parts:
-             text_parts = [part.text for part in candidate.content.parts if hasattr(part, 'text')]
-             if text_parts:
-                 print("Warning: Response.text is empty, but found text in parts.")
-                 return "\n".join(text_parts)
-             else:
-                 print("Error: Response text and parts are empty.")
-                 raise ValueError("Gemini response does not contain any text content.")
-        else:
-             print(f"Warning: Response text is empty. Finish reason: {getattr(candidate, 'finish_reason', 'N/A')}")
-             return ""
-
+async def _call_gemini_async(system_prompt: str, contents: List[Union[str, Dict, "File"]], model_name: str, is_json_output: bool = False) -> str:
+    """_call_gemini の非同期版"""
+    print(f"Calling Gemini model (async): {model_name}")
+    try:
+        with span("gemini_generate"):
+            res = await _client.generate_async(model_name, contents, system_prompt=system_prompt,
+                                               generation_config=_generation_config(is_json_output))
+        print("Received response from Gemini.")
+        return _response_text(res)
     except Exception as e:
-        print(f"An error occurred during Gemini API call:")
-        traceback.print_exc()
-        if hasattr(e, 'message'):
-            raise RuntimeError(f"Gemini API Error: {e.message}") from e
-        else:
-            raise RuntimeError(f"Gemini API Error: {e}") from e
+        raise _gemini_error(e) from e
 
 
 # ---------- 外部公開関数 ----------
 
-def transcribe_audio(audio_path: str) -> str:
-    """音声ファイルをテキストに文字起こしする"""
-    print(f"Attempting to transcribe audio: {audio_path}")
+def _prepare_audio_part(audio: Union[str, bytes], mime_type: str) -> Tuple[Union[Dict, "File"], Optional["File"]]:
+    """
+    音声 (ファイルパスまたはメモリ上のバイト列) を contents に含められる形にする。
+    _INLINE_AUDIO_MAX_BYTES 以下ならインラインデータ、それより大きい場合のみ File API へアップロードする。
+    戻り値: (contents 用のパーツ, 後で削除が必要なアップロード済みファイル or None)
+    """
+    if isinstance(audio, (bytes, bytearray)):
+        if len(audio) <= _INLINE_AUDIO_MAX_BYTES:
+            print(f"Sending audio inline ({len(audio)} bytes)")
+            metrics.audio_bytes.inc(len(audio), mode="inline")
+            return {"mime_type": mime_type, "data": bytes(audio)}, None
+        # File API はパスしか受け付けないため、大きい場合だけ一時ファイルに書き出す
+        with tempfile.NamedTemporaryFile(delete=True) as tmp:
+            tmp.write(audio)
+            tmp.flush()
+            active_audio_file = _upload_and_wait_for_file(tmp.name, mime_type=mime_type)
+        return active_audio_file, active_audio_file
+
+    audio_size = os.path.getsize(audio)
+    if audio_size <= _INLINE_AUDIO_MAX_BYTES:
+        print(f"Sending audio inline ({audio_size} bytes)")
+        metrics.audio_bytes.inc(audio_size, mode="inline")
+        with open(audio, "rb") as f:
+            return {"mime_type": mime_type, "data": f.read()}, None
+    active_audio_file = _upload_and_wait_for_file(audio, mime_type=mime_type)
+    return active_audio_file, active_audio_file
+
+def _release_audio_part(active_audio_file: Optional["File"]) -> None:
+    """アップロード済みファイルがあれば削除する (完了は待たずに戻る)"""
+    if active_audio_file and hasattr(active_audio_file, 'name'):
+        _cleanup_executor.submit(_delete_file, active_audio_file.name)
+
+
+def _audio_label(audio: Union[str, bytes]) -> str:
+    """ログ用に音声の出どころを表す文字列"""
+    return f"<{len(audio)} bytes in memory>" if isinstance(audio, (bytes, bytearray)) else audio
+
+def _transcription_text(response) -> str:
+    """文字起こしのレスポンスからテキストを取り出す"""
+    transcribed_text = response.text
+    print(f"Successfully transcribed audio: {transcribed_text[:50]}...")
+    return transcribed_text
+
+def _transcription_error(e: Exception) -> RuntimeError:
+    """文字起こし中の例外を記録し、呼び出し側に送出する RuntimeError に変換する"""
+    print(f"Error transcribing audio: {e}")
+    traceback.print_exc()
+    return RuntimeError(f"音声の文字起こしに失敗しました: {e}")
+
+def transcribe_audio(audio: Union[str, bytes], mime_type: str = "audio/webm") -> str:
+    """音声 (ファイルパスまたはバイト列) をテキストに文字起こしする"""
+    print(f"Attempting to transcribe audio: {_audio_label(audio)}")
     active_audio_file = None
     try:
-        active_audio_file = _upload_and_wait_for_file(audio_path)
-        model = genai.GenerativeModel(model_name=_MODEL_MODEL_FOR_TRANSCRIPTION)
-        response = model.generate_content([active_audio_file])
-        transcribed_text = response.text
-        print(f"Successfully transcribed audio: {transcribed_text[:50]}...")
-        return transcribed_text
+        with span("transcribe"):
+            audio_part, active_audio_file = _prepare_audio_part(audio, mime_type)
+            response = _client.generate(_MODEL_MODEL_FOR_TRANSCRIPTION, [audio_part])
+        return _transcription_text(response)
     except Exception as e:
-        print(f"Error transcribing audio: {e}")
-        traceback.print_exc()
-        raise RuntimeError(f"音声の文字起こしに失敗しました: {e}")
+        raise _transcription_error(e) from e
     finally:
-        if active_audio_file and hasattr(active_audio_file, 'name'):
-            try:
-                print(f"Attempting to delete file: {active_audio_file.name}")
-                genai.delete_file(active_audio_file.name)
-                print(f"Successfully deleted file: {active_audio_file.name}")
-            except Exception as delete_error:
-                print(f"Warning: Failed to delete uploaded file {active_audio_file.name}: {delete_error}")
+        _release_audio_part(active_audio_file)
+
+
+async def transcribe_audio_async(audio: Union[str, bytes], mime_type: str = "audio/webm") -> str:
+    """transcribe_audio の非同期版 (ファイル読み込み・アップロードはスレッドで行う)"""
+    print(f"Attempting to transcribe audio (async): {_audio_label(audio)}")
+    active_audio_file = None
+    try:
+        with span("transcribe"):
+            audio_part, active_audio_file = await asyncio.to_thread(_prepare_audio_part, audio, mime_type)
+            response = await _client.generate_async(_MODEL_MODEL_FOR_TRANSCRIPTION, [audio_part])
+        return _transcription_text(response)
+    except Exception as e:
+        raise _transcription_error(e) from e
+    finally:
+        _release_audio_part(active_audio_file)
+
+
+def _join_transcriptions(transcriptions: List[str]) -> str:
+    """区間ごとの文字起こしを元の順序でつなぐ"""
+    return "\n".join(text.strip() for text in transcriptions if text and text.strip())
+
+def transcribe_audio_segments(segments: List[Union[str, bytes]], mime_type: str = "audio/wav") -> str:
+    """
+    無音位置で分割した長い録音の各区間を並列に文字起こしし、元の順序でつないで返す。
+    所要時間は区間数 / _TRANSCRIBE_WORKERS 回分の呼び出し程度になる。
+    """
+    print(f"Transcribing {len(segments)} audio segments with up to {_TRANSCRIBE_WORKERS} concurrent calls.")
+    with ThreadPoolExecutor(max_workers=_TRANSCRIBE_WORKERS, thread_name_prefix="transcribe") as executor:
+        futures = [executor.submit(contextvars.copy_context().run, transcribe_audio, segment, mime_type) for segment in segments]
+        transcriptions = [future.result() for future in futures] # 結果は元の順序を保つ
+    return _join_transcriptions(transcriptions)
+
+async def transcribe_audio_segments_async(segments: List[Union[str, bytes]], mime_type: str = "audio/wav") -> str:
+    """transcribe_audio_segments の非同期版 (同時実行数は _TRANSCRIBE_WORKERS まで)"""
+    print(f"Transcribing {len(segments)} audio segments with up to {_TRANSCRIBE_WORKERS} concurrent calls.")
+    semaphore = asyncio.Semaphore(_TRANSCRIBE_WORKERS)
+
+    async def transcribe(segment: Union[str, bytes]) -> str:
+        async with semaphore:
+            return await transcribe_audio_async(segment, mime_type)
+
+    transcriptions = await asyncio.gather(*(transcribe(segment) for segment in segments)) # 結果は元の順序を保つ
+    return _join_transcriptions(transcriptions)
+
+
+def _build_chat_contents(
+    conversation_history: List[Dict[str, str]],
+    user_text: Optional[str],
+    summary: Optional[str] = None
+) -> List[Dict]:
+    """
+    会話履歴と最新のユーザー入力から Gemini に渡す contents を組み立てる (user_text が None なら履歴のみ)。
+    summary があれば、要約済みの古い会話として先頭に入れる。
+    """
+    contents = []
+    if summary:
+        contents.append({"role": "user", "parts": [{"text": f"（ここまでの会話の要約）\n{summary}"}]})
+        contents.append({"role": "model", "parts": [{"text": "うん、覚えてるよ。続きを聞かせて！"}]})
+    for message in conversation_history:
+        role = "user" if message["role"] == "user" else "model"
+        if "content" in message and message["content"]:
+            contents.append({"role": role, "parts": [{"text": message["content"]}]})
+
+    # 最新のユーザー入力を追加
+    if user_text is not None:
+        contents.append({"role": "user", "parts": [{"text": user_text}]})
+    return contents
+
+def _chat_contents(
+    conversation_history: List[Dict[str, str]],
+    user_text: str,
+    summary: Optional[str] = None
+) -> List[Dict]:
+    """chat_with_ai (とストリーミング版) の入力を検査し、contents を組み立てる"""
+    if not user_text:
+        raise ValueError("user_text must be provided.")
+    return _build_chat_contents(conversation_history, user_text, summary)
+
+def _listen_and_reply_contents(
+    conversation_history: List[Dict[str, str]],
+    audio_part: Union[Dict, "File"],
+    summary: Optional[str] = None
+) -> List[Dict]:
+    """会話履歴の後に、最新のユーザー発言として音声を置いた contents を組み立てる"""
+    contents = _build_chat_contents(conversation_history, None, summary)
+    contents.append({"role": "user", "parts": [audio_part]})
+    return contents
+
+def _chat_error_reply(e: Exception) -> str:
+    """応答生成中の例外を記録し、代わりに返す定型の謝罪文を返す"""
+    print(f"Failed to get chat response from Gemini: {e}")
+    traceback.print_exc()
+    return "ごめん、応答を考えるときにエラーが起きちゃったみたい…"
+
+def _route_chat(call, kind: str = "reply", discard=None):
+    """call(model_name) をチャットモデルで実行する (有効ならヘッジ・サーキットブレーカー付き)"""
+    if _CHAT_HEDGING_ENABLED:
+        return _chat_router.call(call, kind=kind, discard=discard)
+    return call(_MODEL_MODEL_FOR_CHAT)
 
+async def _route_chat_async(call, kind: str = "reply", discard=None):
+    """_route_chat の非同期版 (call(model_name) はコルーチンを返す)"""
+    if _CHAT_HEDGING_ENABLED:
+        return await _chat_router.call_async(call, kind=kind, discard=discard)
+    return await call(_MODEL_MODEL_FOR_CHAT)
 
 def chat_with_ai(
     conversation_history: List[Dict[str, str]],
-    user_text: str # user_audio_path は app.py で処理されるため削除
+    user_text: str, # user_audio_path は app.py で処理されるため削除
+    summary: Optional[str] = None,
+    raise_errors: bool = False
 ) -> str:
     """
     テキスト入力と会話履歴を受け取り、AI（友達）としての応答を生成する。
+    summary には会話履歴より前の部分の要約を渡せる。
+    raise_errors=True の場合、失敗すると定型の謝罪文を返さずに例外を送出する (会話履歴に保存しないため)。
     """
     print("Processing chat request...")
-    if not user_text:
-        raise ValueError("user_text must be provided.")
+    contents = _chat_contents(conversation_history, user_text, summary)
+    try:
+        return _route_chat(lambda model_name: _call_gemini(_CHAT_SYSTEM_PROMPT, contents, model_name=model_name))
 
+    except Exception as e:
+        if raise_errors:
+            raise
+        return _chat_error_reply(e)
+
+async def chat_with_ai_async(
+    conversation_history: List[Dict[str, str]],
+    user_text: str,
+    summary: Optional[str] = None,
+    raise_errors: bool = False
+) -> str:
+    """chat_with_ai の非同期版"""
+    print("Processing chat request (async)...")
+    contents = _chat_contents(conversation_history, user_text, summary)
     try:
-        contents = []
-        for message in conversation_history:
-            role = "user" if message["role"] == "user" else "model"
-            if "content" in message and message["content"]:
-                contents.append({"role": role, "parts": [{"text": message["content"]}]})
+        return await _route_chat_async(lambda model_name: _call_gemini_async(_CHAT_SYSTEM_PROMPT, contents, model_name=model_name))
 
-        # 最新のユーザー入力を追加
-        contents.append({"role": "user", "parts": [{"text": user_text}]})
+    except Exception as e:
+        if raise_errors:
+            raise
+        return _chat_error_reply(e)
+
+def _parse_listen_and_reply(raw_response: str) -> Tuple[str, str]:
+    """listen_and_reply の構造化出力を解析する。不正な場合は例外を送出する"""
+    data = json.loads(raw_response)
+    transcription = data["transcription"]
+    reply = data["reply"]
+    if not isinstance(transcription, str) or not isinstance(reply, str) or not transcription.strip() or not reply.strip():
+        raise ValueError("transcription or reply is empty.")
+    return transcription, reply
+
+def _log_listen_and_reply_fallback(e: Exception) -> None:
+    print(f"Listen-and-reply failed, falling back to transcribe + chat: {e}")
+    traceback.print_exc()
+
+def listen_and_reply(
+    conversation_history: List[Dict[str, str]],
+    audio: Union[str, bytes],
+    mime_type: str = "audio/webm",
+    summary: Optional[str] = None
+) -> Tuple[str, str]:
+    """
+    音声と会話履歴を 1 回の呼び出しでチャットモデルに渡し、文字起こしと応答を同時に得る。
+    構造化出力の解析に失敗した場合は transcribe_audio → chat_with_ai の 2 段階処理にフォールバックする。
+    フォールバックの応答生成にも失敗した場合は (定型の謝罪文を返さずに) 例外を送出する。
+    戻り値: (文字起こし, AIの応答) のタプル
+    """
+    print("Processing listen-and-reply request...")
+    active_audio_file = None
+    try:
+        audio_part, active_audio_file = _prepare_audio_part(audio, mime_type)
+        contents = _listen_and_reply_contents(conversation_history, audio_part, summary)
 
-        ai_reply = _call_gemini(_CHAT_SYSTEM_PROMPT, contents, model_name=_MODEL_MODEL_FOR_CHAT, is_json_output=False)
-        return ai_reply
+        raw_response = _route_chat(lambda model_name: _call_gemini(
+            _LISTEN_AND_REPLY_SYSTEM_PROMPT, contents, model_name=model_name, is_json_output=True
+        ), kind="listen")
+        return _parse_listen_and_reply(raw_response)
+    except Exception as e:
+        _log_listen_and_reply_fallback(e)
+    finally:
+        _release_audio_part(active_audio_file)
 
+    transcription = transcribe_audio(audio, mime_type=mime_type)
+    return transcription, chat_with_ai(conversation_history, user_text=transcription, summary=summary, raise_errors=True)
+
+async def listen_and_reply_async(
+    conversation_history: List[Dict[str, str]],
+    audio: Union[str, bytes],
+    mime_type: str = "audio/webm",
+    summary: Optional[str] = None
+) -> Tuple[str, str]:
+    """listen_and_reply の非同期版"""
+    print("Processing listen-and-reply request (async)...")
+    active_audio_file = None
+    try:
+        audio_part, active_audio_file = await asyncio.to_thread(_prepare_audio_part, audio, mime_type)
+        contents = _listen_and_reply_contents(conversation_history, audio_part, summary)
+
+        raw_response = await _route_chat_async(lambda model_name: _call_gemini_async(
+            _LISTEN_AND_REPLY_SYSTEM_PROMPT, contents, model_name=model_name, is_json_output=True
+        ), kind="listen")
+        return _parse_listen_and_reply(raw_response)
     except Exception as e:
-        print(f"Failed to get chat response from Gemini: {e}")
-        traceback.print_exc()
-        return "ごめん、応答を考えるときにエラーが起きちゃったみたい…"
+        _log_listen_and_reply_fallback(e)
+    finally:
+        _release_audio_part(active_audio_file)
 
-def generate_diary_from_conversation(
+    transcription = await transcribe_audio_async(audio, mime_type=mime_type)
+    return transcription, await chat_with_ai_async(conversation_history, user_text=transcription, summary=summary,
+                                                   raise_errors=True)
+
+def _chat_stream_texts(model_name: str, contents: List[Dict]) -> Iterator[str]:
+    """チャットモデルのストリームから、テキストのあるチャンクだけを返す"""
+    stream = _client.generate_stream(model_name, contents, system_prompt=_CHAT_SYSTEM_PROMPT)
+    try:
+        for chunk in stream:
+            text = _chunk_text(chunk)
+            if text:
+                yield text
+    finally:
+        stream.close()
+
+def _open_chat_stream(contents: List[Dict], model_name: str) -> Tuple[str, Iterator[str]]:
+    """ストリームを開始して最初のテキストまで読み、(最初のテキスト, 残りのテキスト) を返す"""
+    texts = _chat_stream_texts(model_name, contents)
+    try:
+        return next(texts, ""), texts
+    except BaseException:
+        texts.close()
+        raise
+
+def _stream_error(e: Exception) -> RuntimeError:
+    """ストリーミング中の例外を記録し、呼び出し側に送出する RuntimeError に変換する"""
+    print(f"An error occurred during streaming Gemini API call: {e}")
+    traceback.print_exc()
+    return RuntimeError(f"Gemini API Error: {e}")
+
+def chat_with_ai_stream(
+    conversation_history: List[Dict[str, str]],
+    user_text: str,
+    summary: Optional[str] = None
+) -> Iterator[str]:
+    """
+    chat_with_ai のストリーミング版。生成されたテキストを届いた順に返す。
+    ブロック・セーフティ停止時は RuntimeError を送出する (途中まで返した後の場合もある)。
+    """
+    print("Processing streaming chat request...")
+    contents = _chat_contents(conversation_history, user_text, summary)
+    try:
+        # 最初のチャンクが届くまでをヘッジ・サーキットブレーカーの対象にする (届いた後はモデルを切り替えられない)
+        first_text, texts = _route_chat(lambda model_name: _open_chat_stream(contents, model_name),
+                                        kind="stream", discard=lambda opened: opened[1].close())
+        try:
+            if first_text:
+                yield first_text
+            yield from texts
+        finally:
+            texts.close()
+        print("Finished streaming response from Gemini.")
+    except Exception as e:
+        raise _stream_error(e) from e
+
+def _chunk_text(chunk) -> str:
+    """ストリーミングの 1 チャンクを検査してテキストを取り出す"""
+    _check_prompt_feedback(chunk)
+    candidate = chunk.candidates[0]
+    _check_finish_reason(candidate)
+    if candidate.content and candidate.content.parts:
+        return "".join(part.text for part in candidate.content.parts if hasattr(part, 'text'))
+    return ""
+
+async def _chat_stream_texts_async(model_name: str, contents: List[Dict]) -> AsyncIterator[str]:
+    """_chat_stream_texts の非同期版"""
+    stream = _client.generate_stream_async(model_name, contents, system_prompt=_CHAT_SYSTEM_PROMPT)
+    try:
+        async for chunk in stream:
+            text = _chunk_text(chunk)
+            if text:
+                yield text
+    finally:
+        await stream.aclose()
+
+async def _open_chat_stream_async(contents: List[Dict], model_name: str) -> Tuple[str, AsyncIterator[str]]:
+    """_open_chat_stream の非同期版"""
+    texts = _chat_stream_texts_async(model_name, contents)
+    try:
+        try:
+            return await texts.__anext__(), texts
+        except StopAsyncIteration:
+            return "", texts
+    except BaseException:
+        await texts.aclose()
+        raise
+
+async def chat_with_ai_stream_async(
+    conversation_history: List[Dict[str, str]],
+    user_text: str,
+    summary: Optional[str] = None
+) -> AsyncIterator[str]:
+    """chat_with_ai_stream の非同期版"""
+    print("Processing streaming chat request (async)...")
+    contents = _chat_contents(conversation_history, user_text, summary)
+    try:
+        first_text, texts = await _route_chat_async(lambda model_name: _open_chat_stream_async(contents, model_name),
+                                                    kind="stream", discard=lambda opened: asyncio.ensure_future(opened[1].aclose()))
+        try:
+            if first_text:
+                yield first_text
+            async for text in texts:
+                yield text
+        finally:
+            await texts.aclose()
+        print("Finished streaming response from Gemini.")
+    except Exception as e:
+        raise _stream_error(e) from e
+
+def _summary_prompt(previous_summary: Optional[str], conversation_history: List[Dict[str, str]]) -> str:
+    """要約の更新に渡すプロンプトを組み立てる"""
+    lines = [
+        f"{msg['role']}: {msg['content']}"
+        for msg in conversation_history
+        if msg.get('content')
+    ]
+    return f"## これまでの要約\n{previous_summary or '(なし)'}\n\n## その後の会話\n" + "\n\n".join(lines)
+
+def summarize_conversation(
+    previous_summary: Optional[str],
     conversation_history: List[Dict[str, str]]
+) -> str:
+    """
+    これまでの要約と、その後の会話をまとめた新しい要約を生成する。
+    長い会話のプロンプトサイズを一定に保つために使う。失敗時は例外を送出する。
+    """
+    print("Processing conversation summary request...")
+    prompt = _summary_prompt(previous_summary, conversation_history)
+    return _call_gemini(_SUMMARY_SYSTEM_PROMPT, [prompt], model_name=_MODEL_MODEL_FOR_CHAT).strip()
+
+async def summarize_conversation_async(
+    previous_summary: Optional[str],
+    conversation_history: List[Dict[str, str]]
+) -> str:
+    """summarize_conversation の非同期版"""
+    print("Processing conversation summary request (async)...")
+    prompt = _summary_prompt(previous_summary, conversation_history)
+    return (await _call_gemini_async(_SUMMARY_SYSTEM_PROMPT, [prompt], model_name=_MODEL_MODEL_FOR_CHAT)).strip()
+
+def _split_into_chunks(lines: List[str], max_tokens: int) -> List[str]:
+    """発言の区切りを保ったまま、見積もりトークン数が max_tokens 程度になるよう分割する"""
+    chunks, current, current_tokens = [], [], 0
+    for line in lines:
+        line_tokens = estimate_tokens(line)
+        if current and current_tokens + line_tokens > max_tokens:
+            chunks.append("\n\n".join(current))
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += line_tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+def _diary_chunks(relevant_history: List[str]) -> List[str]:
+    """map フェーズで要約するチャンクに分ける"""
+    chunks = _split_into_chunks(relevant_history, _DIARY_CHUNK_TOKENS)
+    print(f"Conversation is long; summarizing {len(chunks)} chunks with up to {_DIARY_MAP_WORKERS} concurrent calls.")
+    return chunks
+
+def _summarize_chunk(chunk: str) -> str:
+    """会話の 1 チャンクを要約する (map フェーズ)"""
+    return _call_gemini(_DIARY_CHUNK_SYSTEM_PROMPT, [chunk], model_name=_MODEL_MODEL_FOR_DIARY)
+
+async def _summarize_chunk_async(chunk: str) -> str:
+    """_summarize_chunk の非同期版"""
+    return await _call_gemini_async(_DIARY_CHUNK_SYSTEM_PROMPT, [chunk], model_name=_MODEL_MODEL_FOR_DIARY)
+
+def _map_conversation(relevant_history: List[str]) -> str:
+    """長い会話をチャンクに分けて並列に要約し、日記生成に渡す 1 つのテキストにまとめる"""
+    chunks = _diary_chunks(relevant_history)
+    with ThreadPoolExecutor(max_workers=_DIARY_MAP_WORKERS, thread_name_prefix="diary-map") as executor:
+        futures = [executor.submit(contextvars.copy_context().run, _summarize_chunk, chunk) for chunk in chunks]
+        summaries = [future.result() for future in futures] # 結果は元の順序を保つ
+    return _join_chunk_summaries(summaries)
+
+async def _map_conversation_async(relevant_history: List[str]) -> str:
+    """_map_conversation の非同期版 (同時実行数は _DIARY_MAP_WORKERS まで)"""
+    chunks = _diary_chunks(relevant_history)
+    semaphore = asyncio.Semaphore(_DIARY_MAP_WORKERS)
+
+    async def summarize(chunk: str) -> str:
+        async with semaphore:
+            return await _summarize_chunk_async(chunk)
+
+    summaries = await asyncio.gather(*(summarize(chunk) for chunk in chunks)) # 結果は元の順序を保つ
+    return _join_chunk_summaries(summaries)
+
+def _join_chunk_summaries(summaries: List[str]) -> str:
+    """チャンクごとの要約を、日記生成に渡す 1 つのテキストにまとめる"""
+    parts = [f"### パート {i} / {len(summaries)}\n{summary}" for i, summary in enumerate(summaries, start=1)]
+    return "以下は長い会話を時系列順に区切って要約したものです。全体を一つの会話として扱ってください。\n\n" + "\n\n".join(parts)
+
+# 日記生成に失敗した場合のデフォルト値
+_DEFAULT_DIARY = "## 日記の生成に失敗しました\n\n会話の履歴が空か、AIが内容を解析できませんでした。"
+_DEFAULT_SCORE = 0.0
+_DEFAULT_HIGHLIGHT = "内容の要約に失敗"
+
+def _diary_relevant_history(conversation_history: List[Dict[str, str]]) -> List[str]:
+    """日記生成に使う発言を "role: content" 形式の文字列にする"""
+    return [
+        f"{msg['role']}: {msg.get('content', '[記録なし]')}"
+        for msg in conversation_history
+        if msg['role'] in ['user', 'ai'] and msg.get('content')
+    ]
+
+def _diary_conversation_text(relevant_history: List[str]) -> Optional[str]:
+    """日記生成にそのまま渡す会話テキスト。長すぎて先に map フェーズが必要な場合は None を返す"""
+    full_conversation = "\n\n".join(relevant_history)
+    if estimate_tokens(full_conversation) > _DIARY_MAP_REDUCE_THRESHOLD_TOKENS:
+        return None
+    return full_conversation
+
+def _reduce_diary(full_conversation: str) -> str:
+    """会話 (または map フェーズの要約) から日記を生成する (reduce フェーズ)。戻り値は JSON 文字列"""
+    return _call_gemini(_DIARY_SYSTEM_PROMPT, [full_conversation], model_name=_MODEL_MODEL_FOR_DIARY, is_json_output=True)
+
+async def _reduce_diary_async(full_conversation: str) -> str:
+    """_reduce_diary の非同期版"""
+    return await _call_gemini_async(_DIARY_SYSTEM_PROMPT, [full_conversation], model_name=_MODEL_MODEL_FOR_DIARY, is_json_output=True)
+
+def _parse_diary_response(raw_response: str) -> Tuple[str, Optional[float], Optional[str]]:
+    """日記生成の JSON レスポンスをパースする"""
+    try:
+        data = json.loads(raw_response)
+        
+        diary_content = data.get("diary_content", _DEFAULT_DIARY)
+        sentiment_score = data.get("sentiment_score")
+        highlight_events = data.get("highlight_events", _DEFAULT_HIGHLIGHT)
+
+        # スコアの型をfloatに統一
+        score = float(sentiment_score) if isinstance(sentiment_score, (int, float)) else _DEFAULT_SCORE
+
+        return diary_content, score, highlight_events
+
+    except (json.JSONDecodeError, KeyError, TypeError, AttributeError) as e:
+        print(f"Failed to parse JSON response from Gemini: {e}")
+        print(f"Raw response was: {raw_response}")
+        # パースに失敗した場合、生のレスポンスを日記の内容として返し、その他はデフォルト値を使用
+        return raw_response, _DEFAULT_SCORE, _DEFAULT_HIGHLIGHT
+
+def _diary_error_result(e: Exception) -> Tuple[str, Optional[float], Optional[str]]:
+    """日記生成中の例外を記録し、エラー内容を本文にした結果を返す"""
+    print(f"Failed to generate diary from Gemini: {e}")
+    traceback.print_exc()
+    error_message = f"## 日記の生成に失敗しました\n\nエラーが発生しました。\n```\n{e}\n```"
+    return error_message, _DEFAULT_SCORE, _DEFAULT_HIGHLIGHT
+
+def _finish_diary(raw_response: str, timings: Dict[str, float], started_at: float, reduce_started_at: float) -> Tuple[str, Optional[float], Optional[str]]:
+    """reduce フェーズと全体の所要時間を timings に記録し、日記生成のレスポンスをパースする"""
+    timings["reduce"] = time.perf_counter() - reduce_started_at
+    timings["total"] = time.perf_counter() - started_at
+    print(f"Diary generation timings: {', '.join(f'{k}={v:.2f}s' for k, v in timings.items())}")
+    return _parse_diary_response(raw_response)
+
+def generate_diary_from_conversation(
+    conversation_history: List[Dict[str, str]],
+    timings: Optional[Dict[str, float]] = None,
+    raise_errors: bool = False
 ) -> Tuple[str, Optional[float], Optional[str]]:
     """
     会話履歴全体を受け取り、構造化された日記、感情スコア、ハイライトを生成する。
+    会話が長い場合はチャンクごとの要約 (map) を並列に行ってから日記を生成 (reduce) する。
+    timings に辞書を渡すと、各段階の所要秒数 (map / reduce / total) が書き込まれる。
+    raise_errors=True の場合、生成に失敗するとエラー内容を本文にした結果を返さずに例外を送出する。
     戻り値: (日記コンテンツ, 感情スコア, ハイライト) のタプル
     """
     print("Processing diary generation request...")
-    # エラー時のデフォルト値
-    default_diary = "## 日記の生成に失敗しました\n\n会話の履歴が空か、AIが内容を解析できませんでした。"
-    default_score = 0.0
-    default_highlight = "内容の要約に失敗"
-
     try:
-        relevant_history = [
-            f"{msg['role']}: {msg.get('content', '[記録なし]')}"
-            for msg in conversation_history
-            if msg['role'] in ['user', 'ai'] and msg.get('content')
-        ]
+        relevant_history = _diary_relevant_history(conversation_history)
         if not relevant_history:
-            return default_diary, default_score, default_highlight
+            return _DEFAULT_DIARY, _DEFAULT_SCORE, _DEFAULT_HIGHLIGHT
 
-        full_conversation = "\n\n".join(relevant_history)
-        contents = [full_conversation]
+        timings = timings if timings is not None else {}
+        started_at = time.perf_counter()
+        full_conversation = _diary_conversation_text(relevant_history)
+        if full_conversation is None:
+            full_conversation = _map_conversation(relevant_history)
+            timings["map"] = time.perf_counter() - started_at
 
         # Gemini API 呼び出し (日記生成用プロンプトとJSONモードを使用)
-        raw_response = _call_gemini(_DIARY_SYSTEM_PROMPT, contents, model_name=_MODEL_MODEL_FOR_DIARY, is_json_output=True)
+        reduce_started_at = time.perf_counter()
+        raw_response = _reduce_diary(full_conversation)
+        return _finish_diary(raw_response, timings, started_at, reduce_started_at)
 
-        # JSONレスポンスをパース
-        try:
-            data = json.loads(raw_response)
-            
-            diary_content = data.get("diary_content", default_diary)
-            sentiment_score = data.get("sentiment_score")
-            highlight_events = data.get("highlight_events", default_highlight)
+    except Exception as e:
+        if raise_errors:
+            raise
+        return _diary_error_result(e)
 
-            # スコアの型をfloatに統一
-            score = float(sentiment_score) if isinstance(sentiment_score, (int, float)) else default_score
+async def generate_diary_from_conversation_async(
+    conversation_history: List[Dict[str, str]],
+    timings: Optional[Dict[str, float]] = None,
+    raise_errors: bool = False
+) -> Tuple[str, Optional[float], Optional[str]]:
+    """generate_diary_from_conversation の非同期版"""
+    print("Processing diary generation request (async)...")
+    try:
+        relevant_history = _diary_relevant_history(conversation_history)
+        if not relevant_history:
+            return _DEFAULT_DIARY, _DEFAULT_SCORE, _DEFAULT_HIGHLIGHT
 
-            return diary_content, score, highlight_events
+        timings = timings if timings is not None else {}
+        started_at = time.perf_counter()
+        full_conversation = _diary_conversation_text(relevant_history)
+        if full_conversation is None:
+            full_conversation = await _map_conversation_async(relevant_history)
+            timings["map"] = time.perf_counter() - started_at
 
-        except (json.JSONDecodeError, KeyError, TypeError) as e:
-            print(f"Failed to parse JSON response from Gemini: {e}")
-            print(f"Raw response was: {raw_response}")
-            # パースに失敗した場合、生のレスポンスを日記の内容として返し、その他はデフォルト値を使用
-            return raw_response, default_score, default_highlight
+        reduce_started_at = time.perf_counter()
+        raw_response = await _reduce_diary_async(full_conversation)
+        return _finish_diary(raw_response, timings, started_at, reduce_started_at)
 
     except Exception as e:
-        print(f"Failed to generate diary from Gemini: {e}")
-        traceback.print_exc()
-        error_message = f"## 日記の生成に失敗しました\n\nエラーが発生しました。\n```\n{e}\n```"
-        return error_message, default_score, default_highlight
\ No newline at end of file
+        if raise_errors:
+            raise
+        return _diary_error_result(e)
+
+def diary_analysis_version() -> str:
+    """再分析に使うプロンプトとモデルの組み合わせを表す文字列 (変更されると値が変わる)"""
+    source = "\n".join([_MODEL_MODEL_FOR_DIARY, _DIARY_SYSTEM_PROMPT, _DIARY_ANALYSIS_SYSTEM_PROMPT])
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()[:16]
+
+def _parse_diary_analysis(raw_response: str) -> Tuple[float, str]:
+    """再分析の JSON レスポンスから (感情スコア, ハイライト) を取り出す。不正な場合は例外を送出する"""
+    data = json.loads(raw_response)
+    sentiment_score = data["sentiment_score"]
+    highlight_events = data["highlight_events"]
+    if isinstance(sentiment_score, bool) or not isinstance(sentiment_score, (int, float)):
+        raise ValueError(f"sentiment_score is not a number: {sentiment_score!r}")
+    if not isinstance(highlight_events, str) or not highlight_events.strip():
+        raise ValueError("highlight_events is empty.")
+    return float(sentiment_score), highlight_events.strip()
+
+def analyze_diary(conversation_history: Optional[List[Dict[str, str]]], diary_content: Optional[str]) -> Tuple[float, str]:
+    """
+    保存済みの日記の感情スコアとハイライトを求め直す (reanalyze.py のバッチ再分析用)。
+    会話履歴があれば日記生成と同じプロンプトで会話から、なければ日記本文から求める。
+    generate_diary_from_conversation と異なり、失敗した場合は既定値を返さずに例外を送出する。
+    戻り値: (感情スコア, ハイライト) のタプル
+    """
+    relevant_history = _diary_relevant_history(conversation_history or [])
+    if relevant_history:
+        full_conversation = _diary_conversation_text(relevant_history)
+        if full_conversation is None:
+            full_conversation = _map_conversation(relevant_history)
+        raw_response = _reduce_diary(full_conversation)
+    elif diary_content:
+        raw_response = _call_gemini(_DIARY_ANALYSIS_SYSTEM_PROMPT, [diary_content], model_name=_MODEL_MODEL_FOR_DIARY, is_json_output=True)
+    else:
+        raise ValueError("Neither conversation history nor diary content is available.")
+    return _parse_diary_analysis(raw_response)
@@ -0,0 +1,137 @@
+# backend/idempotency.py
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+def conversation_key(conversation_history: List[Dict[str, str]]) -> str:
+    """
+    会話履歴を正規化してハッシュ化したキーを返す。
+    日記生成に使われない発言 (role が user / ai 以外、内容が空) と前後・連続する空白の違いは無視する。
+    """
+    normalized = [
+        [msg['role'], " ".join(str(msg['content']).split())]
+        for msg in conversation_history
+        if isinstance(msg, dict) and msg.get('role') in ('user', 'ai') and msg.get('content')
+    ]
+    raw = json.dumps(normalized, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class RequestDeduplicator:
+    """
+    同じキーのリクエストを 1 回の処理にまとめる。
+    - 処理中のキーに来た重複リクエストは、同じ Future の完了を待って結果を共有する
+    - 完了した結果は件数上限 (LRU) と有効期限 (TTL) 付きのメモリキャッシュから返す
+    - メモリにない場合は load_persisted で永続化済みの結果を探す
+    失敗した処理の結果はキャッシュしない (待っていたリクエストには同じ例外を送出する)。
+    """
+
+    def __init__(self, max_entries: int = 256, ttl_seconds: float = 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._cache: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._in_flight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def _get_cached(self, key: str) -> Optional[Any]:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        stored_at, result = entry
+        if time.monotonic() - stored_at > self.ttl_seconds:
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return result
+
+    def _put_cached(self, key: str, result: Any) -> None:
+        self._cache[key] = (time.monotonic(), result)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def run(
+        self,
+        key: str,
+        fn: Callable[[], Any],
+        load_persisted: Optional[Callable[[str], Optional[Any]]] = None
+    ) -> Tuple[Any, bool]:
+        """
+        key に対応する結果を返す。戻り値: (結果, 再利用した結果なら True)
+        """
+        with self._lock:
+            cached = self._get_cached(key)
+            if cached is not None:
+                return cached, True
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._in_flight[key] = future
+
+        if not is_leader:
+            # 先行するリクエストの完了を待つ (例外もそのまま伝わる)
+            return future.result(), True
+
+        try:
+            result = load_persisted(key) if load_persisted else None
+            replayed = result is not None
+            if result is None:
+                result = fn()
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._put_cached(key, result)
+            del self._in_flight[key]
+        future.set_result(result)
+        return result, replayed
+
+    async def run_async(
+        self,
+        key: str,
+        fn: Callable[[], Awaitable[Any]],
+        load_persisted: Optional[Callable[[str], Awaitable[Optional[Any]]]] = None
+    ) -> Tuple[Any, bool]:
+        """
+        run の asyncio 版。fn と load_persisted はコルーチン関数。
+        処理中のキーは同期版と共有するため、WSGI と ASGI のどちらから来た重複もまとめられる。
+        """
+        with self._lock:
+            cached = self._get_cached(key)
+            if cached is not None:
+                return cached, True
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._in_flight[key] = future
+
+        if not is_leader:
+            return await asyncio.wrap_future(future), True
+
+        try:
+            result = await load_persisted(key) if load_persisted else None
+            replayed = result is not None
+            if result is None:
+                result = await fn()
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._put_cached(key, result)
+            del self._in_flight[key]
+        future.set_result(result)
+        return result, replayed
@@ -0,0 +1,202 @@
+# backend/metrics.py
+"""
+処理段階ごとの所要時間とカウンタを集計し、Prometheus のテキスト形式で出力する。
+
+    from metrics import span
+    with span("gemini_generate"):
+        ...
+
+span で計測した時間は talklog_stage_duration_seconds{stage=...} のヒストグラムに記録され、
+リクエスト中であれば Server-Timing ヘッダー用にも記録される (SERVER_TIMING_HEADER=1 のとき出力)。
+集計はプロセス内のメモリで行うため、複数プロセスで動かす場合はプロセスごとの値になる。
+"""
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# レスポンスに Server-Timing ヘッダーを付けるか
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_HEADER", "0") == "1"
+
+# 秒数のヒストグラムの区切り (Gemini の呼び出しは数十秒かかることがあるため長めまで取る)
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# プロンプトの見積もりトークン数のヒストグラムの区切り
+TOKEN_BUCKETS = (100, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000)
+
+LabelValues = Tuple[str, ...]
+_INF_LABEL = 'le="+Inf"'
+
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    """ラベルごとに増加するだけの値"""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """ラベルごとの値の分布 (累積バケット・合計・件数)"""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets: Iterable[float] = DURATION_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[LabelValues, Tuple[List[int], float, int]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+        for key, (counts, total, count) in items:
+            for bound, bucket_count in zip(self.buckets, counts):
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, _INF_LABEL)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Gauge:
+    """ラベルごとの現在値"""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def set(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+# --- 集計する値 ---
+http_requests = Counter("talklog_http_requests_total", "HTTP requests by endpoint and status.", ("method", "endpoint", "status"))
+http_duration = Histogram("talklog_http_request_duration_seconds", "HTTP request latency (until the response headers).", ("endpoint",))
+stage_duration = Histogram("talklog_stage_duration_seconds", "Latency of each processing stage.", ("stage",))
+stage_errors = Counter("talklog_stage_errors_total", "Processing stages that raised an exception.", ("stage",))
+audio_bytes = Counter("talklog_gemini_audio_bytes_total", "Audio bytes sent to Gemini.", ("mode",))
+prompt_tokens = Histogram("talklog_gemini_prompt_tokens", "Estimated prompt size in tokens (text parts only).", ("model",), buckets=TOKEN_BUCKETS)
+startup_seconds = Gauge("talklog_startup_seconds", "Time spent in each startup phase of this process.", ("phase",))
+
+_METRICS = [http_requests, http_duration, stage_duration, stage_errors, audio_bytes, prompt_tokens, startup_seconds]
+_collectors: List[Callable[[], List[str]]] = []
+
+
+def register_collector(collector: Callable[[], List[str]]) -> None:
+    """出力時に呼び出して行を追加する関数を登録する (他モジュールが持つ統計値の出力用)"""
+    _collectors.append(collector)
+
+
+def render() -> str:
+    """すべての値を Prometheus のテキスト形式で返す"""
+    lines: List[str] = []
+    for metric in _METRICS:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        lines.extend(collector())
+    return "\n".join(lines) + "\n"
+
+
+# --- リクエストごとの計測 (Server-Timing ヘッダー用) ---
+_request_timings: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar("request_timings", default=None)
+
+
+def start_request() -> List[Tuple[str, float]]:
+    """現在のリクエスト (コンテキスト) で span の記録を始め、記録先のリストを返す"""
+    timings: List[Tuple[str, float]] = []
+    _request_timings.set(timings)
+    return timings
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """ブロックの所要時間を stage として記録する (例外が出た場合はエラーとしても数える)"""
+    started_at = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        stage_errors.inc(stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started_at
+        stage_duration.observe(elapsed, stage=stage)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+
+def observe_request(method: str, endpoint: str, status: int, elapsed: float) -> None:
+    http_requests.inc(method=method, endpoint=endpoint, status=str(status))
+    http_duration.observe(elapsed, endpoint=endpoint)
+
+
+def server_timing_header(timings: List[Tuple[str, float]], total: Optional[float] = None) -> str:
+    """記録した span を Server-Timing ヘッダーの値にする (同じ stage は合計して回数も付ける)"""
+    totals: Dict[str, Tuple[float, int]] = {}
+    for stage, elapsed in timings:
+        duration, count = totals.get(stage, (0.0, 0))
+        totals[stage] = (duration + elapsed, count + 1)
+    entries = [
+        f'{stage};dur={duration * 1000:.1f}' + (f';desc="x{count}"' if count > 1 else "")
+        for stage, (duration, count) in totals.items()
+    ]
+    if total is not None:
+        entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
@@ -0,0 +1,159 @@
+# backend/models.py
+"""
+データベースのモデル定義。
+db はアプリに依存しない拡張として作成し、app.create_app で init_app する。
+"""
+import sqlite3
+import uuid
+from datetime import datetime
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import deferred, validates
+from sqlalchemy.types import TypeDecorator
+
+from compression import compress_text, decompress_text, register_sqlite_functions
+
+db = SQLAlchemy()
+
+@event.listens_for(Engine, "connect")
+def _on_connect(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        register_sqlite_functions(dbapi_connection)
+
+class CompressedText(TypeDecorator):
+    """保存時に圧縮し、読み出し時に展開するテキスト (形式は compression.py を参照)"""
+    impl = db.Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return compress_text(value)
+
+    def process_result_value(self, value, dialect):
+        return decompress_text(value)
+
+# 一覧のカードに表示するプレビューの最大文字数
+PREVIEW_CHARS = 120
+
+def make_preview(content):
+    """
+    本文から一覧用のプレビューを作る。日記は見出しから始まるため、最初の見出し以外の行
+    (箇条書きの記号は除く) を使い、なければ最初の見出しを使う。
+    """
+    heading = None
+    for line in (content or "").splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("#"):
+            heading = heading or line.lstrip("#").strip()
+            continue
+        return _truncate_preview(line.lstrip("-*・ ").strip() or line)
+    return _truncate_preview(heading or "")
+
+def _truncate_preview(text):
+    return text if len(text) <= PREVIEW_CHARS else text[:PREVIEW_CHARS - 1] + "…"
+
+# --- Database Model --- #
+class Diary(db.Model):
+    """日記エントリを保存するモデル"""
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # 本文は圧縮して保存し、一覧では読み込まない (アクセスしたときに読み込んで展開する)
+    diary_content = deferred(db.Column(CompressedText, nullable=False))
+    preview = db.Column(db.String(PREVIEW_CHARS), nullable=True)  # 一覧表示用 (本文から作る)
+    sentiment_score = db.Column(db.Float, nullable=True)
+    highlight_events = db.Column(db.String(255), nullable=True)
+    notion_url = db.Column(db.String(255), nullable=True)
+    chat_session_id = db.Column(db.String(32), nullable=True)  # 生成元の会話セッション (あれば)
+
+    # 一覧取得 (date, id の降順キーセットページング) 用の複合インデックス
+    __table_args__ = (db.Index('ix_diary_date_id', 'date', 'id'),)
+
+    # to_dict / fields= で指定可能なフィールド
+    SERIALIZABLE_FIELDS = ('id', 'date', 'preview', 'diary_content', 'sentiment_score', 'highlight_events', 'notion_url')
+
+    @validates('diary_content')
+    def _update_preview(self, key, content):
+        self.preview = make_preview(content)
+        return content
+
+    def to_dict(self, fields=None):
+        """モデルオブジェクトを辞書に変換 (fields 指定時は空でもそのフィールドのみ)"""
+        data = {key: getattr(self, key) for key in (self.SERIALIZABLE_FIELDS if fields is None else fields)}
+        if 'date' in data:
+            data['date'] = self.date.isoformat()
+        return data
+
+class SentimentRollup(db.Model):
+    """感情スコアの期間別集計 (Diary の保存と同じトランザクションで更新する)"""
+    bucket = db.Column(db.String(5), primary_key=True)   # 'day' | 'week' | 'month'
+    bucket_start = db.Column(db.Date, primary_key=True)  # 期間の開始日 (UTC)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    score_sum = db.Column(db.Float, nullable=False, default=0.0)
+    score_min = db.Column(db.Float, nullable=False)
+    score_max = db.Column(db.Float, nullable=False)
+
+    def to_dict(self):
+        """モデルオブジェクトを辞書に変換"""
+        return {
+            'bucket_start': self.bucket_start.isoformat(),
+            'count': self.count,
+            'avg': self.score_sum / self.count if self.count else None,
+            'min': self.score_min,
+            'max': self.score_max
+        }
+
+class NotionOutbox(db.Model):
+    """Notion への同期待ちジョブ (Diary と同じトランザクションで追加する)"""
+    id = db.Column(db.Integer, primary_key=True)
+    diary_id = db.Column(db.Integer, db.ForeignKey('diary.id'), nullable=False, index=True)
+    status = db.Column(db.String(10), nullable=False, default='pending')  # 'pending' | 'done' | 'failed'
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    diary = db.relationship('Diary')
+
+    __table_args__ = (db.Index('ix_notion_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),)
+
+    def to_dict(self):
+        """モデルオブジェクトを辞書に変換"""
+        return {
+            'status': self.status,
+            'attempts': self.attempts,
+            'last_error': self.last_error
+        }
+
+class ChatSession(db.Model):
+    """サーバー側で保持する会話セッション (古い発言は summary に要約して畳み込む)"""
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    summary = db.Column(db.Text, nullable=True)
+    summarized_turns = db.Column(db.Integer, nullable=False, default=0)  # summary に畳み込んだ発言数
+    turn_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class ChatTurn(db.Model):
+    """会話セッション内の 1 発言"""
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.String(32), db.ForeignKey('chat_session.id'), nullable=False)
+    seq = db.Column(db.Integer, nullable=False)  # セッション内の通し番号 (1 始まり)
+    role = db.Column(db.String(10), nullable=False)  # 'user' | 'ai'
+    content = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint('session_id', 'seq', name='uq_chat_turn_session_seq'),)
+
+    def to_dict(self):
+        """モデルオブジェクトを辞書に変換 (クライアントが送る会話履歴と同じ形式)"""
+        return {'role': self.role, 'content': self.content}
+
+class DiaryRequest(db.Model):
+    """日記生成リクエストの結果 (重複リクエストに同じ結果を返すため、Diary と同じトランザクションで保存する)"""
+    key = db.Column(db.String(128), primary_key=True)  # Idempotency-Key または会話のハッシュ
+    diary_id = db.Column(db.Integer, db.ForeignKey('diary.id'), nullable=False)
+    response_json = db.Column(CompressedText, nullable=False)  # 本文を含むため圧縮して保存する
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True) # 有効期限切れの行の削除に使う
+# --- End Database Model --- #
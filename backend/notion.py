@@ -1,61 +1,245 @@
 # backend/notion.py
 import os
-import requests
 import json
+import re
+import threading
+import time
 from datetime import datetime
 from dotenv import load_dotenv
 import logging # ロギング追加
+from typing import List, Optional
+
+from ratelimit import TokenBucket
+from metrics import span
 
 load_dotenv()
-_NOTION_TOKEN   = os.getenv("NOTION_API_KEY")
-_DATABASE_ID    = os.getenv("NOTION_DATABASE_ID")
-_NOTION_API_URL = "https://api.notion.com/v1/pages"
-_HEADERS = {
-    "Authorization": f"Bearer {_NOTION_TOKEN}",
-    "Notion-Version": "2022-06-28",
-    "Content-Type": "application/json"
-}
+_NOTION_VERSION = "2022-06-28"
 
 logger = logging.getLogger(__name__) # ロガー取得
 
-def save_to_notion(content: str) -> str:
-    """Markdown 日記テキストを Notion データベースに 1 行として登録"""
-    if not _NOTION_TOKEN or not _DATABASE_ID:
+# Notion API の平均レート制限 (約 3 req/s) に合わせたプロセス共通のリミッタ
+_rate_limiter = TokenBucket(rate=float(os.getenv("NOTION_RATE_LIMIT", 3)))
+# 429 が返った場合に同じリクエストをやり直す回数
+_RATE_LIMITED_RETRIES = 3
+
+# 接続を使い回すためのセッション (Keep-Alive / コネクションプール)。
+# requests の読み込みと環境変数の読み取りは起動を遅くしないよう最初の呼び出しまで行わない
+_session = None
+_session_lock = threading.Lock()
+
+def _database_id() -> Optional[str]:
+    return os.getenv("NOTION_DATABASE_ID")
+
+def _base_url() -> str:
+    # ローカルの代替サーバー (ベンチマーク用の fakes.FakeNotionServer など) に向けるときだけ変更する
+    return os.getenv("NOTION_API_BASE_URL", "https://api.notion.com").rstrip("/")
+
+def _get_session():
+    """Notion API 用のセッションを返す (初回のみ作成する)"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                session.headers.update({
+                    "Authorization": f"Bearer {os.getenv('NOTION_API_KEY')}",
+                    "Notion-Version": _NOTION_VERSION,
+                    "Content-Type": "application/json"
+                })
+                session.mount(_base_url(), HTTPAdapter(pool_connections=4, pool_maxsize=8))
+                _session = session
+    return _session
+
+def prewarm() -> None:
+    """Notion が設定されていればセッションを作成しておく"""
+    if is_notion_configured():
+        _get_session()
+
+def is_notion_configured() -> bool:
+    """Notion 連携に必要な環境変数が設定されているか"""
+    return bool(os.getenv("NOTION_API_KEY") and _database_id())
+
+def _retry_after(response) -> float:
+    try:
+        return float(response.headers.get("Retry-After", 1))
+    except ValueError:
+        return 1.0
+
+def _request(method: str, url: str, payload: dict) -> dict:
+    """
+    レート制限を守りつつ Notion API にリクエストし、JSON レスポンスを返す。
+    429 (レート制限超過) はリクエストが処理されていないため、Retry-After だけ待って _RATE_LIMITED_RETRIES 回までやり直す。
+    """
+    import requests
+    session = _get_session()
+    for attempt in range(_RATE_LIMITED_RETRIES + 1):
+        _rate_limiter.acquire()
+        try:
+            res = session.request(method, url, json=payload, timeout=30)
+            if res.status_code == 429 and attempt < _RATE_LIMITED_RETRIES:
+                delay = _retry_after(res)
+                logger.warning(f"Notion API rate limited; retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            res.raise_for_status() # HTTPエラーがあれば例外発生
+            return res.json()
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Notion API request failed: {e}", exc_info=True)
+            # エラーレスポンスの内容もログに出力
+            if hasattr(e, 'response') and e.response is not None:
+                 try:
+                     logger.error(f"Notion API response content: {e.response.json()}")
+                 except json.JSONDecodeError:
+                     logger.error(f"Notion API response content (non-JSON): {e.response.text}")
+            raise # エラーを再送出して呼び出し側でハンドリングさせる
+
+# --- Markdown → Notion ブロック ---
+# Notion API の制限: rich_text の 1 要素の文字数、1 つの rich_text 配列の要素数、1 リクエストで書き込めるブロック数
+_RICH_TEXT_MAX_CHARS = 2000
+_RICH_TEXT_MAX_ITEMS = 100
+_BLOCKS_PER_REQUEST = 100
+
+_HEADING_PATTERN = re.compile(r"^(#{1,3})\s+(.*)$")
+_BULLET_PATTERN = re.compile(r"^(?:[-*+]\s+|・\s*)(.*)$")
+_NUMBERED_PATTERN = re.compile(r"^\d+[.)]\s+(.*)$")
+_QUOTE_PATTERN = re.compile(r"^>\s?(.*)$")
+_DIVIDER_PATTERN = re.compile(r"^(?:-{3,}|\*{3,}|_{3,})$")
+_INLINE_PATTERN = re.compile(r"\*\*(.+?)\*\*|`([^`]+)`")
+# Notion の code ブロックが受け付ける言語のうち、日記に出てきそうなもの (それ以外は plain text)
+_CODE_LANGUAGES = {"bash", "c", "c++", "css", "html", "java", "javascript", "json", "markdown",
+                   "python", "shell", "sql", "typescript", "yaml"}
+
+def _text_items(text: str, annotations: Optional[dict] = None) -> List[dict]:
+    """テキストを 2000 文字以下の rich_text 要素に分ける"""
+    items = []
+    for start in range(0, len(text), _RICH_TEXT_MAX_CHARS):
+        item = {"type": "text", "text": {"content": text[start:start + _RICH_TEXT_MAX_CHARS]}}
+        if annotations:
+            item["annotations"] = annotations
+        items.append(item)
+    return items
+
+def _rich_text(text: str) -> List[dict]:
+    """インラインの **太字** と `コード` を注釈付きの rich_text 要素にする"""
+    items, position = [], 0
+    for match in _INLINE_PATTERN.finditer(text):
+        items += _text_items(text[position:match.start()])
+        if match.group(1) is not None:
+            items += _text_items(match.group(1), {"bold": True})
+        else:
+            items += _text_items(match.group(2), {"code": True})
+        position = match.end()
+    return items + _text_items(text[position:])
+
+def _blocks(block_type: str, rich_text: List[dict], **extra) -> List[dict]:
+    """1 つのブロックを作る (rich_text が 100 要素を超える場合は同じ種類の複数のブロックに分ける)"""
+    return [{"object": "block", "type": block_type,
+             block_type: {"rich_text": rich_text[start:start + _RICH_TEXT_MAX_ITEMS], **extra}}
+            for start in range(0, max(len(rich_text), 1), _RICH_TEXT_MAX_ITEMS)]
+
+def markdown_to_blocks(content: str) -> List[dict]:
+    """
+    日記の Markdown (_DIARY_SYSTEM_PROMPT の構造) を Notion のブロックのリストに変換する。
+    見出し (#, ##, ###)・箇条書き・番号付きリスト・引用・区切り線・コードブロックに対応し、それ以外の行は段落にする。
+    """
+    blocks = []
+    lines = (content or "").splitlines()
+    i = 0
+    while i < len(lines):
+        line = lines[i].strip()
+        i += 1
+        if not line:
+            continue
+        if line.startswith("```"):
+            language = line[3:].strip().lower()
+            code_lines = []
+            while i < len(lines) and not lines[i].strip().startswith("```"):
+                code_lines.append(lines[i])
+                i += 1
+            i += 1 # 閉じる ``` を飛ばす
+            blocks += _blocks("code", _text_items("\n".join(code_lines)),
+                              language=language if language in _CODE_LANGUAGES else "plain text")
+        elif _DIVIDER_PATTERN.match(line):
+            blocks.append({"object": "block", "type": "divider", "divider": {}})
+        elif match := _HEADING_PATTERN.match(line):
+            blocks += _blocks(f"heading_{len(match.group(1))}", _rich_text(match.group(2)))
+        elif match := _BULLET_PATTERN.match(line):
+            blocks += _blocks("bulleted_list_item", _rich_text(match.group(1)))
+        elif match := _NUMBERED_PATTERN.match(line):
+            blocks += _blocks("numbered_list_item", _rich_text(match.group(1)))
+        elif match := _QUOTE_PATTERN.match(line):
+            blocks += _blocks("quote", _rich_text(match.group(1)))
+        else:
+            blocks += _blocks("paragraph", _rich_text(line))
+    return blocks
+
+# --- ページの作成 ---
+def find_page(page_title: str) -> Optional[dict]:
+    """同じタイトルの (アーカイブされていない) ページがあれば {"id", "url"} を返す (リトライ時の重複作成防止用)"""
+    payload = {
+        "filter": { "property": "Name", "title": { "equals": page_title } },
+        "page_size": 1
+    }
+    with span("notion_query"):
+        results = _request("POST", f"{_base_url()}/v1/databases/{_database_id()}/query", payload).get("results", [])
+    return {"id": results[0]["id"], "url": results[0].get("url", "")} if results else None
+
+def archive_page(page_id: str) -> None:
+    """ページをアーカイブする (Notion のゴミ箱に移る)"""
+    with span("notion_archive"):
+        _request("PATCH", f"{_base_url()}/v1/pages/{page_id}", {"archived": True})
+
+def append_blocks(block_id: str, blocks: List[dict]) -> None:
+    """ページ (ブロック) の末尾にブロックを追加する (100 件ずつ順に送る)"""
+    for start in range(0, len(blocks), _BLOCKS_PER_REQUEST):
+        with span("notion_append"):
+            _request("PATCH", f"{_base_url()}/v1/blocks/{block_id}/children",
+                     {"children": blocks[start:start + _BLOCKS_PER_REQUEST]})
+
+def save_to_notion(content: str, page_title: Optional[str] = None, if_exists: Optional[str] = None) -> str:
+    """
+    Markdown 日記を Notion データベースに 1 行 (ページ) として登録し、ページの URL を返す。
+    本文は Notion のブロックに変換してページに書き込み、最初の 100 ブロックはページの作成と同時に、残りは 100 ブロックずつ追加する。
+    if_exists は同じタイトルのページが既にある場合 (前回の試行で作成済みの場合など) の扱い:
+      None:      確認せずに作成する
+      "reuse":   1 回のリクエストで書き込める本文ならそのページを使い、そうでなければ途中までしか
+                 書き込まれていない可能性があるためアーカイブして作り直す
+      "replace": アーカイブして作り直す
+    """
+    if not is_notion_configured():
         logger.error("Notion API Key or Database ID is not set in .env")
         raise ValueError("Notion API Key or Database ID is missing.")
 
-    page_title = f"日記 {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-    # Notion API の rich_text は 2000文字制限があるので注意
-    # Markdown を Notion のブロック形式に変換するとよりリッチになるが、今回は簡略化
-    # backend/notion.py (確認)
+    page_title = page_title or f"日記 {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+    blocks = markdown_to_blocks(content)
+    if if_exists is not None:
+        existing = find_page(page_title)
+        if existing is not None:
+            if if_exists == "reuse" and len(blocks) <= _BLOCKS_PER_REQUEST:
+                return existing["url"]
+            logger.info(f"Archiving existing Notion page {existing['id']} before re-creating it")
+            archive_page(existing["id"])
+
     payload = {
-        "parent": { "database_id": _DATABASE_ID },
+        "parent": { "database_id": _database_id() },
         "properties": {
-            "Name": { # これはOK
+            "Name": {
                 "title": [{ "text": { "content": page_title } }]
             },
-            "Diary": { # Notion側でこの名前に設定したのでOK
-                "rich_text": [{
-                    "text": { "content": content[:2000] + ('...' if len(content) > 2000 else '') }
-                }]
+            # 一覧で読めるよう本文はプロパティにも入れる (rich_text の要素数の上限を超える分はページ本文のみ)
+            "Diary": {
+                "rich_text": _text_items(content)[:_RICH_TEXT_MAX_ITEMS]
             }
-        }
+        },
+        "children": blocks[:_BLOCKS_PER_REQUEST]
     }
 
-    logger.info(f"Sending data to Notion DB: {_DATABASE_ID}")
-    try:
-        res = requests.post(_NOTION_API_URL, headers=_HEADERS, json=payload, timeout=30)
-        res.raise_for_status() # HTTPエラーがあれば例外発生
-        response_data = res.json()
-        page_url = response_data.get("url", "")
-        logger.info(f"Successfully created Notion page: {page_url}")
-        return page_url
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Notion API request failed: {e}", exc_info=True)
-        # エラーレスポンスの内容もログに出力
-        if hasattr(e, 'response') and e.response is not None:
-             try:
-                 logger.error(f"Notion API response content: {e.response.json()}")
-             except json.JSONDecodeError:
-                 logger.error(f"Notion API response content (non-JSON): {e.response.text}")
-        raise # エラーを再送出して app.py でハンドリングさせる
\ No newline at end of file
+    logger.info(f"Sending data to Notion DB: {_database_id()} ({len(blocks)} blocks)")
+    with span("notion_save"):
+        response_data = _request("POST", f"{_base_url()}/v1/pages", payload)
+    append_blocks(response_data["id"], blocks[_BLOCKS_PER_REQUEST:])
+    page_url = response_data.get("url", "")
+    logger.info(f"Successfully created Notion page: {page_url}")
+    return page_url
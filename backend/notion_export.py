@@ -0,0 +1,169 @@
+# backend/notion_export.py
+"""
+範囲を指定した日記をまとめて Notion に書き出す (本文は Notion のブロックに変換して全文を書き込む)。
+
+    python notion_export.py --since-id 1 --until-id 500
+    python notion_export.py --from-date 2024-01-01 --to-date 2024-12-31 --workers 6
+    python notion_export.py --resync             # 書き出し済み (notion_url あり) の日記もページを作り直す
+    python notion_export.py --dry-run --fake-latency 0.3   # ローカルの偽 Notion (fakes.FakeNotionServer) に書き出す
+
+最大 --workers 件の日記を並行して書き出し、ある日記のブロック追加と別の日記のページ作成を重ねることで、
+プロセス共通のレートリミッタ (NOTION_RATE_LIMIT、既定 3 req/s) の上限までリクエストを送り続ける。
+1 件の日記の中のブロック追加は順序を保つため順番に行う。
+書き出した日記には notion_url を保存し、同期待ちのアウトボックスのジョブは完了にする (--dry-run では保存しない)。
+書き出し済みの日記は --resync を指定しない限り飛ばすため、中断した場合は同じコマンドで続きから再開できる。
+同期待ちのジョブがある日記をアプリの同期ワーカーと同時に書き出すと、ページが重複する場合がある。
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam
+
+# 本文を読み込み、書き戻す 1 回あたりの日記の件数
+_CHUNK_SIZE = 50
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export a range of diaries to Notion as native blocks")
+    parser.add_argument("--since-id", type=int, help="この id 以降の日記を書き出す")
+    parser.add_argument("--until-id", type=int, help="この id までの日記を書き出す")
+    parser.add_argument("--from-date", type=datetime.fromisoformat, help="この日 (UTC) 以降の日記を書き出す (YYYY-MM-DD)")
+    parser.add_argument("--to-date", type=datetime.fromisoformat, help="この日 (UTC) までの日記を書き出す (YYYY-MM-DD)")
+    parser.add_argument("--workers", type=int, default=4, help="並行して書き出す日記の最大数")
+    parser.add_argument("--resync", action="store_true", help="書き出し済みの日記も既存のページをアーカイブして作り直す")
+    parser.add_argument("--dry-run", action="store_true", help="ローカルの偽 Notion に書き出し、DB には書き込まない")
+    parser.add_argument("--fake-latency", type=float, default=0.3, help="--dry-run の偽 Notion の応答時間 (秒)")
+    return parser.parse_args(argv)
+
+
+def _diary_ids(app_module, args):
+    """書き出す日記の id を古い順に返す"""
+    Diary = app_module.Diary
+    query = app_module.db.session.query(Diary.id).order_by(Diary.id)
+    if args.since_id is not None:
+        query = query.filter(Diary.id >= args.since_id)
+    if args.until_id is not None:
+        query = query.filter(Diary.id <= args.until_id)
+    if args.from_date is not None:
+        query = query.filter(Diary.date >= args.from_date)
+    if args.to_date is not None:
+        query = query.filter(Diary.date < args.to_date + timedelta(days=1))
+    if not args.resync:
+        query = query.filter(Diary.notion_url.is_(None))
+    return [diary_id for diary_id, in query]
+
+
+def _load_chunk(app_module, ids):
+    """書き出す日記の id・日時・本文と、前回の同期の試行でページが作成済みかもしれないかを読み込む"""
+    db, Diary, NotionOutbox = app_module.db, app_module.Diary, app_module.NotionOutbox
+    rows = (db.session.query(Diary.id, Diary.date, Diary.diary_content, Diary.notion_url)
+            .filter(Diary.id.in_(ids)).order_by(Diary.id).all())
+    attempted = {diary_id for diary_id, in db.session.query(NotionOutbox.diary_id)
+                 .filter(NotionOutbox.diary_id.in_(ids), NotionOutbox.attempts > 0)}
+    db.session.rollback()
+    return rows, attempted
+
+
+def _export_one(notion, notion_page_title, row, if_exists):
+    """日記 1 件を書き出し、(id, ページの URL または None, 例外 または None, ブロック数) を返す"""
+    try:
+        blocks = len(notion.markdown_to_blocks(row.diary_content))
+        url = notion.save_to_notion(row.diary_content, page_title=notion_page_title(row), if_exists=if_exists)
+        return row.id, url, None, blocks
+    except Exception as e:
+        return row.id, None, e, 0
+
+
+def _write_results(app_module, results):
+    """書き出した日記の notion_url を保存し、同期待ちのジョブを完了にする"""
+    db, Diary, NotionOutbox = app_module.db, app_module.Diary, app_module.NotionOutbox
+    exported = [(diary_id, url) for diary_id, url, error, _ in results if error is None]
+    if not exported:
+        return
+    table = Diary.__table__
+    db.session.execute(table.update().where(table.c.id == bindparam("_id")).values(notion_url=bindparam("_url")),
+                       [{"_id": diary_id, "_url": url} for diary_id, url in exported])
+    (NotionOutbox.query
+     .filter(NotionOutbox.diary_id.in_([diary_id for diary_id, _ in exported]), NotionOutbox.status == 'pending')
+     .update({"status": "done", "last_error": None}, synchronize_session=False))
+    db.session.commit()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    fake_server = None
+    if args.dry_run:
+        from fakes import FakeNotionServer
+        fake_server = FakeNotionServer(latency=args.fake_latency, jitter=0.2).start()
+        os.environ.update({"NOTION_API_BASE_URL": fake_server.base_url,
+                           "NOTION_API_KEY": "notion-export-dry-run", "NOTION_DATABASE_ID": "notion-export-dry-run"})
+        os.environ.setdefault("GEMINI_API_KEY", "notion-export-dry-run")
+
+    import logging
+    logging.disable(logging.INFO)
+    import app as app_module
+    import notion
+    from notion_sync import notion_page_title
+    if not notion.is_notion_configured():
+        raise SystemExit("NOTION_API_KEY and NOTION_DATABASE_ID must be set (or use --dry-run)")
+
+    flask_app = app_module.create_app()
+    started_at = time.perf_counter()
+    exported = failed = blocks = 0
+    try:
+        with flask_app.app_context(), ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="notion-export") as executor:
+            ids = _diary_ids(app_module, args)
+            print(f"Exporting {len(ids)} diaries with {args.workers} workers", file=sys.stderr)
+            in_flight, results = set(), []
+
+            def collect(return_when):
+                nonlocal in_flight, exported, failed, blocks
+                done, in_flight = wait(in_flight, return_when=return_when)
+                for future in done:
+                    result = future.result()
+                    results.append(result)
+                    if result[2] is None:
+                        exported += 1
+                        blocks += result[3]
+                    else:
+                        failed += 1
+                        print(f"Diary {result[0]}: {result[2]}", file=sys.stderr)
+
+            for start in range(0, len(ids), _CHUNK_SIZE):
+                rows, attempted = _load_chunk(app_module, ids[start:start + _CHUNK_SIZE])
+                for row in rows:
+                    if row.notion_url:
+                        if_exists = "replace"
+                    else:
+                        if_exists = "reuse" if row.id in attempted else None
+                    # 前の日記の完了を待ちつつ、常に workers 件を超えない範囲で次の日記を送り込む
+                    while len(in_flight) >= args.workers:
+                        collect(FIRST_COMPLETED)
+                    in_flight.add(executor.submit(_export_one, notion, notion_page_title, row, if_exists))
+                if not args.dry_run:
+                    _write_results(app_module, results)
+                results.clear()
+                elapsed = time.perf_counter() - started_at
+                print(f"  {exported + failed}/{len(ids)} done, {failed} failed ({exported / elapsed:.1f} diaries/s)",
+                      file=sys.stderr)
+            collect(ALL_COMPLETED)
+            if not args.dry_run:
+                _write_results(app_module, results)
+    finally:
+        if fake_server is not None:
+            fake_server.stop()
+
+    elapsed = time.perf_counter() - started_at
+    mode = "Dry run (fake Notion, nothing written)" if args.dry_run else "Export"
+    print(f"\n{mode}: {exported} diaries ({blocks} blocks) in {elapsed:.1f}s, {failed} failed")
+    if fake_server is not None:
+        print(f"Fake Notion received {fake_server.requests} requests ({fake_server.requests / elapsed:.1f} req/s)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,129 @@
+# backend/notion_sync.py
+import os
+import random
+import threading
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+
+from notion import save_to_notion
+
+logger = logging.getLogger(__name__)
+
+_MAX_ATTEMPTS = int(os.getenv("NOTION_SYNC_MAX_ATTEMPTS", 8))
+_BACKOFF_BASE_SECONDS = float(os.getenv("NOTION_SYNC_BACKOFF_BASE", 2))
+_BACKOFF_MAX_SECONDS = float(os.getenv("NOTION_SYNC_BACKOFF_MAX", 600))
+_POLL_INTERVAL_SECONDS = float(os.getenv("NOTION_SYNC_POLL_INTERVAL", 30))
+_BATCH_SIZE = 10
+
+
+def notion_page_title(diary) -> str:
+    """日記ごとに一意な Notion ページタイトル (リトライ時の重複確認に使う)"""
+    return f"日記 {diary.date.strftime('%Y-%m-%d %H:%M')} #{diary.id}"
+
+
+def _is_retryable(error: Exception) -> bool:
+    """一時的なエラー (通信エラー / 429 / 5xx) のみリトライ対象とする"""
+    import requests # 起動時に読み込まないよう、失敗したときだけ読み込む
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(error, requests.exceptions.RequestException)
+
+
+def _retry_delay(attempts: int, error: Exception) -> float:
+    """次のリトライまでの秒数 (Retry-After があれば優先し、なければ指数バックオフ + ジッタ)"""
+    response = getattr(error, 'response', None)
+    if response is not None and response.headers.get("Retry-After"):
+        try:
+            return float(response.headers["Retry-After"])
+        except ValueError:
+            pass
+    delay = min(_BACKOFF_MAX_SECONDS, _BACKOFF_BASE_SECONDS * (2 ** (attempts - 1)))
+    return delay * random.uniform(0.5, 1.0)
+
+
+class NotionSyncWorker(threading.Thread):
+    """Notion 同期アウトボックスを順に処理するバックグラウンドワーカー"""
+
+    def __init__(self, app, db, diary_model, outbox_model):
+        super().__init__(name="notion-sync", daemon=True)
+        self.app = app
+        self.db = db
+        self.Diary = diary_model
+        self.NotionOutbox = outbox_model
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+
+    def notify(self) -> None:
+        """新しいジョブが追加されたことをワーカーに知らせる"""
+        self._wakeup.set()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """処理中のジョブが終わったところでワーカーを止め、終了を待つ (未処理のジョブはアウトボックスに残る)"""
+        self._stopping.set()
+        self._wakeup.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self) -> None:
+        logger.info("Notion sync worker started")
+        while not self._stopping.is_set():
+            try:
+                with self.app.app_context():
+                    processed = self.drain()
+            except Exception as e:
+                logger.error(f"Notion sync worker error: {e}", exc_info=True)
+                processed = 0
+            if not processed:
+                self._wakeup.wait(_POLL_INTERVAL_SECONDS)
+                self._wakeup.clear()
+        logger.info("Notion sync worker stopped")
+
+    def drain(self) -> int:
+        """期限の来たジョブを 1 バッチ処理し、処理件数を返す (app context 内で呼ぶ)"""
+        jobs = (self.NotionOutbox.query
+                .filter(self.NotionOutbox.status == 'pending',
+                        self.NotionOutbox.next_attempt_at <= datetime.utcnow())
+                .order_by(self.NotionOutbox.id)
+                .limit(_BATCH_SIZE)
+                .all())
+        for processed, job in enumerate(jobs):
+            if self._stopping.is_set():
+                return processed
+            self._process(job)
+        return len(jobs)
+
+    def _process(self, job) -> None:
+        diary = self.db.session.get(self.Diary, job.diary_id)
+        if diary is None:
+            job.status = 'failed'
+            job.last_error = "Diary not found"
+            self.db.session.commit()
+            return
+
+        page_title = notion_page_title(diary)
+        # 試行回数は Notion を呼ぶ前に記録する (ページの作成後・結果の保存前にプロセスが落ちた場合も、次の試行で既存のページを探す)
+        job.attempts += 1
+        self.db.session.commit()
+        try:
+            # 前回の試行でページ作成だけ成功していた場合に重複作成しない (途中まで書き込まれたページは作り直す)
+            page_url = save_to_notion(diary.diary_content, page_title=page_title,
+                                      if_exists="reuse" if job.attempts > 1 else None)
+        except Exception as e:
+            job.last_error = str(e)[:1000]
+            if _is_retryable(e) and job.attempts < _MAX_ATTEMPTS:
+                delay = _retry_delay(job.attempts, e)
+                job.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+                logger.warning(f"Notion sync for diary {diary.id} failed (attempt {job.attempts}), retrying in {delay:.1f}s: {e}")
+            else:
+                job.status = 'failed'
+                logger.error(f"Notion sync for diary {diary.id} gave up after {job.attempts} attempts: {e}")
+            self.db.session.commit()
+            return
+
+        job.status = 'done'
+        job.last_error = None
+        diary.notion_url = page_url
+        self.db.session.commit()
+        logger.info(f"Synced diary {diary.id} to Notion: {page_url}")
@@ -0,0 +1,48 @@
+# backend/ratelimit.py
+import threading
+import time
+
+
+class TokenBucket:
+    """スレッドセーフなトークンバケット方式のレートリミッタ"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        rate:     1秒あたりに補充されるトークン数
+        capacity: バケットの最大トークン数 (バースト許容量)。省略時は rate と同じ
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive.")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """
+        トークンを先取りし、使ってよくなるまでの秒数を返す (待機はしない)。
+        asyncio など呼び出し側で待機する場合に使う。
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= tokens
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        """トークンが取得できるまで待機する。戻り値は待機した秒数"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
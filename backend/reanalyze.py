@@ -0,0 +1,238 @@
+# backend/reanalyze.py
+"""
+保存済みの日記の感情スコア (sentiment_score) とハイライト (highlight_events) を再分析して付け直す。
+日記生成のプロンプト (_DIARY_SYSTEM_PROMPT) やモデルを変更した後に、過去の日記へ反映するために使う。
+
+    python reanalyze.py                          # すべての日記を再分析する (中断しても同じコマンドで続きから再開する)
+    python reanalyze.py --since-id 5000 --limit 1000
+    python reanalyze.py --retry-failed           # 前回失敗した日記だけを再実行する
+    python reanalyze.py --dry-run                # 偽モデル (fakes.FakeModelFactory) で実行し、DB には書き込まない
+
+日記は id 順に --batch-size 件ずつ読み込み、最大 --concurrency 件を並行して再分析し、
+バッチごとに 1 トランザクションで書き戻して、影響する期間の感情スコアの集計を作り直す。
+Gemini の同時実行数とレートは Gemini クライアントの制限 (GEMINI_MAX_CONCURRENCY / GEMINI_REQUESTS_PER_MINUTE) で抑え、
+このジョブでは --concurrency / --rpm で指定する (長い会話のチャンク要約も 1 リクエストとして数える)。
+書き戻したバッチの最後の id はチェックポイントファイルに記録し、次回はその続きから処理する。
+会話セッションから生成された日記 (chat_session_id あり) は保存済みの全発言から、それ以外は日記本文から再分析する。
+再分析に失敗した日記は値を変更せず、チェックポイントの failed_ids に記録する。
+日記本文と Notion のページは変更しない。
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import bindparam, inspect
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import undefer
+
+_BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+_DEFAULT_CHECKPOINT = os.path.join(_BACKEND_DIR, "reanalyze_checkpoint.json")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Re-score sentiment and highlights of stored diaries through Gemini")
+    parser.add_argument("--batch-size", type=int, default=50, help="1 回に読み込み、1 トランザクションで書き戻す件数")
+    parser.add_argument("--concurrency", type=int, default=4, help="並行して再分析する日記の最大数")
+    parser.add_argument("--rpm", type=float, help="Gemini への 1 分あたりのリクエスト数の上限 (省略時は GEMINI_REQUESTS_PER_MINUTE)")
+    parser.add_argument("--since-id", type=int, default=0, help="この id より大きい日記から始める (チェックポイントより後の場合のみ)")
+    parser.add_argument("--limit", type=int, help="今回処理する日記の最大数")
+    parser.add_argument("--checkpoint", default=_DEFAULT_CHECKPOINT, help="進捗を記録するファイル")
+    parser.add_argument("--restart", action="store_true", help="チェックポイントを無視して最初からやり直す")
+    parser.add_argument("--retry-failed", action="store_true", help="チェックポイントに記録された失敗した日記だけを再実行する")
+    parser.add_argument("--dry-run", action="store_true", help="偽モデルで再分析し、DB とチェックポイントには書き込まない")
+    parser.add_argument("--fake-latency", type=float, default=0.2, help="--dry-run の偽モデルの応答時間 (秒)")
+    parser.add_argument("--fake-error-rate", type=float, default=0.0, help="--dry-run の偽モデルが一時的エラーを返す確率")
+    return parser.parse_args(argv)
+
+
+def read_only_uri(uri):
+    """SQLite の DB なら読み取り専用で開く URI にする (--dry-run 用。それ以外の DB はそのまま返す)"""
+    url = make_url(uri)
+    if not url.drivername.startswith("sqlite") or url.database in (None, "", ":memory:"):
+        return uri
+    return url.set(database=f"file:{url.database}", query={**url.query, "mode": "ro", "uri": "true"}).render_as_string(hide_password=False)
+
+
+def load_checkpoint(path, version, restart):
+    """チェックポイントを読み込む。プロンプトやモデルが前回と異なる場合は --restart が必要"""
+    empty = {"version": version, "last_id": 0, "processed": 0, "changed": 0, "failed_ids": []}
+    if restart or not os.path.exists(path):
+        return empty
+    with open(path, encoding="utf-8") as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("version") != version:
+        raise SystemExit(f"Checkpoint {path} was written with a different prompt or model; "
+                         f"re-run with --restart to start over")
+    return {**empty, **checkpoint}
+
+
+def save_checkpoint(path, checkpoint):
+    """チェックポイントを書き込む (途中で落ちても壊れないよう一時ファイルから置き換える)"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def fetch_batch(db, Diary, ChatTurn, after_id=0, batch_size=50, ids=None):
+    """
+    再分析する日記を id 順に読み込み、会話履歴を付けた辞書のリストにする。
+    ids を指定した場合はその日記を、それ以外は after_id より大きい id の日記を batch_size 件読み込む。
+    """
+    query = Diary.query.options(undefer(Diary.diary_content)).order_by(Diary.id)
+    query = query.filter(Diary.id.in_(ids)) if ids is not None else query.filter(Diary.id > after_id).limit(batch_size)
+    diaries = query.all()
+    session_ids = {diary.chat_session_id for diary in diaries if diary.chat_session_id}
+    conversations = defaultdict(list)
+    if session_ids:
+        turns = ChatTurn.query.filter(ChatTurn.session_id.in_(session_ids)).order_by(ChatTurn.session_id, ChatTurn.seq)
+        for turn in turns:
+            conversations[turn.session_id].append(turn.to_dict())
+    batch = [{
+        "id": diary.id,
+        "date": diary.date,
+        "diary_content": diary.diary_content,
+        "conversation": conversations.get(diary.chat_session_id),
+        "sentiment_score": diary.sentiment_score,
+        "highlight_events": diary.highlight_events,
+    } for diary in diaries]
+    # 再分析の間は読み込みのトランザクションを開いたままにしない
+    db.session.rollback()
+    return batch
+
+
+def analyze_batch(executor, analyze, batch):
+    """バッチ内の日記を並行して再分析し、[(日記, (スコア, ハイライト) または None, 例外 または None)] を返す"""
+    futures = [(item, executor.submit(analyze, item["conversation"], item["diary_content"])) for item in batch]
+    results = []
+    for item, future in futures:
+        try:
+            results.append((item, future.result(), None))
+        except Exception as e:
+            results.append((item, None, e))
+    return results
+
+
+def write_batch(app_module, results):
+    """再分析の結果を 1 トランザクションで書き戻し、影響する期間の感情スコアの集計を作り直す"""
+    db, Diary = app_module.db, app_module.Diary
+    rows = [{"_id": item["id"], "_score": analysis[0], "_highlight": analysis[1]}
+            for item, analysis, _ in results if analysis is not None]
+    if not rows:
+        return
+    table = Diary.__table__
+    db.session.execute(
+        table.update().where(table.c.id == bindparam("_id"))
+        .values(sentiment_score=bindparam("_score"), highlight_events=bindparam("_highlight")),
+        rows
+    )
+    app_module._refresh_sentiment_rollups([item["date"] for item, analysis, _ in results if analysis is not None])
+    db.session.commit()
+
+
+def _batches(app_module, args, checkpoint):
+    """処理するバッチを順に返す (--retry-failed なら失敗した日記、それ以外はチェックポイントの続きから)"""
+    db, Diary, ChatTurn = app_module.db, app_module.Diary, app_module.ChatTurn
+    remaining = args.limit
+    if args.retry_failed:
+        failed_ids = sorted(checkpoint["failed_ids"])[:remaining]
+        for start in range(0, len(failed_ids), args.batch_size):
+            yield fetch_batch(db, Diary, ChatTurn, ids=failed_ids[start:start + args.batch_size])
+        return
+    after_id = max(checkpoint["last_id"], args.since_id)
+    while remaining is None or remaining > 0:
+        size = args.batch_size if remaining is None else min(args.batch_size, remaining)
+        batch = fetch_batch(db, Diary, ChatTurn, after_id=after_id, batch_size=size)
+        if not batch:
+            return
+        yield batch
+        after_id = batch[-1]["id"]
+        if remaining is not None:
+            remaining -= len(batch)
+
+
+def _is_changed(item, analysis):
+    score, highlight = analysis
+    return (item["sentiment_score"] is None or abs(item["sentiment_score"] - score) > 1e-9
+            or item["highlight_events"] != highlight)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.dry_run:
+        os.environ.setdefault("GEMINI_API_KEY", "reanalyze-dry-run")
+    # Gemini クライアントは読み込み時に制限を環境変数から読むため、インポートの前に設定する
+    os.environ["GEMINI_MAX_CONCURRENCY"] = str(args.concurrency)
+    if args.rpm:
+        os.environ["GEMINI_REQUESTS_PER_MINUTE"] = str(args.rpm)
+
+    import logging
+    logging.disable(logging.INFO)
+    import app as app_module
+    import gemini
+    if args.dry_run:
+        from fakes import FakeModelFactory
+        gemini.set_model_factory(FakeModelFactory(latency=args.fake_latency, error_rate=args.fake_error_rate))
+
+    checkpoint = load_checkpoint(args.checkpoint, gemini.diary_analysis_version(), args.restart)
+    config = None
+    if args.dry_run:
+        # --dry-run では DB に一切書き込まない (init_db の移行も行わず、SQLite は読み取り専用で開く)
+        config = {"SQLALCHEMY_DATABASE_URI": read_only_uri(os.getenv("DATABASE_URL", f"sqlite:///{app_module.db_path}"))}
+    flask_app = app_module.create_app(config)
+    started_at = time.perf_counter()
+    processed = changed = failed = 0
+    score_deltas = []
+    with flask_app.app_context(), ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="reanalyze") as executor:
+        if args.dry_run:
+            columns = {column["name"] for column in inspect(app_module.db.engine).get_columns(app_module.Diary.__tablename__)}
+            if not set(app_module.Diary.__table__.columns.keys()) <= columns:
+                raise SystemExit("The database has not been migrated yet; run once without --dry-run (or start the app) first")
+        else:
+            app_module.init_db()
+        for batch in _batches(app_module, args, checkpoint):
+            results = analyze_batch(executor, gemini.analyze_diary, batch)
+            failed_ids = set(checkpoint["failed_ids"])
+            batch_changed = 0
+            for item, analysis, error in results:
+                if analysis is None:
+                    print(f"Diary {item['id']}: {error}", file=sys.stderr)
+                    failed_ids.add(item["id"])
+                    failed += 1
+                    continue
+                failed_ids.discard(item["id"])
+                if _is_changed(item, analysis):
+                    batch_changed += 1
+                    if item["sentiment_score"] is not None:
+                        score_deltas.append(abs(analysis[0] - item["sentiment_score"]))
+            processed += len(results)
+            changed += batch_changed
+            checkpoint["failed_ids"] = sorted(failed_ids)
+
+            if not args.dry_run:
+                write_batch(app_module, results)
+                if not args.retry_failed:
+                    checkpoint["last_id"] = max(checkpoint["last_id"], batch[-1]["id"])
+                checkpoint["processed"] += len(results)
+                checkpoint["changed"] += batch_changed
+                save_checkpoint(args.checkpoint, checkpoint)
+            elapsed = time.perf_counter() - started_at
+            print(f"  up to id {batch[-1]['id']}: {processed} processed, {changed} changed, {failed} failed "
+                  f"({processed / elapsed:.1f} diaries/s)", file=sys.stderr)
+
+    elapsed = time.perf_counter() - started_at
+    mode = "Dry run (fake model, nothing written)" if args.dry_run else "Re-analysis"
+    print(f"\n{mode}: {processed} diaries in {elapsed:.1f}s, {changed} changed, {failed} failed")
+    if score_deltas:
+        print(f"Mean absolute sentiment change: {sum(score_deltas) / len(score_deltas):.3f}")
+    if not args.dry_run:
+        print(f"Checkpoint: {args.checkpoint} (last id {checkpoint['last_id']}, {len(checkpoint['failed_ids'])} failed ids)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,216 @@
+# backend/search.py
+"""
+日記の全文検索 (SQLite FTS5)。
+diary_fts は diary_content と highlight_events を索引する外部コンテンツの FTS5 仮想テーブルで、
+本文は圧縮して保存されているため、展開した本文を返すビュー (diary_search_source) をコンテンツとする。
+日本語は単語に区切られていないため trigram トークナイザを使い、任意の 3 文字以上の部分文字列で検索できるようにする。
+索引は diary テーブルのトリガーで同期する。ビューとトリガーは接続ごとに登録する talklog_decompress
+(compression.register_sqlite_functions) を使うため、この関数を登録していない接続から diary を更新することはできない。
+既存の日記の索引は次のコマンドで作り直せる。
+
+    python search.py
+"""
+import argparse
+import html
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import bindparam, text
+
+from models import db, Diary
+
+FTS_TABLE = "diary_fts"
+_SOURCE_VIEW = "diary_search_source"
+_TRIGGERS = (f"{FTS_TABLE}_ai", f"{FTS_TABLE}_ad", f"{FTS_TABLE}_au")
+# highlight_events での一致を本文より重く扱う (bm25 の列ごとの重み)
+_BM25_WEIGHTS = (1.0, 2.0)
+# trigram では 3 文字未満の語を MATCH で検索できないため、それらは LIKE で絞り込む
+_TRIGRAM_MIN_CHARS = 3
+MAX_QUERY_TERMS = 8
+MAX_QUERY_CHARS = 200
+SNIPPET_TOKENS = 16
+# snippet の一致箇所の目印 (HTML エスケープ後に <mark> に置き換える)
+_MARK_START, _MARK_END = "\x02", "\x03"
+_ELLIPSIS = "…"
+
+_SCHEMA = [
+    f"""CREATE VIEW IF NOT EXISTS {_SOURCE_VIEW} AS
+        SELECT id, talklog_decompress(diary_content) AS diary_content, highlight_events FROM diary""",
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        diary_content, highlight_events,
+        content='{_SOURCE_VIEW}', content_rowid='id', tokenize='trigram'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON diary BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, diary_content, highlight_events)
+        VALUES (new.id, talklog_decompress(new.diary_content), new.highlight_events);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON diary BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, diary_content, highlight_events)
+        VALUES ('delete', old.id, talklog_decompress(old.diary_content), old.highlight_events);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF diary_content, highlight_events ON diary BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, diary_content, highlight_events)
+        VALUES ('delete', old.id, talklog_decompress(old.diary_content), old.highlight_events);
+        INSERT INTO {FTS_TABLE}(rowid, diary_content, highlight_events)
+        VALUES (new.id, talklog_decompress(new.diary_content), new.highlight_events);
+    END""",
+]
+
+
+def drop_search_index() -> None:
+    """索引・トリガー・ビューを削除する (大量の行を書き換える前に外し、後で作り直す場合など)"""
+    with db.engine.begin() as conn:
+        for trigger in _TRIGGERS:
+            conn.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+        conn.execute(text(f"DROP TABLE IF EXISTS {FTS_TABLE}"))
+        conn.execute(text(f"DROP VIEW IF EXISTS {_SOURCE_VIEW}"))
+
+
+def ensure_search_index() -> bool:
+    """
+    検索用の仮想テーブルとトリガーがなければ作成する (本文の圧縮導入前の定義なら作り直す)。
+    テーブルを新しく作成した場合は True を返す (呼び出し側で rebuild_search_index が必要)。
+    """
+    with db.engine.connect() as conn:
+        sql = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                           {"name": FTS_TABLE}).scalar()
+    if sql is not None and _SOURCE_VIEW not in sql:
+        drop_search_index()
+        sql = None
+    with db.engine.begin() as conn:
+        for statement in _SCHEMA:
+            conn.execute(text(statement))
+    return sql is None
+
+
+def rebuild_search_index() -> None:
+    """diary テーブルの全行から索引を作り直す"""
+    with db.engine.begin() as conn:
+        conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+
+
+def parse_query(q: str) -> Tuple[List[str], List[str]]:
+    """
+    検索文字列を空白 (全角を含む) で区切り、(MATCH で検索する語, LIKE で絞り込む短い語) に分ける。
+    すべての語を含む日記が一致する (AND)。
+    """
+    terms = list(dict.fromkeys(q[:MAX_QUERY_CHARS].split()))[:MAX_QUERY_TERMS]
+    long_terms = [t for t in terms if len(t) >= _TRIGRAM_MIN_CHARS]
+    short_terms = [t for t in terms if len(t) < _TRIGRAM_MIN_CHARS]
+    return long_terms, short_terms
+
+
+def _match_expression(terms: List[str]) -> str:
+    """各語をフレーズとして引用し、FTS5 の構文として解釈されないようにする"""
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def _like_pattern(term: str) -> str:
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def _render_snippet(raw: Optional[str]) -> str:
+    """目印付きの snippet を HTML エスケープし、一致箇所を <mark> で囲む"""
+    return html.escape(raw or "").replace(_MARK_START, "<mark>").replace(_MARK_END, "</mark>")
+
+
+def _snippet_around(content: str, terms: List[str]) -> str:
+    """MATCH を使わない検索 (短い語のみ) の snippet を本文から作る"""
+    content = content or ""
+    positions = [(content.find(term), term) for term in terms if term in content]
+    if not positions:
+        return html.escape(content[:SNIPPET_TOKENS * 2])
+    position, _ = min(positions)
+    start = max(0, position - SNIPPET_TOKENS)
+    end = min(len(content), position + SNIPPET_TOKENS * 2)
+    window = content[start:end]
+    for term in terms:
+        window = window.replace(term, _MARK_START + term + _MARK_END)
+    return ((_ELLIPSIS if start > 0 else "") + _render_snippet(window) + (_ELLIPSIS if end < len(content) else ""))
+
+
+def search_diaries(q: str, limit: int, offset: int = 0) -> Tuple[List[Dict], bool]:
+    """
+    日記を検索し、(結果のリスト, 次のページがあるか) を返す。
+    3 文字以上の語があれば bm25 の関連度順、短い語だけの場合は新しい順 (id の降順) に並べる。
+    一致した全行の順位付けは rowid と bm25 だけで行い、snippet と日記の列は返すページの行についてだけ取得する。
+    """
+    long_terms, short_terms = parse_query(q)
+    if not long_terms and not short_terms:
+        return [], False
+
+    params = {"limit": limit + 1, "offset": offset}
+    conditions = []
+    if long_terms:
+        conditions.append(f"{FTS_TABLE} MATCH :match")
+        params["match"] = _match_expression(long_terms)
+    for i, term in enumerate(short_terms):
+        conditions.append(f"({FTS_TABLE}.diary_content LIKE :like{i} ESCAPE '\\' "
+                          f"OR {FTS_TABLE}.highlight_events LIKE :like{i} ESCAPE '\\')")
+        params[f"like{i}"] = _like_pattern(term)
+    if long_terms:
+        weights = ", ".join(str(w) for w in _BM25_WEIGHTS)
+        score, order_by = f"bm25({FTS_TABLE}, {weights})", "score, rowid DESC"
+    else:
+        score, order_by = "NULL", "rowid DESC"
+    ranked = db.session.execute(text(
+        f"SELECT rowid, {score} AS score FROM {FTS_TABLE} WHERE {' AND '.join(conditions)} "
+        f"ORDER BY {order_by} LIMIT :limit OFFSET :offset"
+    ), params).all()
+    page = ranked[:limit]
+    if not page:
+        return [], False
+
+    id_params = {"ids": [row.rowid for row in page]}
+    ids = bindparam("ids", expanding=True)
+    if long_terms:
+        snippet_sql = (f"SELECT rowid, snippet({FTS_TABLE}, -1, :mark_start, :mark_end, :ellipsis, :snippet_tokens) "
+                       f"FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match AND rowid IN :ids")
+        snippet_params = {**id_params, "match": params["match"], "mark_start": _MARK_START, "mark_end": _MARK_END,
+                          "ellipsis": _ELLIPSIS, "snippet_tokens": SNIPPET_TOKENS}
+        snippets = {rowid: _render_snippet(raw)
+                    for rowid, raw in db.session.execute(text(snippet_sql).bindparams(ids), snippet_params)}
+    else:
+        snippet_sql = f"SELECT rowid, diary_content FROM {FTS_TABLE} WHERE rowid IN :ids"
+        snippets = {rowid: _snippet_around(content, short_terms)
+                    for rowid, content in db.session.execute(text(snippet_sql).bindparams(ids), id_params)}
+    diaries = {row.id: row for row in db.session.query(Diary.id, Diary.date, Diary.sentiment_score, Diary.highlight_events)
+               .filter(Diary.id.in_(id_params["ids"]))}
+
+    results = []
+    for row in page:
+        diary = diaries.get(row.rowid)
+        if diary is None:
+            continue
+        results.append({
+            "id": diary.id,
+            "date": diary.date.isoformat(),
+            "sentiment_score": diary.sentiment_score,
+            "highlight_events": diary.highlight_events,
+            "snippet": snippets.get(row.rowid, ""),
+            # bm25 は小さいほど関連度が高いため、符号を反転して大きいほど関連度が高い値にする
+            "score": -row.score if row.score is not None else None,
+        })
+    return results, len(ranked) > limit
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild the diary full-text search index from existing diaries")
+    parser.parse_args(argv)
+
+    from app import create_app
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        ensure_search_index()
+        started_at = time.perf_counter()
+        rebuild_search_index()
+        count = db.session.execute(text("SELECT COUNT(*) FROM diary")).scalar()
+    print(f"Indexed {count} diaries in {time.perf_counter() - started_at:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
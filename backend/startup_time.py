@@ -0,0 +1,141 @@
+# backend/startup_time.py
+"""
+コールドスタートの所要時間を計測する。新しい Python プロセスを --runs 回起動し、
+app のインポート・create_app・init_db・(任意で) prewarm・最初のリクエストのそれぞれにかかった時間を集計する。
+
+    python startup_time.py --runs 10
+    python startup_time.py --prewarm --json startup.json
+    python startup_time.py --max-seconds 0.8   # インポート + create_app の中央値が超えたら終了コード 1
+    python startup_time.py --importtime 15     # 読み込みに時間のかかっているモジュールを表示する
+
+DB は一時ディレクトリの空の SQLite を使い、Gemini / Notion には接続しない。
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+_BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+_PHASES = ["import", "create_app", "init_db", "prewarm", "first_request", "process"]
+
+# 子プロセスで実行する計測コード (結果を JSON で 1 行出力する)
+_PROBE = """
+import json, os, sys, time
+started_at = time.perf_counter()
+import app as app_module
+imported_at = time.perf_counter()
+flask_app = app_module.create_app()
+created_at = time.perf_counter()
+with flask_app.app_context():
+    app_module.init_db()
+initialized_at = time.perf_counter()
+if os.environ.get("STARTUP_PREWARM") == "1":
+    app_module.prewarm(flask_app)
+prewarmed_at = time.perf_counter()
+response = flask_app.test_client().get("/api/diaries?limit=1")
+response.get_data()
+if response.status_code != 200:
+    sys.exit(f"first request failed with {response.status_code}")
+responded_at = time.perf_counter()
+print("STARTUP_RESULT " + json.dumps({
+    "import": imported_at - started_at,
+    "create_app": created_at - imported_at,
+    "init_db": initialized_at - created_at,
+    "prewarm": prewarmed_at - initialized_at,
+    "first_request": responded_at - prewarmed_at,
+}))
+"""
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Measure TalkLog cold-start latency in fresh processes")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--prewarm", action="store_true", help="create_app の後に prewarm を行う (APP_PREWARM=1 相当)")
+    parser.add_argument("--max-seconds", type=float, help="インポート + create_app の中央値の上限 (超えたら終了コード 1)")
+    parser.add_argument("--importtime", type=int, default=0, help="読み込みの遅いモジュールを上位この件数だけ表示する")
+    parser.add_argument("--json", help="結果を JSON で保存するパス")
+    return parser.parse_args(argv)
+
+
+def _child_env(db_path: str, prewarm: bool) -> dict:
+    env = dict(os.environ)
+    env["DATABASE_URL"] = f"sqlite:///{db_path}"
+    env.setdefault("GEMINI_API_KEY", "startup-time")
+    env["STARTUP_PREWARM"] = "1" if prewarm else "0"
+    # create_app 内での prewarm は計測項目を分けるため行わない
+    env["APP_PREWARM"] = "0"
+    return env
+
+
+def run_once(prewarm: bool) -> dict:
+    """新しいプロセスで 1 回計測し、段階ごとの秒数を返す"""
+    with tempfile.TemporaryDirectory(prefix="talklog-startup-") as work_dir:
+        started_at = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-c", _PROBE], cwd=_BACKEND_DIR, capture_output=True, text=True,
+                              env=_child_env(os.path.join(work_dir, "talklog.db"), prewarm))
+        elapsed = time.perf_counter() - started_at
+    if proc.returncode != 0:
+        raise SystemExit(f"Startup probe failed:\n{proc.stderr}")
+    line = next(line for line in proc.stdout.splitlines() if line.startswith("STARTUP_RESULT "))
+    result = json.loads(line[len("STARTUP_RESULT "):])
+    result["process"] = elapsed
+    return result
+
+
+def slowest_imports(limit: int) -> list:
+    """python -X importtime の結果から、累積時間の長いモジュールを返す ([(モジュール名, 秒)])"""
+    with tempfile.TemporaryDirectory(prefix="talklog-startup-") as work_dir:
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=_BACKEND_DIR,
+                              capture_output=True, text=True, env=_child_env(os.path.join(work_dir, "talklog.db"), False))
+    entries = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        if cumulative.isdigit():
+            entries.append((name, int(cumulative) / 1_000_000))
+    return sorted(entries, key=lambda entry: entry[1], reverse=True)[:limit]
+
+
+def median(values):
+    ordered = sorted(values)
+    mid = len(ordered) // 2
+    return ordered[mid] if len(ordered) % 2 else (ordered[mid - 1] + ordered[mid]) / 2
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    runs = [run_once(args.prewarm) for _ in range(args.runs)]
+    summary = {phase: {"median_ms": median([r[phase] for r in runs]) * 1000,
+                       "max_ms": max(r[phase] for r in runs) * 1000} for phase in _PHASES}
+    cold_start = median([r["import"] + r["create_app"] for r in runs])
+
+    print(f"{args.runs} runs{' with prewarm' if args.prewarm else ''}\n")
+    print(f"{'phase':<16}{'median ms':>12}{'max ms':>12}")
+    print("-" * 40)
+    for phase in _PHASES:
+        print(f"{phase:<16}{summary[phase]['median_ms']:>12.1f}{summary[phase]['max_ms']:>12.1f}")
+    print(f"\nimport + create_app (median): {cold_start * 1000:.1f}ms")
+
+    imports = slowest_imports(args.importtime) if args.importtime else []
+    if imports:
+        print("\nSlowest imports (cumulative):")
+        for name, seconds in imports:
+            print(f"  {seconds * 1000:>8.1f}ms  {name}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "phases": summary, "cold_start_ms": cold_start * 1000,
+                       "runs": runs, "slowest_imports": imports}, f, ensure_ascii=False, indent=2)
+
+    if args.max_seconds is not None and cold_start > args.max_seconds:
+        print(f"\nCold start {cold_start:.3f}s exceeds the budget of {args.max_seconds:.3f}s")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
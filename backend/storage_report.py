@@ -0,0 +1,178 @@
+# backend/storage_report.py
+"""
+日記の保存形式 (本文の圧縮・プレビュー列) の移行前後で、DB ファイルのサイズと一覧取得の所要時間を比べる。
+
+    python storage_report.py --diaries 100000
+    python storage_report.py --db talklog.db --json storage.json   # 既存の DB のコピーで計測する
+
+--db を指定しない場合は、移行前の形式 (本文をそのまま TEXT で保存し、プレビューのない行) の日記を作成する。
+移行は init_db と同じ処理 (_migrate_diary_storage と索引の作り直し) で行い、サイズは VACUUM 後の値を比べる。
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+_SEED_SENTENCES = [
+    "朝は少し寝坊したけど、ゆっくりコーヒーを飲んだ。",
+    "仕事で新しいプロジェクトの打ち合わせがあった。",
+    "帰り道に新しいカフェを見つけた。",
+    "友達と電話で久しぶりに話せて楽しかった。",
+    "夕飯はカレーを作った。",
+    "少し疲れたので早めに寝ることにする。",
+]
+# ダッシュボードの一覧が取得する項目 (移行前は本文全体を取得して最初の行だけを表示していた)
+_LIST_FIELDS_BEFORE = None
+_LIST_FIELDS_AFTER = "id,date,sentiment_score,highlight_events,preview"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare DB size and diary list latency before/after the storage migration")
+    parser.add_argument("--db", help="計測に使う既存の DB (コピーして使う)。省略時は移行前の形式の日記を作成する")
+    parser.add_argument("--diaries", type=int, default=20000, help="作成する日記の件数")
+    parser.add_argument("--pages", type=int, default=5, help="一覧を何ページたどるか (1 ページ 50 件)")
+    parser.add_argument("--runs", type=int, default=20, help="一覧の計測の繰り返し回数")
+    parser.add_argument("--json", help="結果を JSON で保存するパス")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def _seed_legacy(app_module, count, rng):
+    """移行前の形式 (本文は TEXT のまま、preview は NULL) で日記を挿入する"""
+    started_at = datetime.utcnow()
+    insert = text("INSERT INTO diary (date, diary_content, sentiment_score, highlight_events) "
+                  "VALUES (:date, :diary_content, :sentiment_score, :highlight_events)")
+    for offset in range(0, count, 10000):
+        rows = []
+        for i in range(offset, min(count, offset + 10000)):
+            sections = ["## 今日のハイライト"] + [f"- {rng.choice(_SEED_SENTENCES)}" for _ in range(3)]
+            sections += ["", "## 感じたこと・気づき"] + [f"- {rng.choice(_SEED_SENTENCES)}" for _ in range(4)]
+            sections += ["", "## ポジティブな点", f"- {rng.choice(_SEED_SENTENCES)}", "", "### タグ", "#会話ログ #今日の振り返り"]
+            rows.append({"date": started_at - timedelta(hours=8 * i), "diary_content": "\n".join(sections),
+                         "sentiment_score": round(rng.uniform(-1, 1), 2), "highlight_events": rng.choice(_SEED_SENTENCES)})
+        app_module.db.session.execute(insert, rows)
+        app_module.db.session.commit()
+
+
+def _sizes(app_module, db_path):
+    """VACUUM 後のファイルサイズと、(dbstat が使える場合) テーブル・索引ごとのサイズを返す"""
+    with app_module.db.engine.connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT").execute(text("VACUUM"))
+        try:
+            tables = dict(conn.execute(text("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name")).all())
+        except Exception:
+            tables = {}
+    diary = tables.get("diary")
+    fts = sum(size for name, size in tables.items() if name.startswith("diary_fts")) if tables else None
+    return {"file_bytes": os.path.getsize(db_path), "diary_table_bytes": diary, "search_index_bytes": fts}
+
+
+def _list_latency(client, fields, pages, runs):
+    """一覧を pages ページたどる時間を runs 回計測し、1 ページあたりの中央値・最大 (ms) と 1 ページのバイト数を返す"""
+    durations, page_bytes = [], []
+    for _ in range(runs):
+        cursor = None
+        for _ in range(pages):
+            params = {"limit": 50}
+            if fields:
+                params["fields"] = fields
+            if cursor:
+                params["cursor"] = cursor
+            started_at = time.perf_counter()
+            response = client.get("/api/diaries", query_string=params)
+            body = response.get_data()
+            durations.append(time.perf_counter() - started_at)
+            page_bytes.append(len(body))
+            cursor = json.loads(body).get("next_cursor")
+            if not cursor:
+                break
+    return {"page_median_ms": statistics.median(durations) * 1000, "page_max_ms": max(durations) * 1000,
+            "page_bytes": int(statistics.median(page_bytes))}
+
+
+def _detail_latency(client, diary_ids, runs):
+    durations = []
+    for i in range(runs):
+        started_at = time.perf_counter()
+        client.get(f"/api/diaries/{diary_ids[i % len(diary_ids)]}").get_data()
+        durations.append(time.perf_counter() - started_at)
+    return {"median_ms": statistics.median(durations) * 1000}
+
+
+def _format_bytes(value):
+    return "-" if value is None else f"{value / (1024 * 1024):.1f}MB"
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    work_dir = tempfile.mkdtemp(prefix="talklog-storage-")
+    db_path = os.path.join(work_dir, "talklog.db")
+    if args.db:
+        shutil.copyfile(args.db, db_path)
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.environ.setdefault("GEMINI_API_KEY", "storage-report")
+
+    import logging
+    logging.disable(logging.INFO)
+    import app as app_module
+    flask_app = app_module.create_app()
+    client = flask_app.test_client()
+    try:
+        with flask_app.app_context():
+            if not args.db:
+                app_module.init_db()
+                print(f"Creating {args.diaries} diaries in the pre-migration format", file=sys.stderr)
+                _seed_legacy(app_module, args.diaries, random.Random(args.seed))
+            else:
+                app_module.db.create_all()
+                app_module._add_missing_columns()
+            before = {"size": _sizes(app_module, db_path)}
+        before["list"] = _list_latency(client, _LIST_FIELDS_BEFORE, args.pages, args.runs)
+
+        with flask_app.app_context():
+            started_at = time.perf_counter()
+            app_module.init_db()
+            migration_seconds = time.perf_counter() - started_at
+            after = {"size": _sizes(app_module, db_path)}
+            diary_ids = [row[0] for row in app_module.db.session.execute(text("SELECT id FROM diary ORDER BY id DESC LIMIT 50"))]
+        after["list"] = _list_latency(client, _LIST_FIELDS_AFTER, args.pages, args.runs)
+        after["list_full"] = _list_latency(client, None, args.pages, args.runs)
+        after["detail"] = _detail_latency(client, diary_ids, args.runs * 5) if diary_ids else None
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    rows = [
+        ("DB file (after VACUUM)", _format_bytes(before["size"]["file_bytes"]), _format_bytes(after["size"]["file_bytes"])),
+        ("  diary table", _format_bytes(before["size"]["diary_table_bytes"]), _format_bytes(after["size"]["diary_table_bytes"])),
+        ("  search index", _format_bytes(before["size"]["search_index_bytes"]), _format_bytes(after["size"]["search_index_bytes"])),
+        ("list page median", f"{before['list']['page_median_ms']:.1f}ms", f"{after['list']['page_median_ms']:.1f}ms"),
+        ("list page max", f"{before['list']['page_max_ms']:.1f}ms", f"{after['list']['page_max_ms']:.1f}ms"),
+        ("list page size", f"{before['list']['page_bytes'] / 1024:.1f}KB", f"{after['list']['page_bytes'] / 1024:.1f}KB"),
+    ]
+    print(f"{'':<26}{'before':>12}{'after':>12}")
+    print("-" * 50)
+    for label, before_value, after_value in rows:
+        print(f"{label:<26}{before_value:>12}{after_value:>12}")
+    print(f"\nList before: all fields (diary_content). List after: fields={_LIST_FIELDS_AFTER}")
+    print(f"After, list with all fields (decompressing every body): {after['list_full']['page_median_ms']:.1f}ms per page")
+    if after["detail"]:
+        print(f"After, GET /api/diaries/<id>: {after['detail']['median_ms']:.2f}ms median")
+    print(f"Migration (init_db): {migration_seconds:.1f}s")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "before": before, "after": after, "migration_seconds": migration_seconds},
+                      f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())